@@ -1,5 +1,9 @@
 import re
-from typing import List, Any, Optional
+import json
+import math
+import time
+import uuid
+from typing import Callable, List, Dict, Any, Optional, Tuple
 from datetime import datetime
 import textwrap
 import streamlit as st
@@ -8,14 +12,34 @@ from streamlit.external.langchain import StreamlitCallbackHandler
 from utils.chat_utils import *
 from utils.str_utils import *
 from utils.data_utils import *
+from utils.plan_utils import *
+from utils.stream_utils import *
+from utils.chart_utils import ChartCodeError, ChartSpec, run_chart_code
+from utils.store_utils import ResultHandle, load_result, result_store_stats, spill_result, touch_session
+from utils.upload_utils import get_ingest_store
+from utils.index_utils import get_advisor, record_query
+from utils.engine_utils import ENGINES, DEFAULT_ENGINE
+from utils.trace_utils import TRACE_FORMATS, Trace, export_trace, span, start_trace, traced
 from prompts import *
 
+MAX_SQL_REPAIRS = 2
+TABLE_PAGE_ROWS = 100
 
+
+def relevant_schema(database_path: str, query: str) -> str:
+    """
+    获取与query相关且不超过token预算的schema
+    """
+    return get_create_statements(database_path, query, st.session_state.settings["schema_token_budget"])
+
+
+@traced()
 def is_db_related_question(messages: Messages, database_path: str) -> bool:
     """
     检查问题是否与数据库有关
     """
     history, question = chat_history_formatter(messages[:-1]), messages[-1]["content"]
+    schema = relevant_schema(database_path, f"{history}\n{question}")
     messages = [
         {
             "role": "system",
@@ -23,23 +47,24 @@ def is_db_related_question(messages: Messages, database_path: str) -> bool:
         },
         {
             "role": "user",
-            "content": f"Database Schema:\n{get_create_statements(database_path)}\n\nChat history:\n{history}\n\nUser's Question: \"{question}\"\nLet's think step by step."
+            "content": f"Database Schema:\n{schema}\n\nChat history:\n{history}\n\nUser's Question: \"{question}\"\nLet's think step by step."
         },
     ]
-    st.session_state["handler"]._thought_labeler.get_initial_label = lambda: "**Is DB related question**: Thinking..."
-    st.session_state["handler"]._thought_labeler.get_final_agent_thought_label = lambda: "**Is DB related question**: **Complete!**"
-    response = extract_xml(chat(messages), "response").lower()
+    set_thought_label("Is DB related question")
+    response = extract_xml(chat(messages, until_elements("response"), workspace_digest(database_path)), "response").lower()
     if response not in ["yes", "no"]:
         return "yes" in response
     else:
         return response == "yes"
 
 
+@traced()
 def rewrite_question(messages: Messages, database_path: str) -> Optional[str]:
     """
     重写与数据库相关的问题
     """
     history, question = chat_history_formatter(messages[:-1]), messages[-1]["content"]
+    schema = relevant_schema(database_path, f"{history}\n{question}")
     messages = [
         {
             "role": "system",
@@ -47,17 +72,121 @@ def rewrite_question(messages: Messages, database_path: str) -> Optional[str]:
         },
         {
             "role": "user",
-            "content": f"Database Schema:\n{get_create_statements(database_path)}\n\nChat history:\n{history}\n\nUser's Question: \"{question}\"\nLet's think step by step."
+            "content": f"Database Schema:\n{schema}\n\nChat history:\n{history}\n\nUser's Question: \"{question}\"\nLet's think step by step."
         },
     ]
-    st.session_state["handler"]._thought_labeler.get_initial_label = lambda: "**Rewrite question**: Thinking..."
-    st.session_state["handler"]._thought_labeler.get_final_agent_thought_label = lambda: "**Rewrite question**: **Complete!**"
-    return extract_xml(chat(messages), "rewritten_question")
+    set_thought_label("Rewrite question")
+    return extract_xml(chat(messages, until_elements("rewritten_question"), workspace_digest(database_path)), "rewritten_question")
 
 
-def planning(question: str, database_path: str) -> Optional[Any]:
+@traced()
+def route_question(messages: Messages, database_path: str) -> Optional[Tuple[bool, Optional[str]]]:
+    """
+    一次调用同时判断问题是否与数据库有关并重写问题, 输出无法解析时返回None
+    """
+    history, question = chat_history_formatter(messages[:-1]), messages[-1]["content"]
+    schema = relevant_schema(database_path, f"{history}\n{question}")
+    messages = [
+        {
+            "role": "system",
+            "content": ROUTE_QUESTION_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": f"Database Schema:\n{schema}\n\nChat history:\n{history}\n\nUser's Question: \"{question}\"\nLet's think step by step."
+        },
+    ]
+    set_thought_label("Route question")
+    response = chat(messages, until_elements("response", "rewritten_question"), workspace_digest(database_path))
+    decision = (extract_xml(response, "response") or "").lower()
+    if decision not in ["yes", "no"]:
+        return None
+    if decision == "no":
+        return False, None
+    rewritten_question = extract_xml(response, "rewritten_question")
+    if not rewritten_question:
+        return None
+    return True, rewritten_question
+
+
+@traced()
+def route(messages: Messages, database_path: str) -> Optional[str]:
+    """
+    路由问题: 与数据库有关时返回重写后的问题, 否则返回None
+
+    优先使用单次调用的路由, 解析失败时退回判断+重写两步调用
+    """
+    if st.session_state.settings["fused_router"]:
+        routed = route_question(messages, database_path)
+        if routed is not None:
+            return routed[1]
+    if not is_db_related_question(messages, database_path):
+        return None
+    return rewrite_question(messages, database_path) or messages[-1]["content"]
+
+
+def normalize_step(step: Dict[str, Any], steps: List[Any]) -> None:
+    """
+    校验并规范化计划中的单个步骤, 不合法时把operation标记为error; steps为计划中的全部步骤, 用于检查数据来源
+    """
+    operation = step.get("operation", "")
+    if not isinstance(operation, str):
+        step["operation"] = "error"
+        return
+    operation = operation.lower().strip()
+    if operation not in ["sql_gen", "visualization", "summary"]:
+        step["operation"] = "error"
+        return
+    step["operation"] = operation
+
+    step_number = step.get("step", 0)
+    if isinstance(step_number, str):
+        try:
+            step_number = int(step_number)
+        except:
+            step_number = 0
+    if not isinstance(step_number, int) or step_number < 1:
+        step["operation"] = "error"
+        return
+    step["step"] = step_number
+
+    params = step.get("parameters", {})
+    if operation == "sql_gen":
+        if "question" not in params or not isinstance(params["question"], str) or not params["question"].strip():
+            step["operation"] = "error"
+            return
+        params["question"] = params["question"].strip()
+    elif operation == "visualization":
+        chart_type = params.get("chart_type", "")
+        data_source = params.get("data_source", [])
+        title = params.get("title", "")
+        if not isinstance(chart_type, str) or not isinstance(data_source, list) or not isinstance(title, str):
+            step["operation"] = "error"
+            return
+        chart_type = chart_type.lower().strip()
+        title = title.strip()
+        for i in range(len(data_source)):
+            if isinstance(data_source[i], str):
+                try:
+                    data_source[i] = int(data_source[i])
+                except:
+                    data_source[i] = 0
+        data_source = [i for i in data_source if isinstance(i, int) and 0 < i < step["step"] and i <= len(steps)
+                       and isinstance(steps[i - 1], dict) and steps[i - 1]["operation"] == "sql_gen"]
+        if not chart_type or not data_source or not title or chart_type not in ["line", "bar", "area", "scatter"]:
+            step["operation"] = "error"
+            return
+        params["chart_type"] = chart_type
+        params["title"] = title
+        params["data_source"] = data_source
+
+
+@traced()
+def planning(question: str, database_path: str, on_step: Optional[Callable[[Dict[str, Any]], None]]=None) -> Optional[Any]:
     """
     指定计划
+
+    传入on_step时增量解析流式输出, 每个步骤生成完整且合法时立即回调; 返回值仍以完整输出解析出的计划为准
     """
     messages = [
         {
@@ -66,81 +195,79 @@ def planning(question: str, database_path: str) -> Optional[Any]:
         },
         {
             "role": "user",
-            "content": f"{get_create_statements(database_path)}\n\"{question}\"\nLet's think step by step.",
+            "content": f"{relevant_schema(database_path, question)}\n\"{question}\"\nLet's think step by step.",
         },
     ]
-    st.session_state["handler"]._thought_labeler.get_initial_label = lambda: "**Make a plan**: Thinking..."
-    st.session_state["handler"]._thought_labeler.get_final_agent_thought_label = lambda: "**Make a plan**: **Complete!**"
-    jsons = extract_json_strings(chat(messages))
+    parser, streamed = PlanStepParser(), []
+
+    def emit_steps(token: str) -> None:
+        for step in parser.feed(token):
+            streamed.append(step)
+            normalize_step(step, streamed)
+            if step["operation"] != "error":
+                on_step(step)
+    set_thought_label("Make a plan")
+    jsons = extract_json_strings(chat(messages, emit_steps if on_step is not None else None, workspace_digest(database_path)))
     plan = jsons[-1] if jsons else None
     if plan and "plan" in plan:
         plan["question"] = question
         if not isinstance(plan["plan"], list):
             plan["plan"] = []
-        has_summary = False
         for step in plan["plan"]:
-            if not isinstance(step, dict):
-                continue
-            operation = step.get("operation", "")
-            if not isinstance(operation, str):
-                step["operation"] = "error"
-                continue
-            operation = operation.lower().strip()
-            if operation not in ["sql_gen", "visualization", "summary"]:
-                step["operation"] = "error"
-                continue
-            step["operation"] = operation
-
-            step_number = step.get("step", 0)
-            if isinstance(step_number, str):
-                try:
-                    step_number = int(step_number)
-                except:
-                    step_number = 0
-            if not isinstance(step_number, int) or step_number < 1:
-                step["operation"] = "error"
-                continue
-            step["step"] = step_number
-            
-            params = step.get("parameters", {})
-            if operation == "sql_gen":
-                if "question" not in params or not isinstance(params["question"], str) or not params["question"].strip():
-                    step["operation"] = "error"
-                    continue
-                params["question"] = params["question"].strip()
-            elif operation == "visualization":
-                chart_type = params.get("chart_type", "")
-                data_source = params.get("data_source", [])
-                title = params.get("title", "")
-                if not isinstance(chart_type, str) or not isinstance(data_source, list) or not isinstance(title, str):
-                    step["operation"] = "error"
-                    continue
-                chart_type = chart_type.lower().strip()
-                title = title.strip()
-                for i in range(len(data_source)):
-                    if isinstance(data_source[i], str):
-                        try:
-                            data_source[i] = int(data_source[i])
-                        except:
-                            data_source[i] = 0
-                data_source = [i for i in data_source if isinstance(i, int) and i > 0 and i < step["step"] and plan["plan"][i - 1]["operation"] == "sql_gen"]
-                if not chart_type or not data_source or not title or chart_type not in ["line", "bar", "area", "scatter"]:
-                    step["operation"] = "error"
-                    continue
-                params["chart_type"] = chart_type
-                params["title"] = title
-                params["data_source"] = data_source
-            else:
-                has_summary = True
-        if has_summary:
-            plan["plan"] = [step for step in plan["plan"] if isinstance(step, dict) and step["operation"] != "error"]
+            if isinstance(step, dict):
+                normalize_step(step, plan["plan"])
+        plan["plan"] = [step for step in plan["plan"] if isinstance(step, dict) and step["operation"] != "error"]
+        if any(step["operation"] == "summary" for step in plan["plan"]):
             return plan
 
 
-def generate_sql(question: str, database_path: str) -> Optional[str]:
+def speculate_planning(prompt: str, database_path: str) -> Speculation:
     """
-    根据自然语言问题生成sql
+    在路由的同时用原始问题推测执行规划
     """
+    placeholder = handler_placeholder()
+    handler = fork_handler(placeholder.container()) if placeholder is not None else None
+    return Speculation(lambda: planning(prompt, database_path), handler, placeholder.empty if placeholder is not None else None)
+
+
+def record_speculation(hit: bool, seconds_saved: float=0.0) -> None:
+    """
+    记录当前会话推测规划的命中情况
+    """
+    stats = st.session_state.setdefault("speculation_stats", {"hits": 0, "misses": 0, "seconds_saved": 0.0})
+    stats["hits" if hit else "misses"] += 1
+    stats["seconds_saved"] += seconds_saved
+
+
+def plan_question(question: str, database_path: str, prompt: str, speculation: Optional[Speculation], routing_seconds: float,
+                  on_step: Optional[Callable[[Dict[str, Any]], None]]=None) -> Optional[Any]:
+    """
+    制定计划: 重写后的问题与原始问题只有细微差别时采用推测规划的结果, 否则取消推测并重新规划(流式输出步骤到on_step)
+    """
+    if speculation is not None:
+        if same_question(prompt, question):
+            try:
+                plan = speculation.result()
+            except Exception as e:
+                logger.info(f"Speculative planning failed, planning again: {e}")
+            else:
+                seconds_saved = min(routing_seconds, speculation.elapsed)
+                record_speculation(True, seconds_saved)
+                logger.info(f"Speculative plan adopted, saved {seconds_saved:.2f}s")
+                if plan:
+                    plan["question"] = question
+                return plan
+        speculation.cancel()
+        record_speculation(False)
+    return planning(question, database_path, on_step)
+
+
+@traced()
+def generate_sql(question: str, database_path: str, failed_sql: Optional[str]=None, error: Optional[str]=None) -> Optional[str]:
+    """
+    根据自然语言问题生成sql, 传入failed_sql与error时根据错误信息修复sql
+    """
+    schema = relevant_schema(database_path, f"{question}\n{failed_sql or ''}")
     messages = [
         {
             "role": "system",
@@ -148,21 +275,84 @@ def generate_sql(question: str, database_path: str) -> Optional[str]:
         },
         {
             "role": "user",
-            "content": f"{get_create_statements(database_path)}\n\"{question}\"\nLet's think step by step.",
+            "content": f"{schema}\n\"{question}\"\nLet's think step by step.",
         },
     ]
-    st.session_state["handler"]._thought_labeler.get_initial_label = lambda: "**Generate a SQL**: Thinking..."
-    st.session_state["handler"]._thought_labeler.get_final_agent_thought_label = lambda: "**Generate a SQL**: **Complete!**"
-    codes = extract_code(chat(messages), "sql")
+    if error:
+        messages += [
+            {
+                "role": "assistant",
+                "content": f"```sql\n{failed_sql}\n```" if failed_sql else "(no SQL code block)",
+            },
+            {
+                "role": "user",
+                "content": f"The SQL failed against the database above with this error:\n{error}\nFix the SQL so that it runs on this schema and still answers \"{question}\".\nLet's think step by step.",
+            },
+        ]
+    set_thought_label("Repair SQL" if error else "Generate a SQL")
+    codes = extract_code(chat(messages, scope=workspace_digest(database_path)), "sql")
     if codes:
         return codes[-1]
 
 
+@traced()
+def batch_generate_sql(questions: Dict[int, str], database_path: str) -> Dict[int, str]:
+    """
+    一次请求为多个子问题生成sql, questions为 {步骤编号: 问题}, 返回 {步骤编号: sql}; 缺少代码块的步骤不在结果中
+    """
+    schema = relevant_schema(database_path, "\n".join(questions.values()))
+    numbered = "\n".join(f"Step {step}: \"{question}\"" for step, question in questions.items())
+    messages = [
+        {
+            "role": "system",
+            "content": BATCH_GENERATE_SQL_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": f"{schema}\n{numbered}\nLet's think step by step.",
+        },
+    ]
+    set_thought_label(f"Generate {len(questions)} SQLs")
+    codes = extract_step_code(chat(messages, scope=workspace_digest(database_path)), "sql")
+    return {step: sql for step, sql in codes.items() if step in questions}
+
+
+@traced()
+def generate_and_execute_sql(question: str, database_path: str, sql: Optional[str]=None) -> Tuple[Optional[str], pd.DataFrame]:
+    """
+    生成并执行sql, 编译或执行失败时带上数据库错误信息重新生成, 最多修复MAX_SQL_REPAIRS次
+
+    传入sql(如批量生成的结果)时跳过首次生成
+    """
+    sql = sql or generate_sql(question, database_path)
+    for attempt in range(MAX_SQL_REPAIRS + 1):
+        error = validate_sql(sql, database_path) if sql else "The response did not contain a ```sql code block."
+        if not error:
+            query_result = execute_sql(sql, database_path)
+            error = query_result.attrs.get("error")
+            if not error:
+                return sql, query_result
+        if attempt == MAX_SQL_REPAIRS:
+            break
+        sql = generate_sql(question, database_path, sql, error)
+    query_result = pd.DataFrame()
+    query_result.attrs["error"] = error
+    return sql, query_result
+
+
+def chart_sources(data_source: List[int], plan: Any) -> List[pd.DataFrame]:
+    """
+    获取画图步骤的数据来源
+    """
+    return [step["query_result"] for step in plan["plan"] if step["step"] in data_source and step["result"]]
+
+
+@traced()
 def draw_chart(chart_type: str, data_source: List[int], title: str, database_path: str, plan: Any) -> Optional[str]:
     """
     画图
     """
-    dfs = [step["query_result"] for step in plan["plan"] if step["step"] in data_source and step["result"]]
+    dfs = chart_sources(data_source, plan)
     messages = [
         {
             "role": "system",
@@ -173,13 +363,13 @@ def draw_chart(chart_type: str, data_source: List[int], title: str, database_pat
             "content": f"Dataframe preview:\n{pd_df_formatter(dfs)}\nChart type: {chart_type}\nTitle: \"{title}\"\nLet's think step by step.",
         },
     ]
-    st.session_state["handler"]._thought_labeler.get_initial_label = lambda: "**Draw a chart**: Thinking..."
-    st.session_state["handler"]._thought_labeler.get_final_agent_thought_label = lambda: "**Draw a chart**: **Complete!**"
+    set_thought_label("Draw a chart")
     codes = extract_code(chat(messages), "python")
     if codes:
         return codes[-1]
 
 
+@traced()
 def summary(plan: Any, database_path: str) -> Optional[str]:
     """
     总结
@@ -197,6 +387,7 @@ def summary(plan: Any, database_path: str) -> Optional[str]:
                                     for idx, step in enumerate(relevant_charts)])
     if not relevant_charts:
         relevant_charts = "No Relevant Charts"
+    schema = relevant_schema(database_path, f"{question}\n{relevant_queries}")
 
     messages = [
         {
@@ -205,35 +396,115 @@ def summary(plan: Any, database_path: str) -> Optional[str]:
         },
         {
             "role": "user",
-            "content": f"Database Schema:\n{get_create_statements(database_path)}\n\nRelevant queries:\n{relevant_queries}\n\nRelevant charts:\n{relevant_charts}\n\nUser's question: \"{question}\"\nLet's think step by step.",
+            "content": f"Database Schema:\n{schema}\n\nRelevant queries:\n{relevant_queries}\n\nRelevant charts:\n{relevant_charts}\n\nUser's question: \"{question}\"\nLet's think step by step.",
         },
     ]
-    st.session_state["handler"]._thought_labeler.get_initial_label = lambda: "**Summary**: Thinking..."
-    st.session_state["handler"]._thought_labeler.get_final_agent_thought_label = lambda: "**Summary**: **Complete!**"
-    response = extract_xml(chat(messages), "response")
+    set_thought_label("Summary")
+    response = extract_xml(chat(messages, until_elements("response"), workspace_digest(database_path)), "response")
     return response
 
 
-def execute_plan(plan: Optional[Any], database_path: str) -> Optional[str]:
+def run_step(step: Any, plan: Any, database_path: str) -> Dict[str, Any]:
+    """
+    执行单个计划步骤
     """
-    执行规划
+    operation = step["operation"]
+    params = step.get("parameters", {})
+    if operation == "sql_gen":
+        sql, query_result = generate_and_execute_sql(params["question"], database_path, step.get("draft_sql"))
+        if query_dialect(database_path) == "SQLite":
+            record_query(sql, database_path)
+        return {"result": sql, "query_result": query_result}
+    elif operation == "visualization":
+        sources = [s for s in plan["plan"] if s["step"] in params["data_source"] and s["operation"] == "sql_gen"]
+        if any(s["query_result"].empty for s in sources):
+            logger.info(f"Skip visualization step {step['step']}: data source is empty")
+            return {"result": None}
+        code = draw_chart(params["chart_type"], params["data_source"], params["title"], database_path, plan)
+        if not code:
+            return {"result": None}
+        try:
+            with span("run_chart_code") as chart_span:
+                specs = run_chart_code(code, chart_sources(params["data_source"], plan))
+                chart_span.set(charts=len(specs))
+        except ChartCodeError as e:
+            logger.info(f"Discard chart of step {step['step']}: {e}")
+            return {"result": None}
+        return {"result": code, "chart_spec": specs}
+    else:
+        return {"result": summary(plan, database_path)}
+
+
+@traced()
+def execute_plan(plan: Optional[Any], database_path: str, executor: Optional[PlanExecutor]=None) -> Optional[str]:
+    """
+    执行规划, 可传入已开始执行计划前若干步骤的执行器
     """
     if not plan:
         return None
-    for step in plan["plan"]:
-        operation = step["operation"]
-        params = step.get("parameters", {})
-        if operation == "sql_gen":
-            sql = generate_sql(params["question"], database_path)
-            step["result"] = sql
-            step["query_result"] = execute_sql(sql, database_path)
-        elif operation == "visualization":
-            code = draw_chart(params["chart_type"], params["data_source"], params["title"], database_path, plan)
-            step["result"] = code
-        else:
-            response = summary(plan, database_path)
-            step["result"] = response
-            return response
+    if executor is None:
+        executor = PlanExecutor(lambda step: run_step(step, plan, database_path), st.session_state.settings["max_workers"])
+    steps = plan["plan"]
+    end = next((i + 1 for i, step in enumerate(steps) if step["operation"] == "summary"), len(steps))
+    pending = [step for step in steps[len(executor):end] if step["operation"] == "sql_gen"]
+    if st.session_state.settings["batched_sql"] and len(pending) > 1:
+        with thread_handler(fork_handler()):
+            drafts = batch_generate_sql({step["step"]: step["parameters"]["question"] for step in pending}, database_path)
+        logger.info(f"Batched SQL generation returned {len(drafts)} of {len(pending)} queries")
+        for step in pending:
+            if step["step"] in drafts:
+                step["draft_sql"] = drafts[step["step"]]
+    for step in steps[len(executor):end]:
+        executor.add(step, fork_handler())
+    executor.join()
+    for step in steps:
+        step.pop("draft_sql", None)
+    summaries = [step for step in plan["plan"] if step["operation"] == "summary" and "result" in step]
+    if summaries:
+        return summaries[0]["result"]
+
+
+@traced()
+def plan_and_execute(question: str, database_path: str, prompt: str, speculation: Optional[Speculation], routing_seconds: float) -> Tuple[Optional[Any], Optional[str]]:
+    """
+    制定并执行计划, 返回 (计划, 总结)
+
+    开启streaming_execution时边规划边执行: 计划中的步骤一旦完整输出就交给执行器, 让SQL的生成与执行和规划的生成重叠.
+    最终以完整输出解析出的计划为准, 已开始执行的步骤与它不一致时放弃这些步骤并按最终计划重新执行.
+    开启batched_sql时需要完整的计划才能批量生成sql, 因此不边规划边执行
+    """
+    settings = st.session_state.settings
+    if not settings["streaming_execution"] or settings["batched_sql"]:
+        plan = plan_question(question, database_path, prompt, speculation, routing_seconds)
+        return plan, execute_plan(plan, database_path)
+    streamed = {"question": question, "plan": []}
+    executor = PlanExecutor(lambda step: run_step(step, streamed, database_path), settings["max_workers"])
+    placeholder, box = None, None
+
+    def on_step(step: Dict[str, Any]) -> None:
+        nonlocal placeholder, box
+        steps = streamed["plan"]
+        if steps and steps[-1]["operation"] == "summary":
+            return
+        if placeholder is None:
+            placeholder = handler_placeholder()
+            box = placeholder.container() if placeholder is not None else None
+        steps.append(step)
+        executor.add(step, fork_handler(box.container() if box is not None else None))
+
+    plan = plan_question(question, database_path, prompt, speculation, routing_seconds, on_step)
+    steps = streamed["plan"]
+    if steps and plan is not None and plan["plan"][:len(steps)] == steps:
+        logger.info(f"Started {len(steps)} plan steps while planning")
+        plan["plan"] = steps + plan["plan"][len(steps):]
+        streamed.update(plan)
+        return streamed, execute_plan(streamed, database_path, executor)
+    if steps:
+        logger.info("Streamed plan steps differ from the final plan, executing the final plan again")
+    executor.cancel()
+    if placeholder is not None:
+        placeholder.empty()
+    return plan, execute_plan(plan, database_path)
 
 
 def chart(type: str, data: pd.DataFrame, x: str, y: Union[str, List[str]], horizontal: bool=False, stack: Optional[Union[bool, str]]=None) -> None:
@@ -250,50 +521,136 @@ def chart(type: str, data: pd.DataFrame, x: str, y: Union[str, List[str]], horiz
         st.area_chart(data, x=x, y=y, stack=stack)
 
 
-def write_response(response: str, plan: Any) -> str:
+def chart_specs(step: Any, plan: Any) -> List[ChartSpec]:
     """
-    渲染模型输出
+    获取画图步骤的图表: 优先回放缓存在步骤中的图表, 没有时执行一次图表代码并缓存
     """
-    plan = plan["plan"]
-    relevant_queries = [step for step in plan if step["operation"] == "sql_gen" and step["result"]]
-    relevant_charts = [step for step in plan if step["operation"] == "visualization" and step["result"]]
-    response = response.split('\n')
-    with st.chat_message("assistant"):
-        all_ = set()
-        all_buffer = []
-        buffer = []
-        for line in response:
-            all_buffer.append(line)
-            buffer.append(line)
-            pattern = r'\*\*(Query|Chart)\s*\d+\*\*'
-            matches = re.finditer(pattern, line, flags=re.IGNORECASE)
-            for match in matches:
-                tmp = match.group().strip("*").lower()
-                t = "query" if tmp.startswith("query") else "chart"
-                n = int(tmp[5:])
-                if t + str(n) in all_:
-                    continue
-                all_.add(t + str(n))
-                st.write('\n'.join(buffer))
-                buffer = []
-                if t == "query":
-                    step = relevant_queries[n - 1]
-                    all_buffer.append(f"**Query {n}:**\n```sql\n{step["result"]}\n```\n**Result {n}:**\n{pd_df_formatter(step["query_result"], head=False)}")
-                    st.write(f"**Query {n}:**\n```sql\n{step["result"]}\n```\n**Result {n}:**")
-                    st.table(step["query_result"])
-                else:
-                    step = relevant_charts[n - 1]
-                    dfs = [s["query_result"] for s in plan if s["step"] in step["parameters"]["data_source"] and s["result"]]
-                    dfs_preview = '\n'.join(["# " + line for line in pd_df_formatter(dfs).split('\n')])
-                    all_buffer.append(f"**Chart {n}:** {step["parameters"]["title"]}\n```python\n{dfs_preview}\n{step["result"]}\n```")
-                    st.write(f"**Chart {n}:** {step["parameters"]["title"]}\n")
-                    local_vars = {f"df{i + 1}": df for i, df in enumerate(dfs)}
-                    local_vars["chart"] = chart
-                    exec(step["result"], {}, local_vars)
-        if buffer:
-            st.write('\n'.join(buffer))
+    if "chart_spec" not in step:
+        try:
+            step["chart_spec"] = run_chart_code(step["result"], chart_sources(step["parameters"]["data_source"], plan))
+        except ChartCodeError as e:
+            logger.info(f"Discard chart of step {step['step']}: {e}")
+            step["chart_spec"] = []
+    return step["chart_spec"]
+
+
+def build_segments(response: str, plan: Any) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    把总结切分为渲染片段(文本、查询结果表、图表)并生成纯文本版本
+
+    只在回答生成时计算一次, 片段通过步骤下标引用计划中的结果, 重新渲染时直接回放
+    """
+    steps = plan["plan"]
+    relevant_queries = [i for i, step in enumerate(steps) if step["operation"] == "sql_gen" and step["result"]]
+    relevant_charts = [i for i, step in enumerate(steps) if step["operation"] == "visualization" and step["result"]]
+    segments = []
+    all_ = set()
+    all_buffer = []
+    buffer = []
+    for line in response.split('\n'):
+        all_buffer.append(line)
+        buffer.append(line)
+        pattern = r'\*\*(Query|Chart)\s*\d+\*\*'
+        matches = re.finditer(pattern, line, flags=re.IGNORECASE)
+        for match in matches:
+            tmp = match.group().strip("*").lower()
+            t = "query" if tmp.startswith("query") else "chart"
+            n = int(tmp[5:])
+            refs = relevant_queries if t == "query" else relevant_charts
+            if t + str(n) in all_ or not 1 <= n <= len(refs):
+                continue
+            all_.add(t + str(n))
+            if buffer:
+                segments.append({"kind": "text", "text": '\n'.join(buffer)})
             buffer = []
-    return '\n'.join(all_buffer)
+            step = steps[refs[n - 1]]
+            if t == "query":
+                all_buffer.append(f"**Query {n}:**\n```sql\n{step["result"]}\n```\n**Result {n}:**\n{pd_df_formatter(step["query_result"], head=False)}")
+            else:
+                dfs = chart_sources(step["parameters"]["data_source"], plan)
+                dfs_preview = '\n'.join(["# " + line for line in pd_df_formatter(dfs).split('\n')])
+                all_buffer.append(f"**Chart {n}:** {step["parameters"]["title"]}\n```python\n{dfs_preview}\n{step["result"]}\n```")
+                chart_specs(step, plan)
+            segments.append({"kind": t, "n": n, "step": refs[n - 1]})
+    if buffer:
+        segments.append({"kind": "text", "text": '\n'.join(buffer)})
+    return segments, '\n'.join(all_buffer)
+
+
+def spill_plan(plan: Any) -> None:
+    """
+    把计划中的大查询结果移到会话的磁盘存储, 会话状态中只保留句柄与预览
+    """
+    session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+    for step in plan["plan"]:
+        if isinstance(step.get("query_result"), pd.DataFrame):
+            step["query_result"] = spill_result(session_id, step["query_result"])
+
+
+def render_table(result: Union[pd.DataFrame, ResultHandle], key: str) -> None:
+    """
+    渲染查询结果: 小表整体渲染, 大表分页, 每次只发送当前页; 溢出到磁盘的结果只在翻到预览之外的页时才读取
+    """
+    rows = len(result) if isinstance(result, pd.DataFrame) else result.rows
+    if rows <= TABLE_PAGE_ROWS:
+        st.table(result if isinstance(result, pd.DataFrame) else result.preview)
+        return
+    pages = math.ceil(rows / TABLE_PAGE_ROWS)
+    page = st.number_input(f"Page (of {pages}, {rows} rows)", 1, pages, 1, key=key)
+    start, end = (page - 1) * TABLE_PAGE_ROWS, page * TABLE_PAGE_ROWS
+    if isinstance(result, ResultHandle) and end <= len(result.preview):
+        df = result.preview
+    else:
+        df, complete = load_result(result)
+        if not complete:
+            st.caption(f"This result was evicted from the session store, only the first {len(df)} rows are kept")
+    st.dataframe(df.iloc[start:end], use_container_width=True)
+
+
+def render_segments(segments: List[Dict[str, Any]], plan: Any, key: str) -> None:
+    """
+    回放渲染片段, key用于区分不同消息中的分页控件
+    """
+    steps = plan["plan"]
+    with st.chat_message("assistant"):
+        for segment in segments:
+            if segment["kind"] == "text":
+                st.write(segment["text"])
+                continue
+            n, step = segment["n"], steps[segment["step"]]
+            if segment["kind"] == "query":
+                st.write(f"**Query {n}:**\n```sql\n{step["result"]}\n```\n**Result {n}:**")
+                render_table(step["query_result"], f"{key}-query{n}")
+            else:
+                st.write(f"**Chart {n}:** {step["parameters"]["title"]}\n")
+                for spec in chart_specs(step, plan):
+                    chart(spec.type, spec.data, spec.x, spec.y, spec.horizontal, spec.stack)
+
+
+def render_trace(trace: Trace) -> None:
+    """
+    以瀑布图展示一次提问的各阶段耗时, 并提供JSONL与OTLP格式的下载
+    """
+    stats = trace.summary()
+    estimated = f" ({stats['llm_estimated_usage']} calls estimated)" if stats["llm_estimated_usage"] else ""
+    st.caption(f"{stats['duration_ms'] / 1000:.2f}s total, {stats['llm_calls']} LLM calls ({stats['llm_cache_hits']} cached),"
+               f" {stats['prompt_tokens']:,} prompt / {stats['completion_tokens']:,} completion tokens{estimated},"
+               f" {stats['sql_queries']} queries in {stats['sql_ms']:.0f} ms returning {stats['rows']:,} rows")
+    df = trace.to_frame()
+    st.vega_lite_chart(df, {
+        "height": max(len(df) * 18, 60),
+        "mark": {"type": "bar", "cornerRadius": 2},
+        "encoding": {
+            "y": {"field": "span", "type": "nominal", "sort": None, "title": None, "axis": {"labelLimit": 160}},
+            "x": {"field": "start_ms", "type": "quantitative", "title": "ms"},
+            "x2": {"field": "end_ms"},
+            "color": {"condition": {"test": "datum.error != ''", "value": "#d62728"}, "value": "#4c78a8"},
+            "tooltip": [{"field": "span"}, {"field": "duration_ms", "format": ".1f"}, {"field": "metrics"}, {"field": "error"}],
+        },
+    }, use_container_width=True)
+    left, right = st.columns(2)
+    left.download_button("JSONL", trace.to_jsonl(), f"{trace.trace_id}.jsonl", use_container_width=True)
+    right.download_button("OTLP", json.dumps(trace.to_otlp()), f"{trace.trace_id}.otlp.json", use_container_width=True)
 
 
 @st.dialog("Settings")
@@ -305,12 +662,32 @@ def settings() -> None:
     api_key = st.text_input("api_key", st.session_state.settings["api_key"])
     model = st.text_input("model", st.session_state.settings["model"])
     temperature = st.slider("temperature", 0.0, 2.0, st.session_state.settings["temperature"], .05)
+    max_workers = st.number_input("max_workers", 1, 16, st.session_state.settings["max_workers"], help="Number of plan steps executed concurrently")
+    fused_router = st.toggle("fused_router", st.session_state.settings["fused_router"], help="Decide relevance and rewrite the question in a single LLM call")
+    speculative_planning = st.toggle("speculative_planning", st.session_state.settings["speculative_planning"], help="Start planning on the original question while it is being routed")
+    schema_token_budget = st.number_input("schema_token_budget", 500, 64000, st.session_state.settings["schema_token_budget"], step=500, help="Approximate token budget for the schema included in each prompt; wider databases are pruned to the most relevant tables and columns")
+    batched_sql = st.toggle("batched_sql", st.session_state.settings["batched_sql"], help="Generate the SQL for all query steps of a plan in one request once the plan is complete; takes precedence over streaming_execution")
+    query_engine = st.selectbox("query_engine", ENGINES, ENGINES.index(st.session_state.settings["query_engine"]), help="Engine used to query newly loaded workspaces: sqlite (row store), or duckdb over Parquet files written at load time (faster aggregates on large tables)")
+    streaming_execution = st.toggle("streaming_execution", st.session_state.settings["streaming_execution"], help="Start executing plan steps as soon as the planner has written them")
+    trace_export = st.selectbox("trace_export", TRACE_FORMATS, TRACE_FORMATS.index(st.session_state.settings["trace_export"]), help="Append the spans of every question to ./tmp/traces as JSONL (one span per line) or OpenTelemetry OTLP/JSON (one trace per line)")
+    trace_panel = st.toggle("trace_panel", st.session_state.settings["trace_panel"], help="Show the span waterfall of the last question in the sidebar")
+    llm_cache = st.toggle("llm_cache", st.session_state.settings["llm_cache"], help="Reuse responses to identical requests when temperature is 0")
     if st.button("Confirm", type="primary"):
         st.session_state["settings"] = {
             "base_url": base_url,
             "api_key": api_key,
             "model": model,
             "temperature": temperature,
+            "max_workers": max_workers,
+            "fused_router": fused_router,
+            "llm_cache": llm_cache,
+            "speculative_planning": speculative_planning,
+            "streaming_execution": streaming_execution,
+            "batched_sql": batched_sql,
+            "query_engine": query_engine,
+            "trace_export": trace_export,
+            "trace_panel": trace_panel,
+            "schema_token_budget": schema_token_budget,
         }
         st.rerun()
 
@@ -322,8 +699,20 @@ if __name__ == "__main__":
             "api_key": "",
             "model": "deepseek-v3",
             "temperature": 0.0,
+            "max_workers": 4,
+            "fused_router": True,
+            "llm_cache": True,
+            "speculative_planning": True,
+            "streaming_execution": True,
+            "batched_sql": False,
+            "query_engine": DEFAULT_ENGINE,
+            "trace_export": "off",
+            "trace_panel": False,
+            "schema_token_budget": SCHEMA_TOKEN_BUDGET,
         }
 
+    touch_session(st.session_state.setdefault("session_id", uuid.uuid4().hex))
+
     if "histories" not in st.session_state:
         st.session_state["histories"] = []
     histories = st.session_state["histories"]
@@ -349,22 +738,55 @@ if __name__ == "__main__":
         st.warning("Please enter your api_key")
         st.stop()
 
-    uploaded_file = st.file_uploader(
-        "Upload a Data file",
+    uploaded_files = st.file_uploader(
+        "Upload Data files",
         type=list(["csv", "xls", "xlsx", "xlsm", "xlsb", "sqlite", "db"]),
-        help="Various File formats are Support",
+        accept_multiple_files=True,
+        help="Various File formats are Support. All files and sheets are loaded into one workspace and can be queried together",
     )
 
-    if uploaded_file:
-        filename = load_data(uploaded_file)
-        database_path = f"./tmp/{filename}.sqlite"
+    database_path = load_data(uploaded_files, st.session_state.settings["query_engine"]) if uploaded_files else None
+
+    if database_path:
+        with st.sidebar:
+            with st.expander("Performance", icon=":material/speed:"):
+                st.text("Query engine")
+                st.caption(f"{query_dialect(database_path)} (switch with query_engine in the settings)")
+                st.text("Automatic indexes")
+                indexes = get_advisor(database_path).report()
+                if indexes:
+                    st.dataframe(indexes, hide_index=True, use_container_width=True)
+                else:
+                    st.caption("No indexes created yet")
+                st.text("Query result cache")
+                stats = result_cache_stats()
+                lookups = stats["hits"] + stats["misses"]
+                st.caption(f"{stats['hits']} hits / {stats['misses']} misses"
+                           f" ({stats['hits'] / lookups if lookups else 0:.0%} hit rate),"
+                           f" {stats['bytes_saved'] / 2 ** 20:.1f} MB served from cache,"
+                           f" {stats['memory_entries']} in memory / {stats['disk_entries']} spilled")
+                st.text("Speculative planning")
+                stats = st.session_state.get("speculation_stats", {"hits": 0, "misses": 0, "seconds_saved": 0.0})
+                attempts = stats["hits"] + stats["misses"]
+                st.caption(f"{stats['hits']} adopted / {stats['misses']} cancelled"
+                           f" ({stats['hits'] / attempts if attempts else 0:.0%} paid off),"
+                           f" {stats['seconds_saved']:.1f}s saved")
+                st.text("Session results")
+                stats = result_store_stats(st.session_state.get("session_id"))
+                st.caption(f"{stats.get('session_entries', 0)} results / {stats.get('session_bytes', 0) / 2 ** 20:.1f} MB on disk for this session,"
+                           f" {stats['bytes'] / 2 ** 20:.1f} MB across sessions,"
+                           f" {stats['loaded_bytes'] / 2 ** 20:.1f} MB loaded, {stats['evictions']} evicted")
+                st.text("Upload store")
+                stats = get_ingest_store().stats()
+                st.caption(f"{stats['parts']} files / {stats['workspaces']} workspaces, {stats['bytes'] / 2 ** 20:.1f} MB,"
+                           f" {stats['leases']} active sessions")
 
     if "messages" not in st.session_state:
         st.session_state["messages"] = []
 
     for msg in st.session_state.messages:
         if "render" in msg:
-            write_response(msg["render"]["response"], msg["render"]["plan"])
+            render_segments(msg["render"]["segments"], msg["render"]["plan"], msg["render"]["key"])
         else:
             st.chat_message(msg["role"]).write(msg["content"])
 
@@ -376,23 +798,41 @@ if __name__ == "__main__":
             expand_new_thoughts=True,
             collapse_completed_thoughts=True,
         )
-        db_related = False
-        if uploaded_file and is_db_related_question(st.session_state.messages, database_path):
-            question = rewrite_question(st.session_state.messages, database_path)
-            if not question:
-                question = prompt
-            plan = planning(question, database_path)
-            response = execute_plan(plan, database_path)
-            if response:
-                db_related = True
-                plain_text = write_response(response, plan)
-                st.session_state.messages.append({"role": "assistant", "content": plain_text, "render": {"response": response, "plan": plan}})
-        if not db_related:
-            stream = chat_stream(st.session_state.messages)
-            with st.chat_message("assistant"):
-                response = st.write_stream(stream)
-            st.session_state.messages.append({"role": "assistant", "content": response})
+        with start_trace("question", prompt_chars=len(prompt), engine=query_dialect(database_path) if database_path else None) as trace:
+            db_related = False
+            question, speculation, routing_seconds = None, None, 0.0
+            if database_path:
+                if st.session_state.settings["speculative_planning"]:
+                    speculation = speculate_planning(prompt, database_path)
+                routing_start = time.perf_counter()
+                question = route(st.session_state.messages, database_path)
+                routing_seconds = time.perf_counter() - routing_start
+            if not question and speculation is not None:
+                speculation.cancel()
+                record_speculation(False)
+            if question:
+                plan, response = plan_and_execute(question, database_path, prompt, speculation, routing_seconds)
+                if response:
+                    db_related = True
+                    with span("render"):
+                        segments, plain_text = build_segments(response, plan)
+                        render = {"segments": segments, "plan": plan, "key": uuid.uuid4().hex}
+                        render_segments(render["segments"], render["plan"], render["key"])
+                    st.session_state.messages.append({"role": "assistant", "content": plain_text, "render": render})
+                    spill_plan(plan)
+            if not db_related:
+                stream = chat_stream(st.session_state.messages)
+                with st.chat_message("assistant"):
+                    response = st.write_stream(stream)
+                st.session_state.messages.append({"role": "assistant", "content": response})
+        st.session_state["last_trace"] = trace
+        export_trace(trace, st.session_state.settings["trace_export"])
         curr_idx = st.session_state.curr_idx
         if curr_idx == -1:
             st.session_state.histories.insert(0, (prompt.replace("\n", " "), st.session_state.messages, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
             st.session_state.curr_idx = 0
+
+    if st.session_state.settings["trace_panel"] and "last_trace" in st.session_state:
+        with st.sidebar:
+            with st.expander("Trace of the last question", icon=":material/timeline:", expanded=True):
+                render_trace(st.session_state["last_trace"])
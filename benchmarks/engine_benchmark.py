@@ -0,0 +1,116 @@
+"""
+对比SQLite与DuckDB(Parquet)查询引擎在生成数据上的聚合查询耗时
+
+按行数生成员工表, 写入SQLite并导出Parquet, 再用两个引擎分别执行相同的分组聚合查询并核对结果
+
+用法: python benchmarks/engine_benchmark.py [行数 ...]  (默认 100000 1000000 10000000)
+"""
+import os
+import sys
+import time
+import shutil
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.engine_utils import DuckDBEngine, SQLiteEngine, export_parquet, parquet_dir
+from utils.ingest_utils import ingest_chunks
+
+BENCHMARK_DIR = "./tmp/engine_benchmark"
+SIZES = [10 ** 5, 10 ** 6, 10 ** 7]
+CHUNK_ROWS = 10 ** 6
+REPEATS = 3
+TIMEOUT = 600.0
+
+QUERIES = {
+    "age groups": "SELECT age - age % 10 AS age_group, COUNT(*) AS employees FROM employees GROUP BY age_group ORDER BY age_group;",
+    "avg salary by department": "SELECT department, AVG(salary) AS avg_salary FROM employees GROUP BY department ORDER BY department;",
+    "filtered aggregate": "SELECT location, gender, COUNT(*) AS n, MAX(salary) AS max_salary FROM employees WHERE age > 40 AND rank = 'SDE3' GROUP BY location, gender ORDER BY location, gender;",
+    "top departments": "SELECT department, SUM(salary) AS payroll FROM employees GROUP BY department ORDER BY payroll DESC LIMIT 5;",
+}
+
+
+def generate_chunks(n_rows: int, seed: int=0):
+    """
+    分块生成员工数据
+    """
+    rng = np.random.default_rng(seed)
+    departments = np.array([f"Dept{i:02d}" for i in range(40)])
+    locations = np.array(["Beijing", "Shanghai", "Shenzhen", "Hangzhou", "Chengdu", "Remote"])
+    ranks = np.array(["SDE1", "SDE2", "SDE3", "Manager", "Director"])
+    for start in range(0, n_rows, CHUNK_ROWS):
+        size = min(CHUNK_ROWS, n_rows - start)
+        yield pd.DataFrame({
+            "id": np.arange(start, start + size),
+            "age": rng.integers(20, 65, size),
+            "gender": rng.choice(np.array(["Male", "Female"]), size),
+            "department": rng.choice(departments, size),
+            "location": rng.choice(locations, size),
+            "rank": rng.choice(ranks, size),
+            "salary": rng.normal(30000, 8000, size).round(2),
+        })
+
+
+def prepare(n_rows: int) -> str:
+    """
+    生成数据库与Parquet目录, 返回数据库路径
+    """
+    database_path = os.path.join(BENCHMARK_DIR, f"{n_rows}.sqlite")
+    if not os.path.exists(database_path):
+        start = time.perf_counter()
+        ingest_chunks(generate_chunks(n_rows), database_path, "employees", profile=False)
+        print(f"  sqlite ingest: {time.perf_counter() - start:.1f}s, {os.path.getsize(database_path) / 2 ** 20:.0f} MB")
+    if not os.path.isdir(parquet_dir(database_path)):
+        start = time.perf_counter()
+        export_parquet(database_path, parquet_dir(database_path))
+        size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(parquet_dir(database_path)) for name in names)
+        print(f"  parquet export: {time.perf_counter() - start:.1f}s, {size / 2 ** 20:.0f} MB")
+    return database_path
+
+
+def measure(engine, query: str) -> tuple:
+    """
+    执行REPEATS次, 返回最短耗时与结果
+    """
+    best, df = float("inf"), None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        df = engine.execute(query, timeout=TIMEOUT, max_instructions=10 ** 12)
+        best = min(best, time.perf_counter() - start)
+    return best, df
+
+
+def same_result(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+    """
+    按值比较两个引擎的结果, 浮点数允许误差
+    """
+    if a.shape != b.shape:
+        return False
+    for x, y in zip(a.itertuples(index=False), b.itertuples(index=False)):
+        for u, v in zip(x, y):
+            if isinstance(u, (float, np.floating)) or isinstance(v, (float, np.floating)):
+                if not np.isclose(float(u), float(v), rtol=1e-9):
+                    return False
+            elif u != v:
+                return False
+    return True
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    try:
+        for n_rows in sizes:
+            print(f"{n_rows:,} rows")
+            database_path = prepare(n_rows)
+            engines = [SQLiteEngine(database_path), DuckDBEngine(database_path)]
+            print(f"  {'query':<28}{'sqlite (ms)':>14}{'duckdb (ms)':>14}{'speedup':>10}  same")
+            for name, query in QUERIES.items():
+                (sqlite_seconds, sqlite_df), (duckdb_seconds, duckdb_df) = [measure(engine, query) for engine in engines]
+                print(f"  {name:<28}{sqlite_seconds * 1000:>14.1f}{duckdb_seconds * 1000:>14.1f}"
+                      f"{sqlite_seconds / duckdb_seconds:>9.1f}x  {same_result(sqlite_df, duckdb_df)}")
+            for engine in engines:
+                engine.close()
+    finally:
+        shutil.rmtree(BENCHMARK_DIR, ignore_errors=True)
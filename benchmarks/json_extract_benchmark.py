@@ -0,0 +1,163 @@
+"""
+extract_json_strings 的回归检查与性能测试
+
+先在 json_corpus.jsonl 与随机生成的文本上确认新旧实现结果完全一致, 再比较两者在长输出上的耗时
+
+用法: python benchmarks/json_extract_benchmark.py
+"""
+import os
+import sys
+import json
+import time
+import random
+from typing import Any, Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.str_utils import extract_json_strings, is_valid_json
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "json_corpus.jsonl")
+FUZZ_CASES = 2000
+FUZZ_ALPHABET = '{}[]"\\:, \n0123456789abtruefalsenul-.eE'
+REPEATS = 3
+
+
+def reference_extract_json_strings(s: str) -> List[Any]:
+    """
+    旧版实现: 对每个起点逐字符扫描, 每次括号配平都调用 json.loads
+    """
+    result = []
+    i = 0
+    n = len(s)
+    while i < n:
+        if s[i] in ('{', '['):
+            stack = [s[i]]
+            start = i
+            max_j = -1
+            in_string = False
+            escaped = False
+            j = i + 1
+            while j < n:
+                c = s[j]
+                if not in_string:
+                    if c == '"':
+                        in_string = True
+                        escaped = False
+                    elif c in ('{', '['):
+                        stack.append(c)
+                    elif c == '}':
+                        if stack and stack[-1] == '{':
+                            stack.pop()
+                        else:
+                            break
+                    elif c == ']':
+                        if stack and stack[-1] == '[':
+                            stack.pop()
+                        else:
+                            break
+                else:
+                    if escaped:
+                        escaped = False
+                    else:
+                        if c == '\\':
+                            escaped = True
+                        elif c == '"':
+                            in_string = False
+                if not stack:
+                    substr = s[start:j+1]
+                    if is_valid_json(substr):
+                        max_j = j
+                j += 1
+            if max_j != -1:
+                result.append(s[start:max_j+1])
+                i = max_j + 1
+            else:
+                i += 1
+        else:
+            i += 1
+    result = [json.loads(j) for j in result]
+    return result
+
+
+def load_corpus() -> List[dict]:
+    """
+    读取回归语料
+    """
+    with open(CORPUS_PATH, encoding="utf-8") as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def fuzz_texts(n: int, seed: int=0) -> List[str]:
+    """
+    随机生成由JSON片段与噪声拼接而成的文本
+    """
+    rng = random.Random(seed)
+    corpus = [case["text"] for case in load_corpus()]
+    texts = []
+    for _ in range(n):
+        pieces = []
+        for _ in range(rng.randint(1, 6)):
+            kind = rng.random()
+            if kind < 0.4:
+                pieces.append("".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(1, 40))))
+            elif kind < 0.7:
+                text = rng.choice(corpus)
+                start = rng.randint(0, len(text))
+                pieces.append(text[start:start + rng.randint(0, 200)])
+            else:
+                pieces.append(json.dumps(rng.choice([{"a": [1, {"b": "}"}]}, [[], {}], {"q": "\"[x]\""}, [1.5, None, True]])))
+        texts.append("".join(pieces))
+    return texts
+
+
+def check(texts: List[str]) -> int:
+    """
+    比较新旧实现, 返回不一致的条数
+    """
+    mismatches = 0
+    for text in texts:
+        expected, actual = reference_extract_json_strings(text), extract_json_strings(text)
+        if expected != actual and json.dumps(expected) != json.dumps(actual):
+            mismatches += 1
+            print(f"MISMATCH: {text[:120]!r}\n  expected {expected!r}\n  actual   {actual!r}")
+    return mismatches
+
+
+def timeit(fn: Callable[[str], Any], text: str) -> float:
+    """
+    多次运行取最短耗时
+    """
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def large_outputs() -> List[tuple]:
+    """
+    构造长输出: 重复的规划回答、带注释的嵌套示例、深层嵌套但末尾非法的JSON
+    """
+    corpus = {case["name"]: case["text"] for case in load_corpus()}
+    nested_invalid = "{\"plan\": [" + ", ".join(
+        json.dumps({"step": i, "operation": "sql_gen", "parameters": {"question": f"q{i}", "examples": [[i, [i, [i]]]]}})
+        for i in range(60)) + ", ]}"
+    return [
+        ("planning answer x10", "\n\n".join([corpus["echoed_template_with_comments"]] * 10)),
+        ("nested example with trailing comma", nested_invalid),
+        ("long prose with brackets", corpus["prose_brackets"] * 30 + corpus["plan_in_fence"]),
+    ]
+
+
+if __name__ == "__main__":
+    corpus = load_corpus()
+    mismatches = check([case["text"] for case in corpus])
+    print(f"corpus: {len(corpus)} cases, {mismatches} mismatches")
+    fuzz_mismatches = check(fuzz_texts(FUZZ_CASES))
+    print(f"fuzz: {FUZZ_CASES} cases, {fuzz_mismatches} mismatches")
+    print(f"{'output':<40}{'chars':>10}{'old (ms)':>12}{'new (ms)':>12}{'speedup':>10}")
+    for name, text in large_outputs():
+        old, new = timeit(reference_extract_json_strings, text), timeit(extract_json_strings, text)
+        print(f"{name:<40}{len(text):>10}{old * 1000:>12.1f}{new * 1000:>12.1f}{old / new:>9.0f}x")
+    sys.exit(1 if mismatches or fuzz_mismatches else 0)
@@ -0,0 +1,115 @@
+"""
+对比单次调用路由与判断+重写两步路由的延迟和token用量
+
+两种路由都在解析到所需的xml元素后提前结束流式请求, 此时token用量为本地估算值, 计入estimated_calls
+
+用法: streamlit run benchmarks/router_benchmark.py
+"""
+import os
+import sys
+import time
+import pandas as pd
+import streamlit as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import is_db_related_question, rewrite_question, route_question
+from utils.chat_utils import token_usage
+from utils.ingest_utils import iter_excel_chunks, ingest_chunks
+from utils.selection_utils import SCHEMA_TOKEN_BUDGET
+
+DATABASE_PATH = "./tmp/router_benchmark.sqlite"
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "salary.xlsx")
+REPEATS = 3
+
+# 每个用例为一段对话, 最后一条是待路由的问题
+CASES = [
+    [{"role": "user", "content": "What is the number of employees in each age group?"}],
+    [{"role": "user", "content": "What is the average salary of female employees?"}],
+    [{"role": "user", "content": "What is the average salary in Hong Kong?"},
+     {"role": "assistant", "content": "The average salary in Hong Kong is 12.3."},
+     {"role": "user", "content": "How does it compare to Greece?"}],
+    [{"role": "user", "content": "Which rank has the highest salary?"},
+     {"role": "assistant", "content": "SDE3 has the highest average salary."},
+     {"role": "user", "content": "How many people hold that rank in each location?"}],
+    [{"role": "user", "content": "Write a haiku about autumn."}],
+    [{"role": "user", "content": "What is the capital of France?"}],
+]
+
+
+def two_step(messages, database_path):
+    """
+    判断+重写两步路由
+    """
+    if not is_db_related_question(messages, database_path):
+        return None
+    return rewrite_question(messages, database_path) or messages[-1]["content"]
+
+
+def fused(messages, database_path):
+    """
+    单次调用路由, 解析失败时记为fallback
+    """
+    routed = route_question(messages, database_path)
+    if routed is None:
+        return "<fallback>"
+    return routed[1]
+
+
+def measure(router, messages):
+    """
+    运行一次路由, 返回结果、耗时与token用量
+    """
+    before = token_usage()
+    start = time.perf_counter()
+    result = router(messages, DATABASE_PATH)
+    elapsed = time.perf_counter() - start
+    after = token_usage()
+    return {
+        "result": result,
+        "seconds": elapsed,
+        **{key: after[key] - before[key] for key in after},
+    }
+
+
+st.title("Router benchmark")
+with st.sidebar:
+    base_url = st.text_input("base_url", "https://api.deepseek.com")
+    api_key = st.text_input("api_key", type="password")
+    model = st.text_input("model", "deepseek-chat")
+    repeats = st.number_input("repeats", 1, 10, REPEATS)
+    start = st.button("Run", disabled=not api_key)
+
+# 关闭响应缓存, 保证两种路由都真正请求了LLM
+st.session_state.settings = {
+    "base_url": base_url,
+    "api_key": api_key,
+    "model": model,
+    "temperature": 0.0,
+    "llm_cache": False,
+    "schema_token_budget": SCHEMA_TOKEN_BUDGET,
+}
+
+if start:
+    os.makedirs("./tmp", exist_ok=True)
+    with open(SOURCE_PATH, "rb") as fp:
+        ingest_chunks(iter_excel_chunks(fp, "xlsx"), DATABASE_PATH, "salary")
+    rows = []
+    progress = st.progress(0.0)
+    total = len(CASES) * repeats
+    for i, messages in enumerate(CASES):
+        for repeat in range(repeats):
+            for name, router in [("two_step", two_step), ("fused", fused)]:
+                rows.append({"case": i, "question": messages[-1]["content"], "router": name, **measure(router, messages)})
+            progress.progress((i * repeats + repeat + 1) / total)
+    df = pd.DataFrame(rows)
+    summary = df.groupby("router")[["seconds", "calls", "estimated_calls", "prompt_tokens", "completion_tokens"]].mean()
+    summary["p95_seconds"] = df.groupby("router")["seconds"].quantile(0.95)
+    st.subheader("Mean per question")
+    st.dataframe(summary)
+    st.subheader("Routing decisions")
+    decisions = df.drop_duplicates(["case", "router"]).pivot(index="question", columns="router", values="result")
+    decisions["agree"] = decisions["fused"].isna() == decisions["two_step"].isna()
+    st.dataframe(decisions)
+    st.subheader("Runs")
+    st.dataframe(df)
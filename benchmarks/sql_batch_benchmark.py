@@ -0,0 +1,112 @@
+"""
+对比逐步生成sql与整个计划批量生成sql的延迟、请求次数和token用量
+
+用法: streamlit run benchmarks/sql_batch_benchmark.py
+"""
+import os
+import sys
+import time
+import pandas as pd
+import streamlit as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import batch_generate_sql, generate_sql
+from utils.chat_utils import token_usage
+from utils.data_utils import validate_sql
+from utils.ingest_utils import iter_excel_chunks, ingest_chunks
+from utils.selection_utils import SCHEMA_TOKEN_BUDGET
+
+DATABASE_PATH = "./tmp/sql_batch_benchmark.sqlite"
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "salary.xlsx")
+REPEATS = 3
+
+# 每个用例为一个计划中全部sql_gen步骤的子问题
+CASES = [
+    {
+        1: "What is the average salary of male employees?",
+        2: "What is the average salary of female employees?",
+        3: "How many employees are there of each gender?",
+    },
+    {
+        1: "What is the average salary in each location?",
+        2: "Which location has the most employees?",
+        3: "What is the average age in each location?",
+        4: "What is the highest salary in each rank?",
+    },
+    {
+        1: "How many employees hold each rank?",
+        2: "What is the average salary of each rank?",
+        3: "What is the average age of each rank?",
+        4: "How many SDE3 employees work in each location?",
+        5: "Who is the oldest employee?",
+    },
+]
+
+
+def individual(questions):
+    """
+    逐步生成, 每个子问题一次请求
+    """
+    return {step: generate_sql(question, DATABASE_PATH) for step, question in questions.items()}
+
+
+def batched(questions):
+    """
+    一次请求生成全部子问题的sql
+    """
+    return batch_generate_sql(questions, DATABASE_PATH)
+
+
+def measure(generator, questions):
+    """
+    运行一次生成, 返回耗时、token用量与能通过编译的sql数量
+    """
+    before = token_usage()
+    start = time.perf_counter()
+    sqls = generator(questions)
+    elapsed = time.perf_counter() - start
+    after = token_usage()
+    return {
+        "seconds": elapsed,
+        **{key: after[key] - before[key] for key in after},
+        "queries": len(questions),
+        "valid": sum(1 for step in questions if sqls.get(step) and not validate_sql(sqls[step], DATABASE_PATH)),
+    }
+
+
+st.title("Batched SQL generation benchmark")
+with st.sidebar:
+    base_url = st.text_input("base_url", "https://api.deepseek.com")
+    api_key = st.text_input("api_key", type="password")
+    model = st.text_input("model", "deepseek-chat")
+    repeats = st.number_input("repeats", 1, 10, REPEATS)
+    start = st.button("Run", disabled=not api_key)
+
+# 关闭响应缓存, 保证两种方式都真正请求了LLM
+st.session_state.settings = {
+    "base_url": base_url,
+    "api_key": api_key,
+    "model": model,
+    "temperature": 0.0,
+    "llm_cache": False,
+    "schema_token_budget": SCHEMA_TOKEN_BUDGET,
+}
+
+if start:
+    os.makedirs("./tmp", exist_ok=True)
+    with open(SOURCE_PATH, "rb") as fp:
+        ingest_chunks(iter_excel_chunks(fp, "xlsx"), DATABASE_PATH, "salary")
+    rows = []
+    progress = st.progress(0.0)
+    total = len(CASES) * repeats
+    for i, questions in enumerate(CASES):
+        for repeat in range(repeats):
+            for name, generator in [("individual", individual), ("batched", batched)]:
+                rows.append({"case": i, "mode": name, **measure(generator, questions)})
+            progress.progress((i * repeats + repeat + 1) / total)
+    df = pd.DataFrame(rows)
+    st.subheader("Mean per plan")
+    st.dataframe(df.groupby("mode")[["seconds", "calls", "prompt_tokens", "completion_tokens", "queries", "valid"]].mean())
+    st.subheader("Runs")
+    st.dataframe(df)
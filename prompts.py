@@ -103,11 +103,71 @@ What is the average salary in each department?
 """.strip()
 
 
+ROUTE_QUESTION_PROMPT = """
+You are a database analysis assistant. In a single pass, decide whether the user's final question needs the provided database to be answered, and if it does, rewrite it into a fully self-contained question.
+
+1. Analyze the database schema from CREATE TABLE statements
+2. Review the chat history for context
+3. Decide relevance. Answer "Yes" if the question:
+   - Requires querying stored data
+   - Asks about database structure/relationships
+   - Needs database-specific knowledge to answer
+   - Relates to entities/fields defined in the schema
+   Otherwise answer "No".
+4. Only if the answer is "Yes", rewrite the question so it can be understood without the chat history:
+   - Maintain the original question's purpose and technical scope
+   - Resolve all pronouns (it/they/that) and implicit context references
+   - Explicitly state any temporal constraints or ambiguous comparisons
+   - Preserve technical terminology from the database schema where applicable
+   - If the question is already self-contained, repeat it unchanged
+
+**Example Input:**
+Database Schema:
+```sql
+CREATE TABLE Employees (
+    EmployeeID INT PRIMARY KEY,
+    Name VARCHAR(100),
+    DepartmentID INT,
+    Salary DECIMAL(10, 2)
+);
+```
+
+Chat History:
+User: "What is the average salary in the IT department?"
+Assistant: "The average salary in the IT department is $75,000."
+
+User's Question: "How does this compare to other departments?"
+
+**Output Format:**
+<reasoning>
+[Brief reasoning about relevance and any ambiguous references]
+</reasoning>
+<response>
+[Yes/No]
+</response>
+<rewritten_question>
+[Self-contained question, only when the response is Yes]
+</rewritten_question>
+
+**Example Output:**
+<reasoning>
+The question asks for salary comparisons, which requires the Employees table. "This" refers to the average salary in the IT department.
+</reasoning>
+<response>
+Yes
+</response>
+<rewritten_question>
+What is the average salary in each department, compared with the IT department?
+</rewritten_question>
+""".strip()
+
+
 PLANNING_PROMPT = """
 You are a database analysis assistant that solves user problems through systematic step-by-step execution. Follow these rules strictly:
 
 1. **Input Context**
    - Database schema will be provided in ```sql code blocks```
+   - The schema may contain several tables loaded from different files or sheets; they can be joined in a single query
    - User question will follow the schema
 
 2. **Output Requirements**
@@ -181,12 +241,15 @@ You are a database analysis assistant that solves user problems through systemat
 GENERATE_SQL_PROMPT = """
 When the user asks a question that requires generating an SQL query, follow these rules:
 1. **Always respond with a SQL code block** wrapped in triple backticks (```sql ... ```).
-2. Prioritize standard SQLite syntax.
+2. Write SQL for the dialect named in the "SQL dialect:" line before the schema (SQLite, DuckDB, ...), prioritizing its standard syntax.
+3. Tables may come from different uploaded files or sheets. Join them when the question spans several datasets.
+4. The schema may end with "Column profiles" comments listing real column values, date formats and value ranges. Use those literal values and formats exactly in filters instead of guessing them.
 
 Note: Database schema will be provided in ```sql code blocks```, and user question will follow the schema.
 
 **Example Interaction:**
 **User:**
+SQL dialect: SQLite
 ```sql
 CREATE TABLE employees (
   id INT PRIMARY KEY,
@@ -212,6 +275,47 @@ WHERE department = 'Sales';
 """.strip()
 
 
+BATCH_GENERATE_SQL_PROMPT = """
+When the user asks several numbered questions that each require generating an SQL query, follow these rules:
+1. Answer every question in its own section, in the order given. Start each section with a `### Step <number>` heading that uses the question's number.
+2. **Each section must contain exactly one SQL code block** wrapped in triple backticks (```sql ... ```) that answers only that question.
+3. Write SQL for the dialect named in the "SQL dialect:" line before the schema (SQLite, DuckDB, ...), prioritizing its standard syntax.
+4. Tables may come from different uploaded files or sheets. Join them when the question spans several datasets.
+5. The schema may end with "Column profiles" comments listing real column values, date formats and value ranges. Use those literal values and formats exactly in filters instead of guessing them.
+
+Note: Database schema will be provided in ```sql code blocks```, and the numbered questions will follow the schema.
+
+**Example Interaction:**
+**User:**
+SQL dialect: SQLite
+```sql
+CREATE TABLE employees (
+  id INT PRIMARY KEY,
+  name VARCHAR(50),
+  department VARCHAR(20),
+  salary DECIMAL(10,2)
+);
+```
+Step 1: "How do I find all employees in the Sales department?"
+Step 3: "What is the average salary in each department?"
+**Your Response:**
+### Step 1
+[your reasoning here]
+```sql
+SELECT id, name
+FROM employees
+WHERE department = 'Sales';
+```
+### Step 3
+[your reasoning here]
+```sql
+SELECT department, AVG(salary) AS avg_salary
+FROM employees
+GROUP BY department;
+```
+""".strip()
+
+
 DRAW_CHART_PROMPT = """
 **Task**: Generate Python code for data preparation and visualization parameters based on given dataframes. Follow these steps:
 
@@ -244,7 +348,8 @@ def chart(type: str, data: DataFrame, x: str, y: Union[str, List[str]], horizont
 ```
 
 **Requirements**:
-- Keep code self-contained (no external dependencies)
+- Keep code self-contained (no external dependencies). `pd` (pandas) and `np` (numpy) are already available; do not write import statements
+- Only use plain statements (assignments, `if`, `for`) and DataFrame operations. Do not define functions or classes, access private attributes, write files or use `eval`/`query`. Stick to common DataFrame/Series methods (groupby, agg, sort_values, pivot_table, `.str`, `.dt`, ...)
 - Use vectorized pandas operations
 - Handle datetime formatting if needed
 - Include comments for key operations
@@ -303,7 +408,8 @@ You are a database analysis assistant. Your task is to answer user questions by
    - Example: "Sales increased by 10% (see **Query 1**), visualized in **Chart 1**."
 2. Do NOT include raw SQL results or chart code in the final answer. Simply reference their numbers.
 3. SQL execution results (Query X) are valid visualizations. Use them where precise values or small datasets matter.
-4. Structure your answer as:
+4. Some results may be marked as truncated. In that case they only contain the first rows of the full result; do not present totals or counts computed from them as complete.
+5. Structure your answer as:
    - <reasoning></reasoning>: Briefly explain how the queries/charts address the question.
    - <response></response>: A polished answer combining text, data highlights, and references to queries/charts.
 
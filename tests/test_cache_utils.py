@@ -0,0 +1,46 @@
+import os
+import pandas as pd
+from utils.cache_utils import LRUCache, ResultCache
+
+
+def test_lru_size():
+    cache = LRUCache(4)
+    cache.put("a", 1, 10)
+    assert cache.size("a") == 10
+    assert cache.size("b") == 0
+    assert cache.stats()["hits"] == 0
+
+
+def test_spilled_results_survive_restart(tmp_path):
+    df = pd.DataFrame({"x": range(10000)})
+    df.attrs["truncated"] = False
+    cache = ResultCache(str(tmp_path), 2 ** 20, 2 ** 30, 1)
+    cache.put("db.sqlite", (1, 2), "SELECT x FROM t", 100, df)
+    assert cache.stats()["disk_entries"] == 1
+    restarted = ResultCache(str(tmp_path), 2 ** 20, 2 ** 30, 1)
+    assert restarted.stats()["disk_entries"] == 1
+    cached = restarted.get("db.sqlite", (1, 2), "SELECT x FROM t", 100)
+    assert cached is not None and cached.equals(df)
+    assert cached.attrs["truncated"] is False
+
+
+def test_restart_drops_stale_and_orphaned_files(tmp_path):
+    df = pd.DataFrame({"x": range(10000)})
+    cache = ResultCache(str(tmp_path), 2 ** 20, 2 ** 30, 1)
+    cache.put("db.sqlite", (1, 2), "SELECT x FROM t", 100, df)
+    (tmp_path / "orphan.parquet").write_bytes(b"data")
+    restarted = ResultCache(str(tmp_path), 2 ** 20, 2 ** 30, 1)
+    assert not (tmp_path / "orphan.parquet").exists()
+    assert restarted.get("db.sqlite", (3, 4), "SELECT x FROM t", 100) is None
+    assert restarted.stats()["disk_entries"] == 0
+    assert os.listdir(tmp_path) == []
+
+
+def test_restart_respects_disk_budget(tmp_path):
+    cache = ResultCache(str(tmp_path), 2 ** 20, 2 ** 30, 1)
+    for i in range(3):
+        cache.put("db.sqlite", (1, 2), f"SELECT {i}", 100, pd.DataFrame({"x": range(10000)}))
+    size = max(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path) if name.endswith(".parquet"))
+    restarted = ResultCache(str(tmp_path), 2 ** 20, size, 1)
+    assert restarted.stats()["disk_entries"] == 1
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".parquet")]) == 1
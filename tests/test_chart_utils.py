@@ -0,0 +1,42 @@
+import os
+import pandas as pd
+import pytest
+from utils.chart_utils import ChartCodeError, run_chart_code, validate_chart_code
+
+DFS = [pd.DataFrame({"dept": ["a", "b", "a"], "salary": [1.0, 2.0, 5.0]})]
+
+
+@pytest.mark.parametrize("method", ["to_string", "to_csv", "to_html", "to_json", "tofile", "dump"])
+def test_rejects_writers_with_path(tmp_path, method):
+    path = tmp_path / "out.txt"
+    code = f"df1.{method}({str(path)!r})\nchart('bar', df1, 'dept', 'salary')"
+    with pytest.raises(ChartCodeError):
+        validate_chart_code(code)
+    with pytest.raises(ChartCodeError):
+        run_chart_code(code, DFS)
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize("code", [
+    "import os\nchart('bar', df1, 'dept', 'salary')",
+    "x = df1.__class__\nchart('bar', df1, 'dept', 'salary')",
+    "x = pd.read_csv('/etc/passwd')\nchart('bar', df1, 'dept', 'salary')",
+    "x = getattr(df1, 'to_csv')\nchart('bar', df1, 'dept', 'salary')",
+    "df1.query('salary > 1')\nchart('bar', df1, 'dept', 'salary')",
+])
+def test_rejects_unsafe_code(code):
+    with pytest.raises(ChartCodeError):
+        validate_chart_code(code)
+
+
+def test_unbounded_loop_times_out():
+    code = "n = 0\nfor _ in range(10 ** 12):\n    n += 1\nchart('bar', df1, 'dept', 'salary')"
+    with pytest.raises(ChartCodeError, match="did not finish"):
+        run_chart_code(code, DFS, timeout=2.0)
+
+
+def test_runs_chart_code():
+    code = "data = df1.groupby('dept', as_index=False)['salary'].mean().sort_values('salary')\nchart('bar', data, 'dept', 'salary')"
+    specs = run_chart_code(code, DFS)
+    assert len(specs) == 1
+    assert specs[0].data.to_dict("list") == {"dept": ["b", "a"], "salary": [2.0, 3.0]}
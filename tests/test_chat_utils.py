@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+import streamlit as st
+from utils import chat_utils
+from utils.cache_utils import ResponseCache
+
+
+class FakeStream:
+    """
+    模拟流式响应: 逐段返回内容, 最后一个数据块携带用量
+    """
+
+    def __init__(self, tokens, usage):
+        self.chunks = [SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=token))]) for token in tokens]
+        self.chunks.append(SimpleNamespace(usage=usage, choices=[]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+def setup_client(monkeypatch, tokens):
+    usage = SimpleNamespace(prompt_tokens=100, completion_tokens=len(tokens))
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: FakeStream(tokens, usage))))
+    monkeypatch.setattr(chat_utils, "get_client", lambda base_url, api_key: client)
+    st.session_state.settings = {"base_url": "http://localhost", "api_key": "", "model": "test", "temperature": 0.0, "llm_cache": False}
+
+
+def test_usage_from_final_chunk(monkeypatch):
+    setup_client(monkeypatch, ["<response>", "yes", "</response>"])
+    before = chat_utils.token_usage()
+    assert chat_utils.chat([{"role": "user", "content": "question"}]) == "<response>yes</response>"
+    after = chat_utils.token_usage()
+    assert after["prompt_tokens"] - before["prompt_tokens"] == 100
+    assert after["completion_tokens"] - before["completion_tokens"] == 3
+    assert after["estimated_calls"] == before["estimated_calls"]
+
+
+def test_usage_estimated_on_early_stop(monkeypatch):
+    setup_client(monkeypatch, ["<response>", "yes", "</response>", " and a long explanation"])
+    before = chat_utils.token_usage()
+    response = chat_utils.chat([{"role": "user", "content": "question"}], lambda token: token == "</response>")
+    after = chat_utils.token_usage()
+    assert response == "<response>yes</response>"
+    assert after["calls"] - before["calls"] == 1
+    assert after["estimated_calls"] - before["estimated_calls"] == 1
+    assert after["prompt_tokens"] > before["prompt_tokens"]
+    assert after["completion_tokens"] > before["completion_tokens"]
+
+
+def setup_async_client(monkeypatch, response, calls):
+    async def create(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=response))],
+                               usage=SimpleNamespace(prompt_tokens=50, completion_tokens=7))
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(chat_utils, "get_async_client", lambda base_url, api_key: client)
+
+
+def test_achat_counts_usage_in_calling_thread(monkeypatch):
+    calls = []
+    setup_async_client(monkeypatch, "answer", calls)
+    settings = {"base_url": "http://localhost", "api_key": "", "model": "test", "temperature": 0.0, "llm_cache": False}
+    before = chat_utils.token_usage()
+    assert chat_utils.run_async(chat_utils.achat([{"role": "user", "content": "question"}], settings)) == "answer"
+    after = chat_utils.token_usage()
+    assert after["calls"] - before["calls"] == 1
+    assert after["prompt_tokens"] - before["prompt_tokens"] == 50
+    assert after["completion_tokens"] - before["completion_tokens"] == 7
+
+
+def test_achat_uses_response_cache(monkeypatch, tmp_path):
+    calls = []
+    setup_async_client(monkeypatch, "answer", calls)
+    monkeypatch.setattr(chat_utils, "_response_cache", ResponseCache(str(tmp_path / "cache.sqlite"), 16, 3600))
+    settings = {"base_url": "http://localhost", "api_key": "", "model": "test", "temperature": 0.0, "llm_cache": True}
+    messages = [{"role": "user", "content": "question"}]
+    assert chat_utils.run_async(chat_utils.achat(messages, settings)) == "answer"
+    assert chat_utils.run_async(chat_utils.achat(messages, settings)) == "answer"
+    assert len(calls) == 1
+
+
+def test_response_cache_scoped_by_workspace(monkeypatch, tmp_path):
+    calls = []
+    setup_async_client(monkeypatch, "answer", calls)
+    monkeypatch.setattr(chat_utils, "_response_cache", ResponseCache(str(tmp_path / "cache.sqlite"), 16, 3600))
+    settings = {"base_url": "http://localhost", "api_key": "", "model": "test", "temperature": 0.0, "llm_cache": True}
+    messages = [{"role": "user", "content": "question"}]
+    chat_utils.run_async(chat_utils.achat(messages, settings, "workspace-a"))
+    chat_utils.run_async(chat_utils.achat(messages, settings, "workspace-b"))
+    chat_utils.run_async(chat_utils.achat(messages, settings, "workspace-a"))
+    assert len(calls) == 2
@@ -0,0 +1,59 @@
+import sqlite3
+import threading
+import time
+from utils import data_utils
+from utils.upload_utils import IngestStore
+
+
+class Upload:
+    def __init__(self, path, name):
+        self.name = name
+        self._fp = open(path, "rb")
+
+    def tell(self):
+        return self._fp.tell()
+
+    def seek(self, position):
+        return self._fp.seek(position)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+
+def make_database(path, table):
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE {table} (x INTEGER);")
+    conn.commit()
+    conn.close()
+
+
+def test_opposite_upload_orders_do_not_deadlock(tmp_path, monkeypatch):
+    store = IngestStore(str(tmp_path / "store"), 2 ** 30, 3600)
+    monkeypatch.setattr(data_utils, "get_ingest_store", lambda: store)
+    write_upload = data_utils.write_upload
+
+    def slow_write_upload(file, path):
+        time.sleep(0.2)
+        write_upload(file, path)
+
+    monkeypatch.setattr(data_utils, "write_upload", slow_write_upload)
+    for name in ("a", "b"):
+        make_database(str(tmp_path / f"{name}.sqlite"), name)
+    uploads = {name: (str(tmp_path / f"{name}.sqlite"), name * 64) for name in ("a", "b")}
+    errors = []
+
+    def ingest(order):
+        try:
+            data_utils.ingest_uploads([(Upload(uploads[name][0], f"{name}.sqlite"), uploads[name][1], "sqlite") for name in order])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ingest, args=(order,), daemon=True) for order in (["a", "b"], ["b", "a"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert errors == []
+    for name in ("a", "b"):
+        assert store.read_manifest(store.part_dir(name * 64)) == {"ext": "sqlite", "sheets": []}
@@ -0,0 +1,49 @@
+import sqlite3
+import pytest
+from utils.guard_utils import QueryRejected, check_query_plan
+from utils.str_utils import table_aliases
+
+ROW_LIMIT = 10 ** 6
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE big (a INTEGER, b TEXT);")
+    conn.execute("CREATE TABLE small (a INTEGER);")
+    conn.executemany("INSERT INTO big VALUES (?, ?);", [(i, str(i)) for i in range(20000)])
+    conn.executemany("INSERT INTO small VALUES (?);", [(i,) for i in range(10)])
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM big x, big y",
+    "SELECT * FROM big a CROSS JOIN big b",
+    "SELECT * FROM big a JOIN big b ON 1=1",
+    "SELECT * FROM big, big AS y",
+    'SELECT * FROM "big" AS "x", big y',
+    "SELECT * FROM (SELECT * FROM big) s, big t",
+    "WITH c AS (SELECT * FROM big) SELECT * FROM c, c d",
+])
+def test_rejects_cartesian_products(conn, query):
+    with pytest.raises(QueryRejected):
+        check_query_plan(conn, query, ROW_LIMIT)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM big x JOIN big y ON x.a = y.a",
+    "SELECT * FROM big x, small y",
+    "SELECT COUNT(*) FROM big",
+    "SELECT 1",
+])
+def test_allows_joined_or_small_queries(conn, query):
+    check_query_plan(conn, query, ROW_LIMIT)
+
+
+def test_table_aliases():
+    assert table_aliases("SELECT * FROM big x, big AS y JOIN small z ON x.a = z.a") == \
+        {"big": "big", "x": "big", "y": "big", "small": "small", "z": "small"}
+    assert table_aliases('SELECT * FROM main."My Table" t LEFT OUTER JOIN other USING (a)') == \
+        {"my table": "My Table", "t": "My Table", "other": "other"}
+    assert "s" not in table_aliases("SELECT * FROM (SELECT * FROM big) s")
@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import pytest
+from utils import index_utils
+from utils.engine_utils import SQLiteEngine
+from utils.schema_utils import database_fingerprint
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "workspace.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE employees (id INTEGER, department TEXT, salary REAL);")
+    conn.executemany("INSERT INTO employees VALUES (?, ?, ?);", [(i, f"d{i % 50}", i * 1.5) for i in range(5000)])
+    conn.commit()
+    conn.close()
+    yield path
+    index_utils.drop_advisor(path)
+
+
+def auto_indexes(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'auto_idx_%';")]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT salary FROM employees WHERE department = 'd7';",
+    "SELECT e.salary FROM employees AS e WHERE e.department = 'd7';",
+    "SELECT e.salary FROM employees e WHERE e.department = 'd7';",
+])
+def test_indexes_built_in_copy(database, sql):
+    fingerprint = database_fingerprint(database)
+    advisor = index_utils.IndexAdvisor(database)
+    advisor.budget = 2 ** 30
+    for _ in range(index_utils.HOT_QUERY_THRESHOLD):
+        advisor.record(sql).result()
+    assert database_fingerprint(database) == fingerprint
+    assert auto_indexes(database) == []
+    assert index_utils.serving_path(database) == index_utils.indexed_path(database)
+    assert auto_indexes(index_utils.indexed_path(database)) == [index_utils.index_name("employees", ("department", "salary"))]
+    assert [row["columns"] for row in advisor.report()] == ["department, salary"]
+    advisor.close()
+
+
+def test_engine_queries_copy(database):
+    advisor = index_utils.get_advisor(database)
+    advisor.budget = 2 ** 30
+    for _ in range(index_utils.HOT_QUERY_THRESHOLD):
+        advisor.record("SELECT salary FROM employees WHERE department = 'd7';").result()
+    df = SQLiteEngine(database).execute("SELECT COUNT(*) AS n FROM employees WHERE department = 'd7';")
+    assert df["n"].tolist() == [100]
+
+
+def test_drop_advisor_removes_copy(database):
+    advisor = index_utils.get_advisor(database)
+    advisor.budget = 2 ** 30
+    for _ in range(index_utils.HOT_QUERY_THRESHOLD):
+        advisor.record("SELECT salary FROM employees WHERE department = 'd7';").result()
+    assert os.path.exists(index_utils.indexed_path(database))
+    index_utils.drop_advisor(database)
+    assert not os.path.exists(index_utils.indexed_path(database))
+    assert index_utils.serving_path(database) == database
+
+
+def test_later_indexes_reuse_copy(database):
+    advisor = index_utils.IndexAdvisor(database)
+    advisor.budget = 2 ** 30
+    for sql in ["SELECT salary FROM employees WHERE department = 'd7';", "SELECT department FROM employees WHERE id = 7;"]:
+        for _ in range(index_utils.HOT_QUERY_THRESHOLD):
+            advisor.record(sql).result()
+        if sql.startswith("SELECT salary"):
+            inode = os.stat(index_utils.indexed_path(database)).st_ino
+    assert os.stat(index_utils.indexed_path(database)).st_ino == inode
+    assert len(auto_indexes(index_utils.indexed_path(database))) == 2
+    advisor.close()
+
+
+def test_budget_counts_copy(database):
+    advisor = index_utils.IndexAdvisor(database)
+    advisor.budget = advisor.size
+    for _ in range(index_utils.HOT_QUERY_THRESHOLD):
+        advisor.record("SELECT salary FROM employees WHERE department = 'd7';").result()
+    assert not os.path.exists(index_utils.indexed_path(database))
+    assert advisor.used == 0
+    advisor.close()
+
+
+def test_failed_build_releases_budget(database, monkeypatch):
+    advisor = index_utils.IndexAdvisor(database)
+    advisor.budget = 2 ** 30
+
+    def fail(indexes):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(advisor, "_create_indexes", fail)
+    for _ in range(index_utils.HOT_QUERY_THRESHOLD):
+        advisor.record("SELECT salary FROM employees WHERE department = 'd7';").result()
+    assert advisor.used == 0
+    advisor.close()
@@ -0,0 +1,52 @@
+import sqlite3
+from utils.ingest_utils import merge_database
+from utils.schema_utils import read_schema
+
+
+def make_part(path):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE sales (id INTEGER, region TEXT, amount REAL);
+        INSERT INTO sales VALUES (1, 'north', 10.0), (2, 'south', 20.0), (3, 'north', 5.0);
+        CREATE UNIQUE INDEX sales_id ON sales (id);
+        CREATE INDEX IF NOT EXISTS "sales region" ON sales (region) WHERE amount > 0;
+        CREATE VIEW north_sales AS SELECT s.id, sales.amount FROM sales s JOIN sales ON sales.id = s.id WHERE s.region = 'north';
+        CREATE VIEW north_total AS SELECT SUM(amount) AS total FROM north_sales;
+    """)
+    conn.close()
+
+
+def test_merge_copies_indexes_and_views(tmp_path):
+    part = str(tmp_path / "part.sqlite")
+    make_part(part)
+    conn = sqlite3.connect(str(tmp_path / "workspace.sqlite"))
+    conn.execute("CREATE TABLE sales (x INTEGER);")
+    conn.execute("CREATE VIEW north_sales AS SELECT x FROM sales;")
+    assert merge_database(conn, part, "upload") == ["upload_sales"]
+    indexes = {name: table for name, table in conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type='index';")}
+    assert indexes == {"sales_id": "upload_sales", "sales region": "upload_sales"}
+    plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN SELECT amount FROM upload_sales WHERE id = 2;"))
+    assert "sales_id" in plan
+    assert conn.execute("SELECT id, amount FROM upload_north_sales ORDER BY id;").fetchall() == [(1, 10.0), (3, 5.0)]
+    assert conn.execute("SELECT total FROM north_total;").fetchall() == [(15.0,)]
+    assert conn.execute("SELECT x FROM north_sales;").fetchall() == []
+    schema = read_schema(conn, "workspace.sqlite", (0, 0))
+    assert {"upload_north_sales", "north_total"} <= {table.name for table in schema.tables}
+    conn.close()
+
+
+def test_merge_skips_broken_views(tmp_path):
+    part = str(tmp_path / "part.sqlite")
+    conn = sqlite3.connect(part)
+    conn.executescript("""
+        CREATE TABLE t (x INTEGER);
+        CREATE VIEW v AS SELECT x FROM t;
+        PRAGMA writable_schema = ON;
+    """)
+    conn.execute("UPDATE sqlite_master SET sql = 'CREATE VIEW v AS SELECT y FROM missing' WHERE name = 'v';")
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(str(tmp_path / "workspace.sqlite"))
+    assert merge_database(conn, part, "upload") == ["t"]
+    assert conn.execute("SELECT name FROM sqlite_master WHERE type='view';").fetchall() == []
+    conn.close()
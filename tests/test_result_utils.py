@@ -0,0 +1,36 @@
+import sqlite3
+import numpy as np
+import pytest
+from utils import result_utils
+from utils.result_utils import fetch_dataframe
+
+ROWS = [(0, 0), (1, 1), (2, 2), (3, 3), (None, 5), (None, "mixed")]
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (a, b);")
+    conn.executemany("INSERT INTO t VALUES (?, ?);", ROWS)
+    cursor = conn.execute("SELECT a, b FROM t ORDER BY rowid;")
+    yield cursor
+    conn.close()
+
+
+@pytest.mark.parametrize("arrow", [True, False])
+def test_null_batch_after_integers(cursor, monkeypatch, arrow):
+    if not arrow:
+        monkeypatch.setattr(result_utils, "pa", None)
+    elif result_utils.pa is None:
+        pytest.skip("pyarrow is not installed")
+    df = fetch_dataframe(cursor, batch_size=2)
+    assert df["a"].tolist()[:4] == [0, 1, 2, 3]
+    assert np.isnan(df["a"].iloc[4]) and np.isnan(df["a"].iloc[5])
+    assert df["b"].tolist() == [0, 1, 2, 3, 5, "mixed"]
+    assert not df.attrs["truncated"]
+
+
+def test_truncates(cursor):
+    df = fetch_dataframe(cursor, max_rows=4, batch_size=2)
+    assert len(df) == 4
+    assert df.attrs["truncated"]
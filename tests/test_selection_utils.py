@@ -0,0 +1,31 @@
+import sqlite3
+from utils.selection_utils import select_create_statements
+from utils.trace_utils import span, start_trace
+
+
+def make_database(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE orders (id INTEGER, amount REAL);")
+    conn.execute("CREATE TABLE customers (id INTEGER, name TEXT);")
+    conn.commit()
+    conn.close()
+
+
+def test_included_tables_recorded_when_schema_fits(tmp_path):
+    path = str(tmp_path / "db.sqlite")
+    make_database(path)
+    with start_trace("question"):
+        with span("schema") as schema_span:
+            select_create_statements(path, "total amount of orders", 4000)
+    assert schema_span.attributes["schema_tables"] == ["orders", "customers"]
+    assert schema_span.attributes["schema_omitted"] == 0
+
+
+def test_included_tables_recorded_when_pruned(tmp_path):
+    path = str(tmp_path / "db.sqlite")
+    make_database(path)
+    with start_trace("question"):
+        with span("schema") as schema_span:
+            select_create_statements(path, "total amount of orders", 20)
+    assert schema_span.attributes["schema_tables"] == ["orders"]
+    assert schema_span.attributes["schema_omitted"] == 1
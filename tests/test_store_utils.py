@@ -0,0 +1,47 @@
+import os
+import time
+import pandas as pd
+from utils.store_utils import ResultStore, SWEEP_INTERVAL
+
+
+def make_store(root, ttl=3600):
+    return ResultStore(str(root), 2 ** 30, 2 ** 30, 2 ** 20, session_ttl=ttl)
+
+
+def test_init_keeps_existing_results(tmp_path):
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "result.parquet").write_bytes(b"data")
+    make_store(tmp_path)
+    assert (tmp_path / "other" / "result.parquet").exists()
+
+
+def test_sweep_drops_idle_sessions(tmp_path):
+    store = make_store(tmp_path)
+    df = pd.DataFrame({"x": range(1000)})
+    idle = store.put("idle", df)
+    now = time.time() + 2 * SWEEP_INTERVAL
+    store._touched["idle"] = now - 7200
+    active = store.put("active", df)
+    store._swept = 0.0
+    assert store.sweep(now) == ["idle"]
+    assert store.load(idle) is None
+    assert not (tmp_path / "idle").exists()
+    assert store.load(active) is not None
+    assert store.stats()["entries"] == 1
+
+
+def test_sweep_removes_stale_untracked_dirs(tmp_path):
+    store = make_store(tmp_path)
+    for name in ("stale", "fresh"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "result.pkl").write_bytes(b"data")
+    os.utime(tmp_path / "stale", (time.time() - 7200, time.time() - 7200))
+    assert store.sweep() == ["stale"]
+    assert not (tmp_path / "stale").exists()
+    assert (tmp_path / "fresh" / "result.pkl").exists()
+
+
+def test_sweep_is_rate_limited(tmp_path):
+    store = make_store(tmp_path, ttl=0)
+    store.touch("a")
+    assert store.sweep() == []
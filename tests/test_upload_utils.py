@@ -0,0 +1,59 @@
+import os
+import pytest
+from utils.upload_utils import IngestStore
+
+
+def make_entry(path):
+    os.makedirs(path)
+    with open(os.path.join(path, "manifest.json"), "w") as fp:
+        fp.write("{}")
+
+
+def test_cleanup_skips_leased_parts(tmp_path):
+    store = IngestStore(str(tmp_path), 0, 3600)
+    held, free = store.part_dir("a" * 64), store.part_dir("b" * 64)
+    make_entry(held)
+    make_entry(free)
+    with store.lease([held]):
+        store.cleanup()
+        assert os.path.exists(held)
+        assert not os.path.exists(free)
+    store.cleanup()
+    assert not os.path.exists(held)
+
+
+def test_cleanup_skips_derived_entries_of_leased_workspace(tmp_path):
+    store = IngestStore(str(tmp_path), 0, 3600)
+    workspace = store.workspace_path("c" * 64)
+    os.makedirs(os.path.dirname(workspace))
+    open(workspace, "wb").close()
+    make_entry(workspace + ".parquet")
+    with store.lease([workspace]):
+        store.cleanup()
+    assert os.path.exists(workspace)
+    assert os.path.exists(workspace + ".parquet")
+
+
+def test_nested_leases(tmp_path):
+    store = IngestStore(str(tmp_path), 0, 3600)
+    part = store.part_dir("d" * 64)
+    make_entry(part)
+    with store.lease([part]):
+        with store.lease([part]):
+            pass
+        store.cleanup()
+        assert os.path.exists(part)
+
+
+def test_stats_tracked_without_walking(tmp_path, monkeypatch):
+    store = IngestStore(str(tmp_path), 2 ** 30, 3600)
+    assert store.stats()["parts"] == 0
+    monkeypatch.setattr(store, "entries", lambda: pytest.fail("stats walked the store"))
+    with store.build(store.part_dir("e" * 64)) as temp_dir:
+        make_entry(temp_dir)
+    stats = store.stats()
+    assert stats["parts"] == 1 and stats["bytes"] == 2
+    monkeypatch.undo()
+    store.quota_bytes = 0
+    store.cleanup()
+    assert store.stats()["parts"] == 0
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+class LRUCache:
+    """
+    线程安全的LRU缓存, 可同时限制条目数与总字节数
+    """
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._on_evict = on_evict
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        读取缓存并标记为最近使用
+        """
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any, size: int = 0) -> None:
+        """
+        写入缓存, 超出容量时淘汰最久未使用的条目
+        """
+        evicted = []
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._sizes.pop(key)
+                del self._data[key]
+            self._data[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes and len(self._data) > 1):
+                old_key, old_value = self._data.popitem(last=False)
+                self.bytes -= self._sizes.pop(old_key)
+                evicted.append((old_key, old_value))
+        for old_key, old_value in evicted:
+            if self._on_evict:
+                self._on_evict(old_key, old_value)
+
+    def size(self, key: Hashable) -> int:
+        """
+        条目写入时记录的字节数, 不存在时为0; 不影响命中统计与使用顺序
+        """
+        with self._lock:
+            return self._sizes.get(key, 0)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """
+        删除缓存条目
+        """
+        with self._lock:
+            if key not in self._data:
+                return None
+            self.bytes -= self._sizes.pop(key)
+            value = self._data.pop(key)
+        if self._on_evict:
+            self._on_evict(key, value)
+        return value
+
+    def pop_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        删除所有键满足条件的条目, 返回删除数量
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+        for key in keys:
+            self.pop(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        """
+        清空缓存
+        """
+        self.pop_where(lambda key: True)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        命中统计
+        """
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class ResponseCache:
+    """
+    LLM响应缓存, 内存LRU + SQLite持久化两级, 持久化条目超过ttl秒后失效
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._memory = LRUCache(max_entries)
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**request: Any) -> str:
+        """
+        根据请求参数计算缓存键
+        """
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        打开持久化缓存, 首次打开时建表并清理过期条目
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        with self._lock:
+            if not self._initialized:
+                conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL);")
+                conn.execute("DELETE FROM llm_cache WHERE created < ?;", (time.time() - self.ttl,))
+                conn.commit()
+                self._initialized = True
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        依次查询内存与持久化缓存
+        """
+        entry = self._memory.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        if not os.path.isdir(os.path.dirname(self.path) or "."):
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT response, created FROM llm_cache WHERE key = ?;", (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None or time.time() - row[1] >= self.ttl:
+            return None
+        self._memory.put(key, row)
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """
+        同时写入内存与持久化缓存
+        """
+        entry = (response, time.time())
+        self._memory.put(key, entry)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key, response, created) VALUES (?, ?, ?);", (key, *entry))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class ResultCache:
+    """
+    查询结果缓存, 键为 (数据库路径, 文件指纹, 规范化SQL, 行数上限)
+
+    小结果以DataFrame保存在内存LRU中, 大结果以Parquet文件溢出到磁盘, 两级分别受字节预算限制;
+    数据库文件指纹变化时, 该数据库的旧结果全部失效.
+    每个溢出文件旁有一个记录缓存键的JSON文件, 创建时据此重建磁盘索引, 重启后溢出文件仍可命中并受预算约束
+    """
+
+    def __init__(self, spill_dir: str, max_memory_bytes: int, max_disk_bytes: int, spill_threshold: int):
+        self.spill_dir = spill_dir
+        self.spill_threshold = spill_threshold
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._memory = LRUCache(4096, max_memory_bytes)
+        self._disk = LRUCache(4096, max_disk_bytes, on_evict=lambda key, entry: self._remove(entry[0]))
+        self._fingerprints: Dict[str, Hashable] = {}
+        self._lock = threading.Lock()
+        self._load_index()
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        """
+        删除溢出文件及其索引
+        """
+        for path_ in (path, os.path.splitext(path)[0] + ".json"):
+            try:
+                os.remove(path_)
+            except OSError:
+                pass
+
+    def _load_index(self) -> None:
+        """
+        从溢出目录重建磁盘索引: 按修改时间从旧到新加入LRU, 超出预算的旧文件随之淘汰; 缺少索引或数据的文件直接删除
+        """
+        if pa is None or not os.path.isdir(self.spill_dir):
+            return
+        stems = {os.path.splitext(name)[0] for name in os.listdir(self.spill_dir) if os.path.splitext(name)[1] in (".parquet", ".json")}
+        entries = []
+        for stem in stems:
+            path = os.path.join(self.spill_dir, stem + ".parquet")
+            try:
+                with open(os.path.join(self.spill_dir, stem + ".json"), encoding="utf-8") as fp:
+                    meta = json.load(fp)
+                entries.append((os.path.getmtime(path), path, meta))
+            except (OSError, ValueError):
+                self._remove(path)
+        for _, path, meta in sorted(entries, key=lambda entry: entry[0]):
+            fingerprint = tuple(meta["fingerprint"]) if isinstance(meta["fingerprint"], list) else meta["fingerprint"]
+            self._fingerprints[meta["database_path"]] = fingerprint
+            self._disk.put((meta["database_path"], fingerprint, meta["sql"], meta["max_rows"]),
+                           (path, meta["attrs"], meta["size"]), os.path.getsize(path))
+
+    def _check_fingerprint(self, database_path: str, fingerprint: Hashable) -> None:
+        """
+        数据库文件变化后清除其所有缓存结果
+        """
+        with self._lock:
+            previous = self._fingerprints.get(database_path)
+            self._fingerprints[database_path] = fingerprint
+        if previous is not None and previous != fingerprint:
+            self._memory.pop_where(lambda key: key[0] == database_path)
+            self._disk.pop_where(lambda key: key[0] == database_path)
+
+    def get(self, database_path: str, fingerprint: Hashable, sql: str, max_rows: int) -> Optional[pd.DataFrame]:
+        """
+        查询缓存, 命中时返回结果的副本
+        """
+        database_path = os.path.abspath(database_path)
+        self._check_fingerprint(database_path, fingerprint)
+        key = (database_path, fingerprint, sql, max_rows)
+        df = None
+        entry = self._memory.get(key)
+        if entry is not None:
+            df = entry.copy()
+            size = self._memory.size(key)
+        else:
+            entry = self._disk.get(key)
+            if entry is not None:
+                path, attrs, size = entry
+                try:
+                    df = pd.read_parquet(path)
+                    df.attrs.update(attrs)
+                except (OSError, ValueError):
+                    self._disk.pop(key)
+        with self._lock:
+            if df is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += size
+        return df
+
+    def put(self, database_path: str, fingerprint: Hashable, sql: str, max_rows: int, df: pd.DataFrame) -> None:
+        """
+        写入缓存, 超过溢出阈值的结果写为Parquet文件
+        """
+        database_path = os.path.abspath(database_path)
+        key = (database_path, fingerprint, sql, max_rows)
+        size = int(df.memory_usage(deep=True).sum())
+        if size < self.spill_threshold:
+            self._memory.put(key, df.copy(), size)
+            return
+        if pa is None:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".parquet")
+        meta = {"database_path": database_path, "fingerprint": fingerprint, "sql": sql, "max_rows": max_rows, "attrs": dict(df.attrs), "size": size}
+        try:
+            df.to_parquet(path, index=False)
+            with open(os.path.splitext(path)[0] + ".json", "w", encoding="utf-8") as fp:
+                json.dump(meta, fp, ensure_ascii=False, default=str)
+        except (pa.ArrowException, ValueError, TypeError, OSError):
+            self._remove(path)
+            return
+        self._disk.put(key, (path, dict(df.attrs), size), os.path.getsize(path))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        命中统计
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes_saved": self.bytes_saved,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory.bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk.bytes,
+            }
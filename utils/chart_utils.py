@@ -0,0 +1,211 @@
+import io
+import os
+import ast
+import sys
+import json
+import pickle
+import builtins
+import subprocess
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Union
+from types import CodeType
+
+CHART_TIMEOUT = 10.0
+CHART_MEMORY_BYTES = 4 * 2 ** 30
+CHART_CODE_CACHE_SIZE = 128
+CHART_TYPES = ("line", "bar", "scatter", "area")
+
+# 允许的语句类型, 其余(import、函数与类定义、while、try、with等)一律拒绝
+ALLOWED_STATEMENTS = (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.Expr, ast.If, ast.For, ast.Pass)
+# 可以直接按名字调用的函数
+ALLOWED_CALLS = {
+    "chart", "abs", "all", "any", "bool", "dict", "enumerate", "filter", "float", "int", "isinstance", "len", "list",
+    "map", "max", "min", "range", "reversed", "round", "set", "sorted", "str", "sum", "tuple", "zip",
+}
+# pd 与 np 上允许访问的属性
+ALLOWED_MODULE_ATTRIBUTES = {
+    "pd": {
+        "DataFrame", "Series", "Categorical", "DateOffset", "Grouper", "NA", "NaT", "Timedelta", "Timestamp", "concat",
+        "crosstab", "cut", "date_range", "isna", "isnull", "melt", "merge", "notna", "notnull", "offsets", "pivot_table",
+        "qcut", "to_datetime", "to_numeric", "to_timedelta",
+    },
+    "np": {
+        "abs", "arange", "ceil", "clip", "cumsum", "exp", "float64", "floor", "inf", "int64", "isnan", "linspace", "log",
+        "log10", "maximum", "mean", "median", "minimum", "nan", "percentile", "round", "select", "sqrt", "sum", "where",
+    },
+}
+# 其它对象(DataFrame、Series、GroupBy、.str/.dt访问器、list、dict、str)上允许访问的属性,
+# 只包含整理绘图数据用到的方法, 不含任何接受路径或缓冲区参数的方法(to_csv、to_string、tofile等)
+ALLOWED_ATTRIBUTES = {
+    # DataFrame / Series
+    "T", "abs", "add", "agg", "aggregate", "all", "any", "apply", "assign", "astype", "at", "between", "clip", "columns",
+    "combine_first", "copy", "corr", "count", "cov", "cummax", "cummin", "cumprod", "cumsum", "describe", "diff", "div",
+    "drop", "drop_duplicates", "dropna", "dt", "dtype", "dtypes", "empty", "eq", "explode", "fillna", "ge", "groupby", "gt",
+    "head", "iat", "idxmax", "idxmin", "iloc", "index", "isin", "isna", "isnull", "join", "le", "loc", "lt", "map", "mask",
+    "max", "mean", "median", "melt", "merge", "min", "mod", "mode", "mul", "name", "ndim", "ne", "nlargest", "notna",
+    "notnull", "nsmallest", "nunique", "pct_change", "pivot", "pivot_table", "pow", "prod", "quantile", "rank", "rename",
+    "rename_axis", "reindex", "replace", "reset_index", "resample", "rolling", "round", "set_index", "shape", "shift",
+    "size", "sort_index", "sort_values", "stack", "std", "str", "sub", "sum", "tail", "to_dict", "to_frame", "to_list",
+    "tolist", "transform", "truediv", "unique", "unstack", "value_counts", "values", "var", "where",
+    # GroupBy / Rolling
+    "cumcount", "first", "last", "ngroup", "nth",
+    # .dt 访问器与时间
+    "ceil", "date", "day", "day_name", "dayofweek", "dayofyear", "days", "floor", "hour", "minute", "month", "month_name",
+    "normalize", "quarter", "second", "strftime", "to_period", "to_timestamp", "total_seconds", "week", "weekday", "year",
+    # .str 访问器与str
+    "capitalize", "contains", "endswith", "extract", "len", "lower", "lstrip", "pad", "rstrip", "slice", "split",
+    "startswith", "strip", "title", "upper", "zfill",
+    # list / dict
+    "append", "extend", "get", "insert", "items", "keys", "pop", "sort", "update",
+}
+SAFE_BUILTINS = {name: getattr(builtins, name) for name in ALLOWED_CALLS - {"chart"}}
+
+
+class ChartCodeError(Exception):
+    """
+    图表代码未通过校验或执行失败
+    """
+
+
+@dataclass
+class ChartSpec:
+    """
+    一次 chart() 调用的参数, 重新渲染时直接回放
+    """
+    type: str
+    data: pd.DataFrame
+    x: str
+    y: Union[str, List[str]]
+    horizontal: bool = False
+    stack: Optional[Union[bool, str]] = None
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        转换为可JSON序列化的字典
+        """
+        return {"type": self.type, "data": self.data.to_json(orient="table", index=False), "x": self.x, "y": self.y,
+                "horizontal": self.horizontal, "stack": self.stack}
+
+    @classmethod
+    def from_json(cls, item: Dict[str, Any]) -> "ChartSpec":
+        """
+        从 to_json 的结果还原
+        """
+        return cls(item["type"], pd.read_json(io.StringIO(item["data"]), orient="table"), item["x"], item["y"],
+                   bool(item["horizontal"]), item["stack"])
+
+
+def validate_chart_code(code: str) -> ast.Module:
+    """
+    按允许列表校验图表代码, 返回语法树; 不合法时抛出ChartCodeError
+    """
+    try:
+        tree = ast.parse(code, mode="exec")
+    except SyntaxError as e:
+        raise ChartCodeError(f"Syntax error: {e}")
+    chart_calls = 0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.stmt) and not isinstance(node, ALLOWED_STATEMENTS):
+            raise ChartCodeError(f"Line {node.lineno}: {type(node).__name__} statements are not allowed")
+        if isinstance(node, ast.Name) and node.id.startswith("__"):
+            raise ChartCodeError(f"Line {node.lineno}: name {node.id!r} is not allowed")
+        if isinstance(node, ast.Attribute):
+            if isinstance(node.value, ast.Name) and node.value.id in ALLOWED_MODULE_ATTRIBUTES:
+                if node.attr not in ALLOWED_MODULE_ATTRIBUTES[node.value.id]:
+                    raise ChartCodeError(f"Line {node.lineno}: {node.value.id}.{node.attr} is not allowed")
+            elif node.attr not in ALLOWED_ATTRIBUTES:
+                raise ChartCodeError(f"Line {node.lineno}: attribute {node.attr!r} is not allowed")
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id not in ALLOWED_CALLS:
+                raise ChartCodeError(f"Line {node.lineno}: call to {node.func.id!r} is not allowed")
+            if node.func.id == "chart":
+                chart_calls += 1
+                if node.args and isinstance(node.args[0], ast.Constant) and node.args[0].value not in CHART_TYPES:
+                    raise ChartCodeError(f"Line {node.lineno}: unknown chart type {node.args[0].value!r}")
+    if not chart_calls:
+        raise ChartCodeError("The code never calls chart()")
+    return tree
+
+
+@lru_cache(maxsize=CHART_CODE_CACHE_SIZE)
+def compile_chart_code(code: str) -> CodeType:
+    """
+    校验并编译图表代码, 相同代码只编译一次
+    """
+    return compile(validate_chart_code(code), "<chart>", "exec")
+
+
+def execute_chart_code(code: str, dfs: List[pd.DataFrame]) -> List[ChartSpec]:
+    """
+    在当前进程中执行图表代码, 只提供允许列表内的内置函数, 返回 chart() 调用记录的图表
+    """
+    compiled = compile_chart_code(code)
+    specs = []
+
+    def chart(type: str, data: pd.DataFrame, x: str, y: Union[str, List[str]], horizontal: bool=False, stack: Optional[Union[bool, str]]=None) -> None:
+        if type not in CHART_TYPES:
+            raise ChartCodeError(f"Unknown chart type {type!r}")
+        if not isinstance(data, pd.DataFrame):
+            raise ChartCodeError("chart() data must be a DataFrame")
+        missing = [column for column in [x] + ([y] if isinstance(y, str) else list(y)) if column not in data.columns]
+        if missing:
+            raise ChartCodeError(f"chart() columns not found: {', '.join(map(str, missing))}")
+        specs.append(ChartSpec(type, data.copy(), x, y if isinstance(y, str) else list(y), bool(horizontal), stack))
+
+    namespace = {"__builtins__": SAFE_BUILTINS, "pd": pd, "np": np, "chart": chart}
+    namespace.update({f"df{i + 1}": df.copy() for i, df in enumerate(dfs)})
+    try:
+        exec(compiled, namespace)
+    except ChartCodeError:
+        raise
+    except Exception as e:
+        raise ChartCodeError(f"{type(e).__name__}: {e}")
+    return specs
+
+
+def execute_chart_code_isolated(code: str, dfs: List[pd.DataFrame], timeout: float=CHART_TIMEOUT) -> List[ChartSpec]:
+    """
+    在子进程中执行图表代码, 超过timeout秒时终止
+
+    子进程的输出不可信, 因此只以JSON(而不是pickle)传回图表
+    """
+    validate_chart_code(code)
+    try:
+        process = subprocess.run([sys.executable, "-m", "utils.chart_utils"], input=pickle.dumps({"code": code, "dfs": dfs}),
+                                 capture_output=True, timeout=timeout, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    except subprocess.TimeoutExpired:
+        raise ChartCodeError(f"Chart code did not finish within {timeout:g}s")
+    if process.returncode != 0:
+        lines = process.stderr.decode(errors="replace").strip().splitlines()
+        raise ChartCodeError(lines[-1] if lines else f"Chart process exited with code {process.returncode}")
+    try:
+        return [ChartSpec.from_json(item) for item in json.loads(process.stdout)]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ChartCodeError(f"Invalid chart process output: {e}")
+
+
+def run_chart_code(code: str, dfs: List[pd.DataFrame], timeout: float=CHART_TIMEOUT) -> List[ChartSpec]:
+    """
+    执行图表代码得到图表
+
+    静态校验无法限制循环次数与内存用量, 因此总是在有时间与内存限制的子进程中执行; 得到的图表由调用方缓存, 同一段代码只执行一次
+    """
+    return execute_chart_code_isolated(code, dfs, timeout)
+
+
+if __name__ == "__main__":
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (CHART_MEMORY_BYTES, CHART_MEMORY_BYTES))
+    except (ImportError, ValueError, OSError):
+        pass
+    request = pickle.loads(sys.stdin.buffer.read())
+    try:
+        specs = execute_chart_code(request["code"], request["dfs"])
+    except ChartCodeError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(1)
+    sys.stdout.write(json.dumps([spec.to_json() for spec in specs]))
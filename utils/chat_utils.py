@@ -1,7 +1,16 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Coroutine, Dict, Iterator, List, Optional, Tuple
+import httpx
 import streamlit as st
-from openai import OpenAI, Stream
-from openai.types.chat import ChatCompletionChunk
+from streamlit.external.langchain import StreamlitCallbackHandler
+from openai import OpenAI, AsyncOpenAI
 from .type_utils import *
+from .cache_utils import ResponseCache
+from .selection_utils import estimate_tokens
+from .trace_utils import span, start_span
 
 import logging
 logging.basicConfig(
@@ -11,53 +20,394 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_local = threading.local()
 
-def chat(messages: Messages) -> str:
+CLIENT_TIMEOUT = 120.0
+CLIENT_CONNECT_TIMEOUT = 10.0
+CLIENT_MAX_RETRIES = 3
+CLIENT_MAX_CONNECTIONS = 32
+CLIENT_MAX_KEEPALIVE_CONNECTIONS = 16
+CLIENT_KEEPALIVE_EXPIRY = 60.0
+
+LLM_CACHE_PATH = "./tmp/llm_cache.sqlite"
+LLM_CACHE_SIZE = 256
+LLM_CACHE_TTL = 7 * 24 * 3600
+# 估算prompt token时每条消息的格式开销
+MESSAGE_TOKEN_OVERHEAD = 4
+
+_response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_SIZE, LLM_CACHE_TTL)
+_stats_lock = threading.Lock()
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+# run_async执行的协程中的token用量先记在任务自己的列表里, 结束后计入调用线程
+_task_usage: ContextVar[Optional[List[Tuple[int, int, bool]]]] = ContextVar("task_usage", default=None)
+
+
+def _client_options(max_connections: int, max_keepalive_connections: int, timeout: float) -> Dict[str, Any]:
     """
-    与llm对话
+    连接池与超时配置
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(timeout, connect=CLIENT_CONNECT_TIMEOUT),
+    }
+
+
+@st.cache_resource(show_spinner=False)
+def get_client(base_url: str, api_key: str,
+               max_connections: int=CLIENT_MAX_CONNECTIONS,
+               max_keepalive_connections: int=CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+               timeout: float=CLIENT_TIMEOUT,
+               max_retries: int=CLIENT_MAX_RETRIES) -> OpenAI:
+    """
+    获取复用连接池的同步客户端, 每个 (base_url, api_key) 只创建一次
+
+    失败请求由 openai 客户端按指数退避重试 max_retries 次
+    """
+    options = _client_options(max_connections, max_keepalive_connections, timeout)
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=options["timeout"],
+        max_retries=max_retries,
+        http_client=httpx.Client(**options),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_client(base_url: str, api_key: str,
+                     max_connections: int=CLIENT_MAX_CONNECTIONS,
+                     max_keepalive_connections: int=CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+                     timeout: float=CLIENT_TIMEOUT,
+                     max_retries: int=CLIENT_MAX_RETRIES) -> AsyncOpenAI:
+    """
+    获取复用连接池的异步客户端, 每个 (base_url, api_key) 只创建一次
+
+    异步连接绑定在事件循环上, 因此只能在 run_async 提供的后台事件循环中使用
     """
-    client = OpenAI(
-        api_key=st.session_state.settings["api_key"],
-        base_url=st.session_state.settings["base_url"],
+    options = _client_options(max_connections, max_keepalive_connections, timeout)
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=options["timeout"],
+        max_retries=max_retries,
+        http_client=httpx.AsyncClient(**options),
     )
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """
+    获取常驻后台线程的事件循环
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return _loop
+
+
+async def _track_usage(coro: Coroutine[Any, Any, Any], usage: List[Tuple[int, int, bool]]) -> Any:
+    """
+    执行协程, 期间的token用量记入usage
+    """
+    _task_usage.set(usage)
+    return await coro
+
+
+def run_async(coro: Coroutine[Any, Any, Any]) -> Any:
+    """
+    在后台事件循环中执行协程并等待结果, 协程中achat的token用量计入当前线程
+    """
+    usage: List[Tuple[int, int, bool]] = []
+    try:
+        return asyncio.run_coroutine_threadsafe(_track_usage(coro, usage), _get_loop()).result()
+    finally:
+        for prompt_tokens, completion_tokens, estimated in usage:
+            _add_usage(prompt_tokens, completion_tokens, estimated)
+
+
+def get_handler() -> Optional[StreamlitCallbackHandler]:
+    """
+    获取当前线程的思考过程渲染器
+    """
+    handler = getattr(_local, "handler", None)
+    if handler is not None:
+        return handler
+    return st.session_state.get("handler", None)
+
+
+@contextmanager
+def thread_handler(handler: Optional[StreamlitCallbackHandler]) -> Iterator[None]:
+    """
+    为当前线程指定思考过程渲染器
+    """
+    previous = getattr(_local, "handler", None)
+    _local.handler = handler
+    try:
+        yield
+    finally:
+        _local.handler = previous
+
+
+def fork_handler(container: Optional[Any]=None) -> Optional[StreamlitCallbackHandler]:
+    """
+    在当前渲染器下创建独立的子渲染器, 供并行任务使用, 可通过container指定渲染位置
+    """
+    handler = get_handler()
+    if handler is None:
+        return None
+    return StreamlitCallbackHandler(container if container is not None else handler._parent_container.container(),
+        max_thought_containers=handler._max_thought_containers,
+        expand_new_thoughts=handler._expand_new_thoughts,
+        collapse_completed_thoughts=handler._collapse_completed_thoughts,
+    )
+
+
+def handler_placeholder() -> Optional[Any]:
+    """
+    在当前渲染器下预留一个可清空的位置
+    """
+    handler = get_handler()
+    if handler is None:
+        return None
+    return handler._parent_container.empty()
+
+
+class LLMCancelled(Exception):
+    """
+    LLM请求被取消
+    """
+
+
+@contextmanager
+def cancel_scope(event: threading.Event) -> Iterator[None]:
+    """
+    为当前线程指定取消事件, 事件被设置后chat会在收到下一个数据块时中止请求
+    """
+    previous = getattr(_local, "cancel", None)
+    _local.cancel = event
+    try:
+        yield
+    finally:
+        _local.cancel = previous
+
+
+def _check_cancelled() -> None:
+    """
+    当前线程的请求已被取消时抛出LLMCancelled
+    """
+    event = getattr(_local, "cancel", None)
+    if event is not None and event.is_set():
+        raise LLMCancelled()
+
+
+def set_thought_label(stage: str) -> None:
+    """
+    设置思考过程的标题
+    """
+    handler = get_handler()
+    if handler is None:
+        return
+    handler._thought_labeler.get_initial_label = lambda: f"**{stage}**: Thinking..."
+    handler._thought_labeler.get_final_agent_thought_label = lambda: f"**{stage}**: **Complete!**"
+
+
+def token_usage() -> Dict[str, int]:
+    """
+    返回当前线程chat调用累计的请求次数与token用量, 命中缓存的调用不计入;
+    estimated_calls为提前结束、用量由本地估算的调用次数
+    """
+    return dict(getattr(_local, "usage", {"calls": 0, "estimated_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}))
+
+
+def _add_usage(prompt_tokens: int, completion_tokens: int, estimated: bool=False) -> None:
+    """
+    累计当前线程的token用量; 在run_async执行的协程中时先记在任务中, 由run_async计入调用线程
+    """
+    pending = _task_usage.get()
+    if pending is not None:
+        pending.append((prompt_tokens, completion_tokens, estimated))
+        return
+    usage = getattr(_local, "usage", None) or {"calls": 0, "estimated_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    usage["calls"] += 1
+    usage["estimated_calls"] += int(estimated)
+    usage["prompt_tokens"] += prompt_tokens
+    usage["completion_tokens"] += completion_tokens
+    _local.usage = usage
+
+
+def _estimate_usage(messages: Messages, response: str) -> Tuple[int, int]:
+    """
+    本地估算一次请求的 (prompt_tokens, completion_tokens)
+
+    提前结束流式请求时收不到服务端在最后一个数据块中返回的用量, 只能按文本估算
+    """
+    prompt_tokens = sum(estimate_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD for message in messages)
+    return prompt_tokens, estimate_tokens(response)
+
+
+def record_cache_lookup(hit: bool) -> Dict[str, int]:
+    """
+    记录当前会话的LLM缓存命中情况
+    """
+    with _stats_lock:
+        stats = st.session_state.setdefault("llm_cache_stats", {"hits": 0, "misses": 0})
+        stats["hits" if hit else "misses"] += 1
+        return dict(stats)
+
+
+def chat(messages: Messages, on_token: Optional[Callable[[str], Optional[bool]]]=None, scope: Optional[str]=None) -> str:
+    """
+    与llm对话
+
+    temperature为0时输出是确定的, 相同请求直接复用缓存的响应; scope标识请求依赖的工作区, 计入缓存键,
+    使剪裁后相同的schema文本不会在不同数据库之间共用响应.
+    on_token在收到每段输出时被调用(命中缓存时以完整响应调用一次), 返回True时提前结束流式请求并返回已生成的部分;
+    调用方对同一请求总是使用相同的结束条件, 因此提前结束的响应同样可以缓存. 提前结束时token用量为本地估算值, span标记usage_estimated.
+    每次调用记录为一个llm span, 包含首token延迟、token用量与缓存命中情况
+    """
+    with span("llm", model=st.session_state.settings["model"]) as llm_span:
+        return _chat(messages, on_token, scope, llm_span)
+
+
+def _chat(messages: Messages, on_token: Optional[Callable[[str], Optional[bool]]], scope: Optional[str], llm_span: Any) -> str:
+    """
+    chat的实现
+    """
+    settings = st.session_state.settings
     messages = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
-    handler = st.session_state.get("handler", None)
+    _check_cancelled()
+    handler = get_handler()
     if handler:
         handler.on_llm_start(None, None)
-    completion = client.chat.completions.create(
-        model=st.session_state.settings["model"],
-        messages=messages,
-        temperature=st.session_state.settings["temperature"],
-        stream=True,
-    )
-    collected_messages = []
-    for chunk in completion:
-        chunk_message = chunk.choices[0].delta.content
-        if chunk_message:
-            collected_messages.append(chunk_message)
-            handler.on_llm_new_token(chunk_message)
+    cache_key, stats = None, None
+    response = None
+    if settings["temperature"] == 0 and settings.get("llm_cache", True):
+        cache_key = ResponseCache.make_key(base_url=settings["base_url"], model=settings["model"],
+                                           temperature=settings["temperature"], scope=scope, messages=messages)
+        response = _response_cache.get(cache_key)
+        stats = record_cache_lookup(response is not None)
+    cache_hit = response is not None
+    if cache_key is not None:
+        llm_span.set(cache_hit=cache_hit)
+    if cache_hit:
+        llm_span.set(ttft_ms=llm_span.duration_ms)
+        if handler:
+            handler.on_llm_new_token(response)
+        if on_token is not None:
+            on_token(response)
+    else:
+        client = get_client(settings["base_url"], settings["api_key"])
+        collected_messages = []
+        usage = None
+        with client.chat.completions.create(
+            model=settings["model"],
+            messages=messages,
+            temperature=settings["temperature"],
+            stream=True,
+            stream_options={"include_usage": True},
+        ) as completion:
+            for chunk in completion:
+                _check_cancelled()
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                chunk_message = chunk.choices[0].delta.content
+                if chunk_message:
+                    if not collected_messages:
+                        llm_span.set(ttft_ms=llm_span.duration_ms)
+                    collected_messages.append(chunk_message)
+                    if handler:
+                        handler.on_llm_new_token(chunk_message)
+                    if on_token is not None and on_token(chunk_message):
+                        llm_span.set(early_stop=True)
+                        break
+        response = ''.join(collected_messages)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = _estimate_usage(messages, response)
+            llm_span.set(usage_estimated=True)
+        _add_usage(prompt_tokens, completion_tokens, estimated=usage is None)
+        llm_span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        if cache_key is not None:
+            _response_cache.put(cache_key, response)
     if handler:
+        if stats is not None:
+            handler.on_llm_new_token(f"\n\n*LLM cache {'hit' if cache_hit else 'miss'} "
+                                     f"({stats['hits']} hits / {stats['misses']} misses this session)*")
         handler.on_llm_end(None)
         handler.on_agent_finish(None)
-    response = ''.join(collected_messages)
     logger.info("User:\n" + messages[-1]["content"])
     logger.info("Assistant:\n" + response)
     return response
 
 
-def chat_stream(messages: Messages) -> Stream[ChatCompletionChunk]:
+def chat_stream(messages: Messages) -> Iterator[str]:
     """
-    流式对话
+    流式对话, 逐段产出输出文本
+
+    整个流记录为一个write_response span; 生成器在读取过程中交出控制权, 因此该span不设为当前span
+    """
+    client = get_client(st.session_state.settings["base_url"], st.session_state.settings["api_key"])
+    messages = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+    stream_span = start_span("write_response", model=st.session_state.settings["model"])
+    try:
+        with client.chat.completions.create(
+            model=st.session_state.settings["model"],
+            messages=messages,
+            temperature=st.session_state.settings["temperature"],
+            stream=True,
+            stream_options={"include_usage": True},
+        ) as completion:
+            for chunk in completion:
+                if chunk.usage:
+                    stream_span.set(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if "ttft_ms" not in stream_span.attributes:
+                    stream_span.set(ttft_ms=stream_span.duration_ms)
+                yield chunk.choices[0].delta.content
+    except BaseException as e:
+        stream_span.finish(e)
+        raise
+    stream_span.finish()
+
+
+async def achat(messages: Messages, settings: Dict[str, Any], scope: Optional[str]=None) -> str:
+    """
+    异步对话, 与其它请求共享连接池, 与chat使用相同的响应缓存(含scope)与token用量统计
+
+    后台线程无法访问 st.session_state, 因此需要显式传入 settings; 需通过 run_async 执行
     """
-    client = OpenAI(
-        api_key=st.session_state.settings["api_key"],
-        base_url=st.session_state.settings["base_url"],
-    )
     messages = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
-    completion = client.chat.completions.create(
-        model=st.session_state.settings["model"],
+    cache_key = None
+    if settings["temperature"] == 0 and settings.get("llm_cache", True):
+        cache_key = ResponseCache.make_key(base_url=settings["base_url"], model=settings["model"],
+                                           temperature=settings["temperature"], scope=scope, messages=messages)
+        response = _response_cache.get(cache_key)
+        if response is not None:
+            return response
+    client = get_async_client(settings["base_url"], settings["api_key"])
+    completion = await client.chat.completions.create(
+        model=settings["model"],
         messages=messages,
-        temperature=st.session_state.settings["temperature"],
-        stream=True,
+        temperature=settings["temperature"],
     )
-    return completion
+    response = completion.choices[0].message.content or ""
+    if completion.usage is not None:
+        _add_usage(completion.usage.prompt_tokens, completion.usage.completion_tokens)
+    else:
+        _add_usage(*_estimate_usage(messages, response), estimated=True)
+    if cache_key is not None:
+        _response_cache.put(cache_key, response)
+    logger.info("User:\n" + messages[-1]["content"])
+    logger.info("Assistant:\n" + response)
+    return response
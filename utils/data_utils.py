@@ -1,67 +1,278 @@
 import os
+import time
+import uuid
 import sqlite3
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 import pandas as pd
 import streamlit as st
+from typing import Any, Dict, List, Optional, Set, Tuple
+from .schema_utils import get_schema, invalidate_schema, database_fingerprint
+from .selection_utils import select_create_statements, invalidate_schema_index, SCHEMA_TOKEN_BUDGET
+from .profile_utils import invalidate_profiles
+from .cache_utils import ResultCache
+from .str_utils import normalize_sql
+from .index_utils import drop_advisor
+from .pool_utils import close_pool
+from .guard_utils import QUERY_TIMEOUT, QUERY_MAX_INSTRUCTIONS
+from .result_utils import MAX_RESULT_ROWS
+from .engine_utils import close_engine, engine_available, export_parquet, get_engine, parquet_dir, DEFAULT_ENGINE
+from .ingest_utils import ingest_chunks, ingest_sheet, iter_csv_chunks, iter_excel_chunks, list_sheets, merge_database, stream_fraction
+from .upload_utils import get_ingest_store, hash_upload, write_upload
+from .trace_utils import span
 
+INGEST_WORKERS = os.cpu_count() or 1
 
-def excel2sqlite(filename: str, df: pd.DataFrame) -> None:
+RESULT_CACHE_DIR = "./tmp/result_cache"
+RESULT_CACHE_MEMORY_BYTES = 256 * 2 ** 20
+RESULT_CACHE_DISK_BYTES = 2 ** 30
+RESULT_CACHE_SPILL_BYTES = 8 * 2 ** 20
+
+_result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MEMORY_BYTES, RESULT_CACHE_DISK_BYTES, RESULT_CACHE_SPILL_BYTES)
+
+
+def invalidate_database(database_path: str) -> None:
     """
-    将excel转换为sqlite
+    工作区数据库建成或被淘汰后清理相关缓存
     """
-    conn = sqlite3.connect(f"./tmp/{filename}.sqlite")
-    df.to_sql(filename, conn, if_exists='replace', index=False)
-    conn.close()
+    invalidate_schema(database_path)
+    invalidate_schema_index(database_path)
+    invalidate_profiles(database_path)
+    drop_advisor(database_path)
+    close_pool(database_path)
+    close_engine(database_path)
 
 
-@st.cache_data(ttl="2h")
-def load_data(uploaded_file: str) -> str:
+def split_filename(name: str) -> Tuple[str, str]:
     """
-    读取数据源
+    拆分文件名与扩展名
     """
     try:
-        filename, ext = os.path.splitext(uploaded_file.name)
+        filename, ext = os.path.splitext(name)
         ext = ext[1:].lower()
     except:
-        filename = uploaded_file.name[::-1].split('.', 1)[-1][::-1]
-        ext = uploaded_file.name.split('.')[-1]
-    if not os.path.isdir("./tmp"):
-        os.mkdir("./tmp")
-    if ext in ["csv", "xls", "xlsx", "xlsm", "xlsb"]:
-        df = pd.read_csv(uploaded_file) if ext == "csv" else pd.read_excel(uploaded_file)
-        excel2sqlite(filename, df)
-        return filename
-    elif ext in ["sqlite", "db"]:
-        with open(f"./tmp/{filename}.sqlite", "wb") as fp:
-            fp.write(uploaded_file.getvalue())
-        return filename
+        filename = name[::-1].split('.', 1)[-1][::-1]
+        ext = name.split('.')[-1]
+    return filename, ext
+
+
+def unique_table_name(name: str, used: Set[str]) -> str:
+    """
+    生成工作区内不重复的表名
+    """
+    candidate, i = name, 1
+    while candidate.lower() in used:
+        i += 1
+        candidate = f"{name}_{i}"
+    used.add(candidate.lower())
+    return candidate
+
+
+def run_ingest_jobs(jobs: List[Tuple[str, str, Any, str, str]]) -> None:
+    """
+    执行工作表导入任务: 单个任务在当前进程中流式导入, 多个任务分发到工作进程并行导入
+    """
+    progress_bar = st.progress(0.0, text="Loading data...")
+    if len(jobs) == 1:
+        source_path, ext, sheet_name, table_name, part_path = jobs[0]
+
+        def on_progress(n_rows: int, rows_per_second: float, fraction: Optional[float]) -> None:
+            progress_bar.progress(fraction or 0.0, text=f"Loading {table_name}: {n_rows:,} rows ({rows_per_second:,.0f} rows/s)")
+
+        with open(source_path, "rb") as fp:
+            chunks = iter_csv_chunks(fp) if ext == "csv" else iter_excel_chunks(fp, ext, sheet_name)
+            n_rows = ingest_chunks(chunks, part_path, table_name, on_progress, stream_fraction(fp, os.path.getsize(source_path)))
+        st.toast(f"Loaded {n_rows:,} rows into {table_name}")
     else:
-        st.error(f"Unsupported file format: {ext}")
+        with ProcessPoolExecutor(max_workers=min(len(jobs), INGEST_WORKERS), mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(ingest_sheet, *job) for job in jobs]
+            for i, future in enumerate(as_completed(futures)):
+                table_name, n_rows, seconds = future.result()
+                progress_bar.progress((i + 1) / len(jobs), text=f"Loaded {table_name}: {n_rows:,} rows ({n_rows / max(seconds, 1e-6):,.0f} rows/s)")
+        st.toast(f"Loaded {len(jobs)} sheets")
+    progress_bar.empty()
+
+
+def upload_digest(uploaded_file: Any) -> str:
+    """
+    获取上传文件内容的sha256, 同一个上传对象在会话内只计算一次
+    """
+    file_id = getattr(uploaded_file, "file_id", None)
+    if file_id is None:
+        return hash_upload(uploaded_file)
+    hashes = st.session_state.setdefault("upload_hashes", {})
+    if file_id not in hashes:
+        hashes[file_id] = hash_upload(uploaded_file)
+    return hashes[file_id]
+
+
+def workspace_digest(database_path: str) -> str:
+    """
+    工作区数据库的内容摘要(由上传文件摘要与查询引擎计算), 用作LLM响应缓存的scope
+    """
+    return os.path.splitext(os.path.basename(database_path))[0]
+
+
+def ingest_uploads(uploads: List[Tuple[Any, str, str]]) -> None:
+    """
+    把尚未导入过的上传文件导入到按内容寻址的目录, uploads为 (上传文件, sha256, 扩展名)
+
+    所有文件的工作表一起分发给导入任务; 内容相同的文件只导入一次, 其它会话可以直接复用.
+    各条目的构建锁按sha256顺序获取, 上传顺序不同的会话同时导入相同的文件时不会互相等待而死锁
+    """
+    store = get_ingest_store()
+    unique = {digest: (uploaded_file, ext) for uploaded_file, digest, ext in reversed(uploads)}
+    with ExitStack() as stack:
+        jobs, manifests = [], []
+        for digest in sorted(unique):
+            uploaded_file, ext = unique[digest]
+            temp_dir = stack.enter_context(store.build(store.part_dir(digest)))
+            if temp_dir is None:
+                continue
+            os.makedirs(temp_dir)
+            source_path = os.path.join(temp_dir, f"source.{ext}")
+            write_upload(uploaded_file, source_path)
+            manifest = {"ext": ext, "sheets": []}
+            if ext not in ["sqlite", "db"]:
+                filename, _ = split_filename(uploaded_file.name)
+                sheets = list_sheets(source_path, ext)
+                for i, sheet_name in enumerate(sheets):
+                    table_name = filename if len(sheets) == 1 else f"{filename}_{sheet_name}"
+                    jobs.append((source_path, ext, sheet_name, table_name, os.path.join(temp_dir, f"{i}.sqlite")))
+                    manifest["sheets"].append({"sheet": sheet_name, "table": table_name, "path": f"{i}.sqlite"})
+            manifests.append((temp_dir, source_path, manifest))
+        if jobs:
+            run_ingest_jobs(jobs)
+        for temp_dir, source_path, manifest in manifests:
+            if manifest["sheets"]:
+                os.remove(source_path)
+            store.write_manifest(temp_dir, manifest)
+
+
+def load_data(uploaded_files: List[Any], engine: str=DEFAULT_ENGINE) -> Optional[str]:
+    """
+    读取数据源, 所有文件的所有工作表都作为独立的表写入同一个工作区数据库, 返回数据库路径
+
+    导入结果与工作区都按上传内容的sha256寻址并在会话间共享: 重复上传直接复用, 同名的不同文件互不影响.
+    engine为duckdb时工作区另外导出一份Parquet供DuckDB查询, 查询引擎随工作区确定.
+    当前会话持有工作区的租约, 构建期间另外持有工作区与所用导入结果的临时租约;
+    只在写入新条目后检查配额, 此时只淘汰没有租约的条目
+    """
+    store = get_ingest_store()
+    uploads = []
+    for uploaded_file in uploaded_files:
+        _, ext = split_filename(uploaded_file.name)
+        if ext not in ["csv", "xls", "xlsx", "xlsm", "xlsb", "sqlite", "db"]:
+            st.error(f"Unsupported file format: {ext}")
+            continue
+        uploads.append((uploaded_file, upload_digest(uploaded_file), ext))
+    if not uploads:
         return None
+    if not engine_available(engine):
+        st.warning(f"Query engine {engine} is not installed, falling back to SQLite")
+        engine = DEFAULT_ENGINE
+    lines = [f"{digest}:{uploaded_file.name}" for uploaded_file, digest, _ in uploads]
+    if engine != DEFAULT_ENGINE:
+        lines.insert(0, f"engine:{engine}")
+    workspace = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+    database_path = store.workspace_path(workspace)
+    created = False
+    with store.lease([database_path] + [store.part_dir(digest) for _, digest, _ in uploads]):
+        if not os.path.exists(database_path):
+            ingest_uploads(uploads)
+            with store.build(database_path) as building_path:
+                if building_path is not None:
+                    conn = sqlite3.connect(building_path)
+                    try:
+                        conn.execute("PRAGMA journal_mode=OFF;")
+                        conn.execute("PRAGMA synchronous=OFF;")
+                        used, databases = set(), []
+                        for uploaded_file, digest, _ in uploads:
+                            filename, _ = split_filename(uploaded_file.name)
+                            part_dir = store.part_dir(digest)
+                            manifest = store.read_manifest(part_dir)
+                            if not manifest["sheets"]:
+                                databases.append((os.path.join(part_dir, f"source.{manifest['ext']}"), filename))
+                                continue
+                            for sheet in manifest["sheets"]:
+                                table_name = unique_table_name(filename if len(manifest["sheets"]) == 1 else f"{filename}_{sheet['sheet']}", used)
+                                merge_database(conn, os.path.join(part_dir, sheet["path"]), table_name, {sheet["table"]: table_name})
+                        for source_path, filename in databases:
+                            merge_database(conn, source_path, filename)
+                    finally:
+                        conn.close()
+            invalidate_database(database_path)
+            created = True
+        if engine == "duckdb" and not os.path.isdir(parquet_dir(database_path)):
+            with store.build(parquet_dir(database_path)) as building_dir:
+                if building_dir is not None:
+                    with st.spinner("Writing Parquet files..."):
+                        export_parquet(database_path, building_dir)
+            close_engine(database_path)
+            created = True
+        store.acquire(st.session_state.setdefault("session_id", uuid.uuid4().hex), database_path)
+    if created:
+        store.cleanup(invalidate_database)
+    return database_path
 
 
-def get_create_statements(database_path: str) -> str:
+def get_create_statements(database_path: str, query: Optional[str]=None, budget: int=SCHEMA_TOKEN_BUDGET) -> str:
     """
-    获取数据库schema
+    获取数据库schema, 指定query时只保留token预算内与之相关的表和列; 开头注明查询引擎的SQL方言
     """
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
+    if query is None:
+        statements = get_schema(database_path).create_statements
+    else:
+        statements = select_create_statements(database_path, query, budget)
+    return f"SQL dialect: {query_dialect(database_path)}\n{statements}"
 
-    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
-    tables = cursor.fetchall()
-    conn.close()
-    return "```sql\n" + "\n\n".join(create_sql for _, create_sql in tables) + "\n```"
+
+def query_dialect(database_path: str) -> str:
+    """
+    工作区查询引擎的SQL方言
+    """
+    return get_engine(database_path).dialect
 
 
-def execute_sql(query: str, database_path: str) -> pd.DataFrame:
+def execute_sql(query: str, database_path: str, max_rows: int=MAX_RESULT_ROWS,
+                timeout: float=QUERY_TIMEOUT, max_instructions: int=QUERY_MAX_INSTRUCTIONS) -> pd.DataFrame:
     """
-    执行sql语句
+    执行sql语句, 结果超过max_rows行时截断并设置 df.attrs["truncated"]
+
+    由工作区的查询引擎执行: 执行前拒绝预计为笛卡尔积的查询, 执行中限制耗时(SQLite还限制虚拟机指令数);
+    结果按 (数据库文件指纹, 规范化SQL) 缓存. 失败时返回空DataFrame, 错误信息记录在 df.attrs["error"]
     """
-    try:
-        conn = sqlite3.connect(database_path)
-        cursor = conn.cursor()
-        cursor.execute(query)
-        result = cursor.fetchall()
-        columns = [column[0] for column in cursor.description]
-        return pd.DataFrame([list(row) for row in result], columns=columns)
-    except:
-        return pd.DataFrame()
+    with span("execute_sql") as sql_span:
+        try:
+            fingerprint = database_fingerprint(database_path)
+            normalized = normalize_sql(query)
+            df = _result_cache.get(database_path, fingerprint, normalized, max_rows)
+            sql_span.set(cache_hit=df is not None)
+            if df is None:
+                engine = get_engine(database_path)
+                start = time.perf_counter()
+                df = engine.execute(query, max_rows, timeout, max_instructions)
+                sql_span.set(engine=engine.name, sql_ms=(time.perf_counter() - start) * 1000)
+                _result_cache.put(database_path, fingerprint, normalized, max_rows, df)
+        except Exception as e:
+            df = pd.DataFrame()
+            df.attrs["error"] = str(e)
+            sql_span.error = str(e)
+        sql_span.set(rows=len(df), truncated=bool(df.attrs.get("truncated", False)))
+        return df
+
+
+def validate_sql(query: str, database_path: str) -> Optional[str]:
+    """
+    用工作区的查询引擎编译sql(EXPLAIN, 不执行)并检查查询计划, 返回错误信息, 没有错误时返回None
+    """
+    return get_engine(database_path).validate(query)
+
+
+def result_cache_stats() -> Dict[str, int]:
+    """
+    查询结果缓存统计
+    """
+    return _result_cache.stats()
@@ -0,0 +1,275 @@
+import os
+import re
+import sqlite3
+import threading
+import pandas as pd
+from typing import Dict, Optional, Union
+from .pool_utils import connect
+from .index_utils import serving_path
+from .guard_utils import check_query_plan, query_guard, QueryRejected, CARTESIAN_ROW_LIMIT, QUERY_TIMEOUT, QUERY_MAX_INSTRUCTIONS
+from .profile_utils import is_sidecar
+from .result_utils import fetch_dataframe, MAX_RESULT_ROWS, RESULT_BATCH_SIZE
+from .str_utils import quote_identifier
+
+try:
+    import duckdb
+    import pyarrow as pa
+except ImportError:
+    duckdb = pa = None
+
+ENGINES = ("sqlite", "duckdb")
+DEFAULT_ENGINE = "sqlite"
+PARQUET_SUFFIX = ".parquet"
+PARQUET_CHUNK_ROWS = 10 ** 6
+DUCKDB_THREADS = os.cpu_count() or 1
+DUCKDB_MEMORY_LIMIT = "2GB"
+
+
+def parquet_dir(database_path: str) -> str:
+    """
+    工作区数据库对应的Parquet目录, 每张表一个子目录
+    """
+    return database_path + PARQUET_SUFFIX
+
+
+def engine_available(name: str) -> bool:
+    """
+    查询引擎是否可用, DuckDB是可选依赖
+    """
+    return name == "sqlite" or (name == "duckdb" and duckdb is not None)
+
+
+def _write_parquet(chunk: pd.DataFrame, path: str) -> None:
+    """
+    写入一块数据, 混合类型的列转为文本
+    """
+    try:
+        chunk.to_parquet(path, index=False)
+    except (pa.ArrowException, ValueError, TypeError):
+        for column in chunk.columns[chunk.dtypes == object]:
+            chunk[column] = chunk[column].map(lambda value: None if value is None else str(value))
+        chunk.to_parquet(path, index=False)
+
+
+def export_parquet(database_path: str, target_dir: str, chunk_rows: int=PARQUET_CHUNK_ROWS) -> Dict[str, int]:
+    """
+    把数据库中除附属表外的每张表(视图按其结果)按块导出为 <target_dir>/<序号>/<块号>.parquet, 返回每张表的行数
+
+    各块的列类型可能不同(如整数块与含小数的块), 读取时由DuckDB按列名合并并提升类型
+    """
+    os.makedirs(target_dir)
+    rows = {}
+    conn = sqlite3.connect(f"file:{os.path.abspath(database_path)}?mode=ro", uri=True)
+    try:
+        tables = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name;") if not is_sidecar(name)]
+        for i, table in enumerate(tables):
+            table_dir = os.path.join(target_dir, str(i))
+            os.makedirs(table_dir)
+            n_rows, n_chunks = 0, 0
+            for chunk in pd.read_sql_query(f"SELECT * FROM {quote_identifier(table)};", conn, chunksize=chunk_rows):
+                _write_parquet(chunk, os.path.join(table_dir, f"{n_chunks}.parquet"))
+                n_rows += len(chunk)
+                n_chunks += 1
+            if not n_chunks:
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quote_identifier(table)});")]
+                pd.DataFrame({column: pd.Series(dtype=object) for column in columns}).to_parquet(os.path.join(table_dir, "0.parquet"), index=False)
+            with open(os.path.join(table_dir, "table.txt"), "w", encoding="utf-8") as fp:
+                fp.write(table)
+            rows[table] = n_rows
+    finally:
+        conn.close()
+    return rows
+
+
+class SQLiteEngine:
+    """
+    SQLite查询引擎: 从连接池借用只读连接, 用查询计划拒绝笛卡尔积, 执行中限制耗时与虚拟机指令数
+
+    存在自动索引的副本时在副本上查询
+    """
+    name = "sqlite"
+    dialect = "SQLite"
+
+    def __init__(self, database_path: str):
+        self.database_path = database_path
+
+    def validate(self, query: str) -> Optional[str]:
+        """
+        编译sql(EXPLAIN, 不执行)并检查查询计划, 返回错误信息, 没有错误时返回None
+        """
+        try:
+            with connect(serving_path(self.database_path)) as conn:
+                conn.execute(f"EXPLAIN {query}").fetchall()
+                check_query_plan(conn, query)
+            return None
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            return str(e)
+
+    def execute(self, query: str, max_rows: int=MAX_RESULT_ROWS, timeout: float=QUERY_TIMEOUT,
+                max_instructions: int=QUERY_MAX_INSTRUCTIONS) -> pd.DataFrame:
+        """
+        执行sql语句, 结果超过max_rows行时截断并设置 df.attrs["truncated"]
+        """
+        with connect(serving_path(self.database_path)) as conn:
+            check_query_plan(conn, query)
+            cursor = conn.cursor()
+            try:
+                with query_guard(conn, timeout, max_instructions):
+                    cursor.execute(query)
+                    return fetch_dataframe(cursor, max_rows)
+            finally:
+                cursor.close()
+
+    def close(self) -> None:
+        """
+        连接由连接池管理, 这里无需释放
+        """
+
+
+class DuckDBEngine:
+    """
+    DuckDB查询引擎: 在内存数据库中为每张表创建读取Parquet目录的视图, 列式执行聚合查询
+
+    连接只能读取工作区的Parquet目录, 配置在创建视图后锁定; 只允许单条SELECT语句,
+    计划中包含行数乘积超过上限的CROSS_PRODUCT时拒绝, 超时后中断查询
+    """
+    name = "duckdb"
+    dialect = "DuckDB"
+
+    def __init__(self, database_path: str):
+        self.database_path = database_path
+        self.directory = os.path.abspath(parquet_dir(database_path))
+        self.rows: Dict[str, int] = {}
+        self._conn = duckdb.connect(":memory:", config={"threads": DUCKDB_THREADS, "memory_limit": DUCKDB_MEMORY_LIMIT})
+        self._lock = threading.Lock()
+        for name in sorted(os.listdir(self.directory)):
+            table_dir = os.path.join(self.directory, name)
+            with open(os.path.join(table_dir, "table.txt"), encoding="utf-8") as fp:
+                table = fp.read()
+            pattern = os.path.join(table_dir, "*.parquet").replace("'", "''")
+            self._conn.execute(f"CREATE VIEW {quote_identifier(table)} AS SELECT * FROM read_parquet('{pattern}', union_by_name=true);")
+            self.rows[table.lower()] = self._conn.execute(f"SELECT COUNT(*) FROM {quote_identifier(table)};").fetchone()[0]
+        directory = self.directory.replace("'", "''")
+        self._conn.execute(f"SET allowed_directories=['{directory}'];")
+        self._conn.execute("SET enable_external_access=false;")
+        self._conn.execute("SET lock_configuration=true;")
+
+    def _check(self, cursor: "duckdb.DuckDBPyConnection", query: str, row_limit: int=CARTESIAN_ROW_LIMIT) -> None:
+        """
+        只允许单条SELECT语句, 并拒绝行数乘积超过row_limit的笛卡尔积
+        """
+        statements = duckdb.extract_statements(query)
+        if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+            raise QueryRejected("Query rejected: only a single SELECT statement is allowed")
+        plan = "\n".join(str(row[-1]) for row in cursor.execute(f"EXPLAIN {query}").fetchall())
+        if "CROSS_PRODUCT" not in plan:
+            return
+        tables = [table for table in self.rows if re.search(r"\b" + re.escape(table) + r"\b", query, re.IGNORECASE)]
+        product = 1
+        for table in tables:
+            product *= max(self.rows[table], 1)
+        if len(tables) > 1 and product > row_limit:
+            raise QueryRejected(f"Query rejected: the plan joins {', '.join(tables)} without a join condition "
+                                f"(about {product:,} row combinations). Add join conditions or filters.")
+
+    def _cursor(self) -> "duckdb.DuckDBPyConnection":
+        """
+        为当前线程创建游标, 共享视图定义
+        """
+        with self._lock:
+            return self._conn.cursor()
+
+    def validate(self, query: str) -> Optional[str]:
+        """
+        编译sql(EXPLAIN, 不执行)并检查语句类型与查询计划, 返回错误信息, 没有错误时返回None
+        """
+        cursor = self._cursor()
+        try:
+            self._check(cursor, query)
+            return None
+        except (duckdb.Error, QueryRejected) as e:
+            return str(e)
+        finally:
+            cursor.close()
+
+    def execute(self, query: str, max_rows: int=MAX_RESULT_ROWS, timeout: float=QUERY_TIMEOUT,
+                max_instructions: int=QUERY_MAX_INSTRUCTIONS) -> pd.DataFrame:
+        """
+        执行sql语句, 按批读取Arrow结果, 超过max_rows行时截断并设置 df.attrs["truncated"]
+
+        DuckDB没有虚拟机指令数, max_instructions不起作用, 只限制墙钟时间
+        """
+        cursor = self._cursor()
+        state = {"timed_out": False}
+
+        def interrupt() -> None:
+            state["timed_out"] = True
+            cursor.interrupt()
+
+        timer = threading.Timer(timeout, interrupt)
+        try:
+            self._check(cursor, query)
+            timer.start()
+            try:
+                reader = cursor.execute(query).fetch_record_batch(RESULT_BATCH_SIZE)
+                batches, n_rows, truncated = [], 0, False
+                for batch in reader:
+                    if n_rows + batch.num_rows > max_rows:
+                        batches.append(batch.slice(0, max_rows - n_rows))
+                        truncated = True
+                        break
+                    batches.append(batch)
+                    n_rows += batch.num_rows
+                df = pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+            except duckdb.InterruptException as e:
+                if state["timed_out"]:
+                    raise QueryRejected(f"Query aborted: exceeded the time budget of {timeout:g}s") from e
+                raise
+        finally:
+            timer.cancel()
+            cursor.close()
+        df.attrs["truncated"] = truncated
+        df.attrs["max_rows"] = max_rows
+        return df
+
+    def close(self) -> None:
+        """
+        关闭内存数据库
+        """
+        with self._lock:
+            self._conn.close()
+
+
+QueryEngine = Union[SQLiteEngine, DuckDBEngine]
+
+_engines: Dict[str, QueryEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(database_path: str) -> QueryEngine:
+    """
+    获取工作区的查询引擎: 存在Parquet目录且安装了DuckDB时使用DuckDB, 否则使用SQLite
+    """
+    key = os.path.abspath(database_path)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            if engine_available("duckdb") and os.path.isdir(parquet_dir(database_path)):
+                engine = DuckDBEngine(database_path)
+            else:
+                engine = SQLiteEngine(database_path)
+            _engines[key] = engine
+        return engine
+
+
+def close_engine(path: str) -> None:
+    """
+    关闭数据库(或其Parquet目录)对应的查询引擎
+    """
+    path = os.path.abspath(path)
+    if path.endswith(PARQUET_SUFFIX):
+        path = path[:-len(PARQUET_SUFFIX)]
+    with _engines_lock:
+        engine = _engines.pop(path, None)
+    if engine is not None:
+        engine.close()
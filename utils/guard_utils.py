@@ -0,0 +1,95 @@
+import re
+import time
+import sqlite3
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+from .str_utils import quote_identifier, table_aliases
+
+QUERY_TIMEOUT = 30.0
+QUERY_MAX_INSTRUCTIONS = 2 * 10 ** 9
+PROGRESS_INTERVAL = 10000
+CARTESIAN_ROW_LIMIT = 10 ** 8
+
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\S+)(?: AS (\S+))?")
+
+
+class QueryRejected(sqlite3.Error):
+    """
+    查询被执行守卫拒绝或中止
+    """
+
+
+def _table_rows(conn: sqlite3.Connection, table: str) -> Optional[int]:
+    """
+    用 MAX(rowid) 快速估算表行数, 不是普通表时返回None
+    """
+    try:
+        return conn.execute(f"SELECT MAX(rowid) FROM {quote_identifier(table)};").fetchone()[0] or 0
+    except sqlite3.Error:
+        return None
+
+
+def _max_table_rows(conn: sqlite3.Connection) -> int:
+    """
+    数据库中最大的表的估计行数, 用于估算无法对应到表的扫描(子查询、CTE等)
+    """
+    tables = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+    return max([_table_rows(conn, table) or 0 for table in tables], default=0)
+
+
+def check_query_plan(conn: sqlite3.Connection, query: str, row_limit: int=CARTESIAN_ROW_LIMIT) -> None:
+    """
+    用 EXPLAIN QUERY PLAN 检查查询, 同一层循环中对多张表做全表扫描且行数乘积超过row_limit时视为笛卡尔积并拒绝
+
+    计划中的表名可能是别名, 先按FROM/JOIN子句映射回真实表; 仍无法对应到表的扫描按最大的表估算行数
+    """
+    aliases = table_aliases(query)
+    loops: Dict[int, List[str]] = defaultdict(list)
+    for _, parent, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {query}").fetchall():
+        if detail.startswith("SCAN CONSTANT ROW"):
+            continue
+        match = _SCAN.match(detail)
+        if match:
+            name = match.group(1).strip('"')
+            loops[parent].append(aliases.get(name.lower(), name))
+    for tables in loops.values():
+        if len(tables) < 2:
+            continue
+        rows = [_table_rows(conn, table) for table in tables]
+        if None in rows:
+            estimate = _max_table_rows(conn)
+            rows = [estimate if n is None else n for n in rows]
+        product = 1
+        for n in rows:
+            product *= max(n, 1)
+        if product > row_limit:
+            raise QueryRejected(f"Query rejected: the plan scans {', '.join(tables)} in nested loops without a join "
+                                f"condition (about {product:,} row combinations). Add join conditions or filters.")
+
+
+@contextmanager
+def query_guard(conn: sqlite3.Connection, timeout: float=QUERY_TIMEOUT, max_instructions: int=QUERY_MAX_INSTRUCTIONS) -> Iterator[None]:
+    """
+    在with块内限制查询的墙钟时间与虚拟机指令数, 超出时中止查询并抛出QueryRejected
+    """
+    deadline = time.monotonic() + timeout
+    state = {"instructions": 0, "reason": None}
+
+    def progress() -> int:
+        state["instructions"] += PROGRESS_INTERVAL
+        if state["instructions"] > max_instructions:
+            state["reason"] = f"Query aborted: exceeded the budget of {max_instructions:,} VM instructions"
+        elif time.monotonic() > deadline:
+            state["reason"] = f"Query aborted: exceeded the time budget of {timeout:g}s"
+        return 1 if state["reason"] else 0
+
+    conn.set_progress_handler(progress, PROGRESS_INTERVAL)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if state["reason"]:
+            raise QueryRejected(state["reason"]) from e
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
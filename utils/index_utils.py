@@ -0,0 +1,304 @@
+import os
+import re
+import uuid
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from .pool_utils import close_pool
+from .schema_utils import get_schema
+from .str_utils import quote_identifier, table_aliases
+
+logger = logging.getLogger(__name__)
+
+INDEX_PREFIX = "auto_idx_"
+INDEX_SUFFIX = ".indexes"
+HOT_QUERY_THRESHOLD = 2
+MAX_INDEX_COLUMNS = 4
+# 索引副本与其中的索引合计占用的磁盘不超过数据库大小的倍数
+INDEX_BUDGET_RATIO = 1.5
+
+_TOKEN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]|[A-Za-z_][A-Za-z0-9_$]*|\S")
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\S+)(?: AS (\S+))?$")
+_USING_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\S+)")
+_CLAUSES = {"WHERE": "filter", "ON": "filter", "HAVING": "other", "ORDER": "other", "LIMIT": "other",
+            "SELECT": "select", "FROM": "other", "JOIN": "other", "UNION": "other", "GROUP": "group"}
+
+
+def _unquote(token: str) -> str:
+    """
+    去掉标识符的引号
+    """
+    if token[:1] in ('"', '`', '['):
+        return token[1:-1].replace('""', '"')
+    return token
+
+
+def referenced_columns(sql: str) -> Dict[str, List[str]]:
+    """
+    按子句收集SQL中出现的标识符, 返回 {"filter": [...], "group": [...], "select": [...], "other": [...]}
+    """
+    result: Dict[str, List[str]] = {"filter": [], "group": [], "select": [], "other": []}
+    clause = "other"
+    for token in _TOKEN.findall(sql):
+        upper = token.upper()
+        if upper in _CLAUSES:
+            clause = _CLAUSES[upper]
+            continue
+        if token.startswith("'") or not (token[0].isalpha() or token[0] in ('_', '"', '`', '[')):
+            continue
+        result[clause].append(_unquote(token).lower())
+    return result
+
+
+def index_name(table: str, columns: Tuple[str, ...]) -> str:
+    """
+    生成自动索引名
+    """
+    name = re.sub(r"\W+", "_", f"{table}_{'_'.join(columns)}").strip("_").lower()
+    if len(name) > 48:
+        name = name[:32] + "_" + hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return INDEX_PREFIX + name
+
+
+def indexed_path(database_path: str) -> str:
+    """
+    数据库的索引副本路径
+    """
+    return database_path + INDEX_SUFFIX
+
+
+def serving_path(database_path: str) -> str:
+    """
+    执行查询时使用的数据库: 存在索引副本时使用副本, 否则使用数据库本身
+
+    副本与数据库的数据相同, 只多了自动索引, 因此查询结果与按数据库指纹建立的缓存都不受影响
+    """
+    path = indexed_path(database_path)
+    return path if os.path.exists(path) else database_path
+
+
+class IndexAdvisor:
+    """
+    根据生成的SQL负载为数据库自动创建索引
+
+    记录每条查询的 EXPLAIN QUERY PLAN, 对全表扫描的表提取过滤/连接/分组列,
+    同一组列被多次使用后在后台创建(尽量覆盖查询的)索引.
+    工作区在会话间共享且按内容寻址, 不能原地修改: 索引建在数据库的副本(indexed_path)中,
+    第一次建索引时复制数据库、建索引后原子替换到位, 之后的索引直接建在这个副本中; 查询引擎通过 serving_path 使用副本.
+    磁盘预算同时计入副本与索引的大小
+    """
+
+    def __init__(self, database_path: str):
+        self.database_path = database_path
+        self.path = indexed_path(database_path)
+        self.size = os.path.getsize(database_path)
+        self.budget = int(self.size * INDEX_BUDGET_RATIO)
+        self.used = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.candidates: Counter = Counter()
+        self.speedups: Counter = Counter()
+        self._lock = threading.Lock()
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-advisor")
+
+    def record(self, sql: str) -> Future:
+        """
+        在后台分析一条查询
+        """
+        return self._worker.submit(self._analyze, sql)
+
+    def close(self, wait: bool=False) -> None:
+        """
+        停止后台分析, 尚未开始的任务被取消; wait为True时等待进行中的任务完成
+        """
+        self._worker.shutdown(wait=wait, cancel_futures=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        以只读方式打开当前使用的数据库(存在副本时为副本)
+        """
+        return sqlite3.connect(f"file:{os.path.abspath(serving_path(self.database_path))}?mode=ro", uri=True, timeout=30)
+
+    def _analyze(self, sql: str) -> None:
+        """
+        分析查询计划, 必要时创建索引
+        """
+        try:
+            conn = self._connect()
+            try:
+                plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+                with self._lock:
+                    for detail in plan:
+                        match = _USING_INDEX.search(detail)
+                        if match and match.group(1).startswith(INDEX_PREFIX):
+                            self.speedups[match.group(1)] += 1
+                hot = []
+                for table, columns in self._candidates(sql, plan):
+                    with self._lock:
+                        self.candidates[(table, columns)] += 1
+                        if self.candidates[(table, columns)] >= HOT_QUERY_THRESHOLD:
+                            hot.append((table, columns))
+                indexes, reserved = self._reserve(conn, list(dict.fromkeys(hot)))
+            finally:
+                conn.close()
+            if indexes:
+                try:
+                    self._create_indexes(indexes)
+                except BaseException:
+                    self._release(reserved)
+                    raise
+        except sqlite3.Error as e:
+            logger.info(f"Index advisor skipped query: {e}")
+
+    def _candidates(self, sql: str, plan: List[str]) -> List[Tuple[str, Tuple[str, ...]]]:
+        """
+        为全表扫描的表挑选索引列: 过滤/连接列在前, 分组列在后, 列数允许时补齐其余引用列以覆盖查询
+
+        查询计划中有别名的表只显示别名, 按SQL中的FROM/JOIN子句映射回真实表
+        """
+        schema = get_schema(self.database_path)
+        columns = referenced_columns(sql)
+        aliases = table_aliases(sql)
+        candidates = []
+        for detail in plan:
+            match = _SCAN.match(detail)
+            if match is None:
+                continue
+            name = _unquote(match.group(1))
+            table = schema.table(aliases.get(name.lower(), name))
+            if table is None:
+                continue
+            names = {column.name.lower(): column.name for column in table.columns}
+            keys = list(dict.fromkeys(names[c] for c in columns["filter"] + columns["group"] if c in names))
+            if not keys:
+                continue
+            covering = list(dict.fromkeys(keys + [names[c] for c in columns["select"] + columns["other"] if c in names]))
+            if len(covering) <= MAX_INDEX_COLUMNS:
+                keys = covering
+            candidates.append((table.name, tuple(keys[:MAX_INDEX_COLUMNS])))
+        return candidates
+
+    def _reserve(self, conn: sqlite3.Connection, hot: List[Tuple[str, Tuple[str, ...]]]) -> Tuple[List[Tuple[str, Tuple[str, ...]]], int]:
+        """
+        为尚不存在的索引在磁盘预算内预留空间, 还没有副本时第一个索引同时预留副本的大小, 返回 (可创建的索引, 预留的字节数)
+        """
+        indexes, reserved = [], 0
+        try:
+            for table, columns in hot:
+                name = index_name(table, columns)
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?;", (name,)).fetchone():
+                    continue
+                lengths = " + ".join(f"COALESCE(AVG(LENGTH({quote_identifier(c)})), 0)" for c in columns)
+                n_rows, avg_bytes = conn.execute(f"SELECT COUNT(*), {lengths} FROM {quote_identifier(table)};").fetchone()
+                estimate = int(n_rows * (avg_bytes + 16))
+                if not indexes and not os.path.exists(self.path):
+                    estimate += self.size
+                with self._lock:
+                    if self.used + estimate > self.budget:
+                        logger.info(f"Index advisor: {name} ({estimate} bytes) exceeds disk budget")
+                        continue
+                    self.used += estimate
+                reserved += estimate
+                indexes.append((table, columns))
+        except BaseException:
+            self._release(reserved)
+            raise
+        return indexes, reserved
+
+    def _release(self, reserved: int) -> None:
+        """
+        索引创建失败时归还预留的预算
+        """
+        with self._lock:
+            self.used -= reserved
+
+    def _create_indexes(self, indexes: List[Tuple[str, Tuple[str, ...]]]) -> None:
+        """
+        创建索引: 已有副本时直接在副本中创建; 否则复制数据库, 在临时文件中建好索引后原子重命名为副本
+        """
+        statements = [f"CREATE INDEX IF NOT EXISTS {quote_identifier(index_name(table, columns))} ON {quote_identifier(table)} "
+                      f"({', '.join(quote_identifier(c) for c in columns)});" for table, columns in indexes]
+        if os.path.exists(self.path):
+            conn = sqlite3.connect(self.path, timeout=30)
+            try:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.commit()
+            finally:
+                conn.close()
+        else:
+            directory, name = os.path.split(os.path.abspath(self.path))
+            temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+            try:
+                source = sqlite3.connect(f"file:{os.path.abspath(self.database_path)}?mode=ro", uri=True, timeout=30)
+                target = sqlite3.connect(temp_path)
+                try:
+                    source.backup(target)
+                    for statement in statements:
+                        target.execute(statement)
+                    target.commit()
+                finally:
+                    source.close()
+                    target.close()
+                os.replace(temp_path, self.path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        for table, columns in indexes:
+            logger.info(f"Index advisor: created {index_name(table, columns)} on {table}({', '.join(columns)})")
+
+    def report(self) -> List[Dict[str, Any]]:
+        """
+        列出自动创建的索引及其加速过的查询数
+        """
+        conn = self._connect()
+        try:
+            indexes = conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type='index' AND name LIKE ?;",
+                                   (INDEX_PREFIX + "%",)).fetchall()
+            report = []
+            for name, table in indexes:
+                columns = [row[2] for row in conn.execute(f"PRAGMA index_info({quote_identifier(name)});")]
+                with self._lock:
+                    report.append({"index": name, "table": table, "columns": ", ".join(columns), "queries": self.speedups[name]})
+            return report
+        finally:
+            conn.close()
+
+
+_advisors: Dict[str, IndexAdvisor] = {}
+_advisors_lock = threading.Lock()
+
+
+def get_advisor(database_path: str) -> IndexAdvisor:
+    """
+    获取数据库对应的索引顾问
+    """
+    key = os.path.abspath(database_path)
+    with _advisors_lock:
+        if key not in _advisors:
+            _advisors[key] = IndexAdvisor(database_path)
+        return _advisors[key]
+
+
+def record_query(sql: Optional[str], database_path: str) -> None:
+    """
+    记录生成的SQL, 供索引顾问分析
+    """
+    if sql:
+        get_advisor(database_path).record(sql)
+
+
+def drop_advisor(database_path: str) -> None:
+    """
+    工作区数据库建成或被淘汰后丢弃对应的索引顾问与索引副本; 等待进行中的任务结束, 以免旧副本在删除后被重新写入
+    """
+    with _advisors_lock:
+        advisor = _advisors.pop(os.path.abspath(database_path), None)
+    if advisor is not None:
+        advisor.close(wait=True)
+    path = indexed_path(database_path)
+    close_pool(path)
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,284 @@
+import re
+import time
+import logging
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from .str_utils import quote_identifier, rename_tables
+from .profile_utils import TableProfiler, is_sidecar, merge_profiles
+
+logger = logging.getLogger(__name__)
+
+INGEST_CHUNK_SIZE = 50000
+
+Progress = Callable[[int, float, Optional[float]], None]
+
+
+def sqlite_affinity(series: pd.Series) -> str:
+    """
+    根据pandas列类型推断SQLite列类型
+    """
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(series):
+        return "REAL"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "TIMESTAMP"
+    return "TEXT"
+
+
+def _to_sql_value(value: Any) -> Any:
+    """
+    将sqlite3无法直接绑定的值转换为字符串
+    """
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return value
+    if isinstance(value, (datetime.datetime, pd.Timestamp)):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _column_values(series: pd.Series) -> List[Any]:
+    """
+    将一列转换为可绑定到sqlite3的Python值, 缺失值转为None
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        series = series.dt.strftime("%Y-%m-%d %H:%M:%S")
+    values = series.astype(object).where(series.notna(), None)
+    if pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+        values = values.map(_to_sql_value)
+    return values.tolist()
+
+
+def dedup_columns(columns: Iterable[Any]) -> List[str]:
+    """
+    规范化列名: 空列名补全, 重复列名追加序号
+    """
+    result, seen = [], {}
+    for i, column in enumerate(columns):
+        name = str(column).strip() if column is not None and str(column).strip() else f"Unnamed: {i}"
+        if name.lower() in seen:
+            seen[name.lower()] += 1
+            name = f"{name}.{seen[name.lower()]}"
+        seen.setdefault(name.lower(), 0)
+        result.append(name)
+    return result
+
+
+def iter_csv_chunks(file: BinaryIO, chunksize: int=INGEST_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    分块读取CSV
+    """
+    with pd.read_csv(file, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def iter_excel_chunks(file: BinaryIO, ext: str, sheet_name: Any=0, chunksize: int=INGEST_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    分块读取Excel工作表, xlsx/xlsm 使用 openpyxl 只读模式逐行读取, 其它格式整表读取后分块
+    """
+    if ext not in ["xlsx", "xlsm"]:
+        df = pd.read_excel(file, sheet_name=sheet_name)
+        for start in range(0, max(len(df), 1), chunksize):
+            yield df.iloc[start:start + chunksize]
+        return
+    from openpyxl import load_workbook
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = dedup_columns(header)
+        padding = (None,) * len(columns)
+        buffer, yielded = [], False
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            buffer.append((row + padding)[:len(columns)])
+            if len(buffer) >= chunksize:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer, yielded = [], True
+        if buffer or not yielded:
+            yield pd.DataFrame(buffer, columns=columns)
+    finally:
+        workbook.close()
+
+
+def ingest_chunks(chunks: Iterable[pd.DataFrame], database_path: str, table_name: str, progress: Optional[Progress]=None,
+                  fraction: Optional[Callable[[], Optional[float]]]=None, profile: bool=True) -> int:
+    """
+    将分块数据流式写入SQLite
+
+    表结构由第一块数据推断, 只创建一次; 所有数据在同一个事务中用executemany批量插入,
+    写入期间关闭日志与同步. profile为True时同时逐块计算列画像并写入附属表. 返回写入的行数
+    """
+    conn = sqlite3.connect(database_path, isolation_level=None)
+    start = time.perf_counter()
+    n_rows = 0
+    try:
+        conn.execute("PRAGMA journal_mode=OFF;")
+        conn.execute("PRAGMA synchronous=OFF;")
+        conn.execute("BEGIN;")
+        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)};")
+        insert = None
+        profiler = TableProfiler(table_name) if profile else None
+        for chunk in chunks:
+            if insert is None:
+                chunk.columns = dedup_columns(chunk.columns)
+                columns = list(chunk.columns)
+                definitions = ",\n".join(f"  {quote_identifier(c)} {sqlite_affinity(chunk[c])}" for c in columns)
+                conn.execute(f"CREATE TABLE {quote_identifier(table_name)} (\n{definitions}\n);")
+                insert = f"INSERT INTO {quote_identifier(table_name)} VALUES ({', '.join('?' * len(columns))});"
+            else:
+                chunk.columns = columns
+            if len(chunk):
+                conn.executemany(insert, zip(*(_column_values(chunk.iloc[:, i]) for i in range(len(columns)))))
+                n_rows += len(chunk)
+            if profiler is not None:
+                profiler.update(chunk)
+            if progress:
+                elapsed = time.perf_counter() - start
+                progress(n_rows, n_rows / elapsed if elapsed > 0 else 0.0, fraction() if fraction else None)
+        if profiler is not None:
+            profiler.write(conn)
+        conn.execute("COMMIT;")
+    except:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK;")
+        raise
+    finally:
+        conn.close()
+    return n_rows
+
+
+def stream_fraction(file: BinaryIO, size: Optional[int]=None) -> Callable[[], Optional[float]]:
+    """
+    根据文件读取位置估算进度
+    """
+    size = size or getattr(file, "size", None)
+
+    def fraction() -> Optional[float]:
+        try:
+            return min(file.tell() / size, 1.0) if size else None
+        except (OSError, ValueError):
+            return None
+    return fraction
+
+
+def list_sheets(source_path: str, ext: str) -> List[Any]:
+    """
+    列出文件中的所有工作表, CSV视为只有一个工作表
+    """
+    if ext == "csv":
+        return [0]
+    if ext in ["xlsx", "xlsm"]:
+        from openpyxl import load_workbook
+        workbook = load_workbook(source_path, read_only=True)
+        try:
+            return list(workbook.sheetnames)
+        finally:
+            workbook.close()
+    return list(pd.ExcelFile(source_path).sheet_names)
+
+
+def ingest_sheet(source_path: str, ext: str, sheet_name: Any, table_name: str, database_path: str) -> Tuple[str, int, float]:
+    """
+    将单个工作表写入独立的SQLite文件, 供工作进程并行调用
+
+    返回 (表名, 行数, 耗时)
+    """
+    start = time.perf_counter()
+    with open(source_path, "rb") as fp:
+        chunks = iter_csv_chunks(fp) if ext == "csv" else iter_excel_chunks(fp, ext, sheet_name)
+        n_rows = ingest_chunks(chunks, database_path, table_name)
+    return table_name, n_rows, time.perf_counter() - start
+
+
+_IDENTIFIER = r'(?:"(?:[^"]|"")*"|\[[^\]]*\]|`[^`]*`|[^\s(.]+)'
+
+
+def rename_create_statement(create_sql: str, table_name: str) -> str:
+    """
+    替换CREATE TABLE语句中的表名
+    """
+    pattern = rf'^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(?:{_IDENTIFIER}\s*\.\s*)?{_IDENTIFIER}'
+    return re.sub(pattern, lambda m: f"CREATE TABLE {quote_identifier(table_name)}", create_sql, count=1, flags=re.IGNORECASE)
+
+
+def rename_index_statement(create_sql: str, index_name: str, table_name: str) -> str:
+    """
+    替换CREATE INDEX语句中的索引名与表名
+    """
+    pattern = rf'^\s*CREATE\s+(UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(?:{_IDENTIFIER}\s*\.\s*)?{_IDENTIFIER}\s+ON\s+{_IDENTIFIER}'
+    return re.sub(pattern, lambda m: f"CREATE {m.group(1) or ''}INDEX {quote_identifier(index_name)} ON {quote_identifier(table_name)}",
+                  create_sql, count=1, flags=re.IGNORECASE)
+
+
+def rename_view_statement(create_sql: str, view_name: str, tables: Dict[str, str]) -> str:
+    """
+    替换CREATE VIEW语句中的视图名, 并按tables(键为小写的原表名)替换其引用的表名
+    """
+    pattern = rf'^\s*CREATE\s+(?:TEMP\s+|TEMPORARY\s+)?VIEW\s+(?:IF\s+NOT\s+EXISTS\s+)?(?:{_IDENTIFIER}\s*\.\s*)?{_IDENTIFIER}'
+    create_sql = re.sub(pattern, lambda m: f"CREATE VIEW {quote_identifier(view_name)}", create_sql, count=1, flags=re.IGNORECASE)
+    return rename_tables(create_sql, tables)
+
+
+def merge_database(conn: sqlite3.Connection, part_path: str, prefix: str, rename: Optional[Dict[str, str]]=None) -> List[str]:
+    """
+    将part_path中的所有表合并到conn对应的数据库, rename指定的表先改名, 重名的表加上prefix前缀, 列画像随之合并
+
+    表上的索引与视图一并复制, 重名时同样加上前缀, 视图中引用的表名随表改名; 无法查询的视图(如引用了不存在的表)被跳过.
+    返回合并后的表名
+    """
+    conn.execute("ATTACH DATABASE ? AS part;", (part_path,))
+    try:
+        tables = conn.execute("SELECT name, sql FROM part.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';").fetchall()
+        existing = {name.lower() for name, in conn.execute("SELECT name FROM main.sqlite_master;")}
+
+        def unique_name(name: str) -> str:
+            while name.lower() in existing:
+                name = f"{prefix}_{name}"
+            existing.add(name.lower())
+            return name
+
+        merged = {}
+        for name, create_sql in tables:
+            if is_sidecar(name):
+                continue
+            target = unique_name((rename or {}).get(name, name))
+            conn.execute(rename_create_statement(create_sql, target))
+            conn.execute(f"INSERT INTO main.{quote_identifier(target)} SELECT * FROM part.{quote_identifier(name)};")
+            merged[name] = target
+        renamed = {name.lower(): target for name, target in merged.items()}
+        objects = conn.execute("SELECT type, name, tbl_name, sql FROM part.sqlite_master "
+                               "WHERE type IN ('index', 'view') AND sql IS NOT NULL ORDER BY rowid;").fetchall()
+        for type_, name, table, create_sql in objects:
+            if type_ == "index":
+                if table in merged:
+                    conn.execute(rename_index_statement(create_sql, unique_name(name), merged[table]))
+                continue
+            target = unique_name(name)
+            conn.execute(rename_view_statement(create_sql, target, renamed))
+            try:
+                conn.execute(f"SELECT * FROM main.{quote_identifier(target)} LIMIT 0;").fetchall()
+            except sqlite3.OperationalError as e:
+                conn.execute(f"DROP VIEW main.{quote_identifier(target)};")
+                existing.discard(target.lower())
+                logger.info(f"Skipped view {name}: {e}")
+                continue
+            renamed[name.lower()] = target
+        merge_profiles(conn, merged)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DETACH DATABASE part;")
+    return list(merged.values())
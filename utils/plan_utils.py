@@ -0,0 +1,177 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional, Set
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from .chat_utils import thread_handler, cancel_scope
+from .trace_utils import current_span, span, trace_scope
+
+logger = logging.getLogger(__name__)
+
+
+def step_dependencies(step: Any, steps: List[Any]) -> Set[int]:
+    """
+    计算计划步骤依赖的前序步骤(下标)
+    """
+    operation = step["operation"]
+    if operation == "sql_gen":
+        return set()
+    if operation == "visualization":
+        data_source = step["parameters"]["data_source"]
+        return {i for i, s in enumerate(steps) if s["operation"] == "sql_gen" and s["step"] in data_source}
+    return set(range(len(steps)))
+
+
+class PlanExecutor:
+    """
+    按依赖关系并行执行计划步骤
+
+    步骤在线程池中执行, 但结果只由调用 join 的线程按步骤顺序写回, 保证写入确定性.
+    步骤可以在计划仍在生成时陆续追加; 放弃执行(cancel)时通知进行中的LLM请求中止
+    """
+
+    def __init__(self, run_step: Callable[[Any], Dict[str, Any]], max_workers: int = 4):
+        ctx = get_script_run_ctx()
+        self._run_step = run_step
+        self._parent = current_span()
+        self._pool = ThreadPoolExecutor(max_workers=max(max_workers, 1),
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+        self._steps: List[Any] = []
+        self._handlers: List[Any] = []
+        self._dependencies: List[Set[int]] = []
+        self._futures: Dict[Future, int] = {}
+        self._started: Set[int] = set()
+        self._done: Set[int] = set()
+        self._closed = False
+        self._cancelled = threading.Event()
+        self._start = time.perf_counter()
+        self.timings: List[Dict[str, Any]] = []
+
+    def add(self, step: Any, handler: Optional[Any] = None) -> None:
+        """
+        追加一个步骤, 依赖满足时立即开始执行
+        """
+        if self._closed:
+            raise RuntimeError("PlanExecutor is closed")
+        self._dependencies.append(step_dependencies(step, self._steps))
+        self._steps.append(step)
+        self._handlers.append(handler)
+        self._schedule()
+
+    def __len__(self) -> int:
+        """
+        已追加的步骤数
+        """
+        return len(self._steps)
+
+    def close(self) -> None:
+        """
+        标记步骤已全部追加
+        """
+        self._closed = True
+
+    def join(self) -> List[Dict[str, Any]]:
+        """
+        等待所有步骤完成, 按步骤顺序写回结果, 返回每个步骤的耗时
+        """
+        self.close()
+        self._schedule()
+        try:
+            while len(self._done) < len(self._steps):
+                if not self._futures:
+                    raise RuntimeError("Plan has unsatisfiable step dependencies")
+                finished, _ = wait(list(self._futures), return_when=FIRST_COMPLETED)
+                for idx, outcome in sorted((self._futures.pop(f), f.result()) for f in finished):
+                    fields, timing = outcome
+                    self._steps[idx].update(fields)
+                    self._steps[idx]["timing"] = timing
+                    self.timings.append(timing)
+                    self._done.add(idx)
+                self._schedule()
+        finally:
+            for future in self._futures:
+                future.cancel()
+            self._pool.shutdown(wait=True)
+        logger.info("Plan timings:\n" + '\n'.join(
+            f"step {t['step']} ({t['operation']}): {t['start']:.2f}s -> {t['end']:.2f}s ({t['elapsed']:.2f}s)"
+            for t in sorted(self.timings, key=lambda t: t["start"])))
+        return self.timings
+
+    def cancel(self) -> None:
+        """
+        放弃执行: 取消尚未开始的步骤, 中止进行中的步骤并等待其结束, 结果不写回
+        """
+        self._closed = True
+        self._cancelled.set()
+        for future in self._futures:
+            future.cancel()
+        self._pool.shutdown(wait=True)
+
+    def _schedule(self) -> None:
+        """
+        提交所有依赖已满足的步骤
+        """
+        for idx, step in enumerate(self._steps):
+            if idx in self._started or not self._dependencies[idx] <= self._done:
+                continue
+            if step["operation"] == "summary" and not self._closed:
+                continue
+            self._started.add(idx)
+            self._futures[self._pool.submit(self._run, idx)] = idx
+
+    def _run(self, idx: int) -> Any:
+        """
+        在工作线程中执行步骤并计时
+        """
+        step = self._steps[idx]
+        start = time.perf_counter() - self._start
+        with thread_handler(self._handlers[idx]), cancel_scope(self._cancelled), trace_scope(self._parent), \
+                span(f"step {step['step']}", operation=step["operation"]):
+            fields = self._run_step(step)
+        end = time.perf_counter() - self._start
+        return fields, {"step": step["step"], "operation": step["operation"], "start": start, "end": end, "elapsed": end - start}
+
+
+class Speculation:
+    """
+    在后台线程中推测执行任务
+
+    结果可以被采用(result)或丢弃(cancel); 丢弃时通知进行中的LLM请求中止, 任务结束后调用on_discard清理
+    """
+
+    def __init__(self, fn: Callable[[], Any], handler: Optional[Any] = None, on_discard: Optional[Callable[[], None]] = None):
+        ctx = get_script_run_ctx()
+        self._event = threading.Event()
+        self._parent = current_span()
+        self._on_discard = on_discard
+        self._start = time.perf_counter()
+        self.elapsed: Optional[float] = None
+        pool = ThreadPoolExecutor(max_workers=1,
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+        self._future = pool.submit(self._run, fn, handler)
+        pool.shutdown(wait=False)
+
+    def _run(self, fn: Callable[[], Any], handler: Optional[Any]) -> Any:
+        """
+        在工作线程中执行任务并计时
+        """
+        try:
+            with thread_handler(handler), cancel_scope(self._event), trace_scope(self._parent), span("speculation"):
+                return fn()
+        finally:
+            self.elapsed = time.perf_counter() - self._start
+
+    def result(self) -> Any:
+        """
+        采用推测结果, 等待任务完成
+        """
+        return self._future.result()
+
+    def cancel(self) -> None:
+        """
+        丢弃推测结果
+        """
+        self._event.set()
+        if self._on_discard is not None:
+            self._future.add_done_callback(lambda _: self._on_discard())
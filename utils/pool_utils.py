@@ -0,0 +1,162 @@
+import os
+import queue
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from typing import Dict, Iterator, List
+
+POOL_SIZE = 8
+POOL_TIMEOUT = 30.0
+MMAP_SIZE = 256 * 2 ** 20
+CACHE_SIZE_KIB = 64 * 1024
+
+
+class ConnectionPool:
+    """
+    只读SQLite连接池
+
+    连接以 mode=ro 打开并设置 query_only, 同时调大 mmap_size 与 cache_size,
+    使页缓存在多次查询之间得以保留; 连接可在线程间传递, 但同一时刻只借给一个线程
+    """
+
+    def __init__(self, database_path: str, max_size: int=POOL_SIZE):
+        self.database_path = os.path.abspath(database_path)
+        self.uri = f"file:{pathname2url(self.database_path)}?mode=ro"
+        self.inode = os.stat(self.database_path).st_ino
+        self.max_size = max_size
+        self.closed = False
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        """
+        打开并配置一个只读连接
+        """
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False, timeout=POOL_TIMEOUT)
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE};")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB};")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        借出连接, 没有空闲连接且已达上限时等待归还
+        """
+        if self.closed:
+            raise sqlite3.ProgrammingError(f"Connection pool for {self.database_path} is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._size < self.max_size
+            if can_open:
+                self._size += 1
+        if can_open:
+            try:
+                return self._open()
+            except:
+                with self._lock:
+                    self._size -= 1
+                raise
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"Timed out waiting for a connection to {self.database_path}")
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """
+        归还连接, 连接池已关闭时直接关闭连接
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        if self.closed:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def _discard(self, conn: sqlite3.Connection) -> None:
+        """
+        关闭连接
+        """
+        with self._lock:
+            self._size -= 1
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        借用连接, 退出时自动归还
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """
+        关闭连接池: 空闲连接立即关闭, 借出的连接归还时关闭
+        """
+        self.closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database_path: str) -> ConnectionPool:
+    """
+    获取数据库对应的连接池, 文件被替换(inode变化)时重建
+    """
+    key = os.path.abspath(database_path)
+    inode = os.stat(key).st_ino
+    stale = None
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.closed or pool.inode != inode:
+            stale = pool
+            pool = _pools[key] = ConnectionPool(key)
+    if stale is not None:
+        stale.close()
+    return pool
+
+
+@contextmanager
+def connect(database_path: str) -> Iterator[sqlite3.Connection]:
+    """
+    从连接池借用只读连接
+    """
+    with get_pool(database_path).connection() as conn:
+        yield conn
+
+
+def close_pool(database_path: str) -> None:
+    """
+    关闭数据库对应的连接池
+    """
+    with _pools_lock:
+        pool = _pools.pop(os.path.abspath(database_path), None)
+    if pool is not None:
+        pool.close()
+
+
+@atexit.register
+def close_all_pools() -> None:
+    """
+    关闭所有连接池
+    """
+    with _pools_lock:
+        pools: List[ConnectionPool] = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,382 @@
+import os
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .cache_utils import LRUCache
+from .pool_utils import connect
+from .schema_utils import database_fingerprint, Fingerprint
+from .str_utils import quote_identifier, tokenize
+
+SIDECAR_PREFIX = "_qa_"
+PROFILES_TABLE = "_qa_profiles"
+VALUES_TABLE = "_qa_values"
+PROFILE_CHUNK_SIZE = 50000
+PROFILE_CACHE_SIZE = 16
+TOP_K = 10
+CATEGORICAL_LIMIT = 1000
+DISTINCT_LIMIT = 100000
+MAX_VALUE_LENGTH = 64
+DATE_SAMPLE_SIZE = 200
+MATCHED_VALUES = 20
+DATE_FORMATS = ["%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y/%m/%d", "%Y/%m/%d %H:%M:%S", "%Y%m%d", "%Y-%m",
+                "%d/%m/%Y", "%m/%d/%Y", "%d.%m.%Y", "%Y年%m月%d日"]
+
+_CREATE_SIDECARS = [
+    f"""CREATE TABLE IF NOT EXISTS {PROFILES_TABLE} (
+  table_name TEXT,
+  column_name TEXT,
+  position INTEGER,
+  kind TEXT,
+  rows INTEGER,
+  nulls INTEGER,
+  distinct_count INTEGER,
+  distinct_approx INTEGER,
+  min_value,
+  max_value,
+  top_values TEXT,
+  date_format TEXT,
+  PRIMARY KEY (table_name, column_name)
+) WITHOUT ROWID;""",
+    f"""CREATE TABLE IF NOT EXISTS {VALUES_TABLE} (
+  term TEXT,
+  table_name TEXT,
+  column_name TEXT,
+  value TEXT,
+  count INTEGER,
+  PRIMARY KEY (term, table_name, column_name, value)
+) WITHOUT ROWID;""",
+]
+
+
+def is_sidecar(table_name: str) -> bool:
+    """
+    判断是否为存放画像的附属表
+    """
+    return table_name.lower().startswith(SIDECAR_PREFIX)
+
+
+def detect_date_format(values: pd.Series) -> Optional[str]:
+    """
+    检测文本列的日期格式, 所有样本都能按同一格式解析时返回该格式
+    """
+    values = values.astype(str).str.strip()
+    if values.empty or not values.str.contains(r"\d", regex=True).all():
+        return None
+    for date_format in DATE_FORMATS:
+        if pd.to_datetime(values, format=date_format, errors="coerce").notna().all():
+            return date_format
+    return None
+
+
+def _scalar(value: Any, date_format: Optional[str]=None) -> Any:
+    """
+    转换为可写入SQLite的标量, 时间按date_format格式化
+    """
+    if isinstance(value, pd.Timestamp):
+        return value.strftime(date_format or "%Y-%m-%d %H:%M:%S")
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ColumnProfiler:
+    """
+    逐块累计一列的统计信息
+
+    不同值用64位哈希去重, 超过DISTINCT_LIMIT后只给出下界; 文本列在不同值不超过CATEGORICAL_LIMIT时记录取值频次
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.kind: Optional[str] = None
+        self.rows = 0
+        self.nulls = 0
+        self.min: Any = None
+        self.max: Any = None
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.distinct_approx = False
+        self.mixed = False
+        self.counts: Optional[Counter] = Counter()
+        self.date_format: Optional[str] = None
+
+    def update(self, series: pd.Series) -> None:
+        """
+        累计一块数据
+        """
+        self.rows += len(series)
+        values = series.dropna()
+        self.nulls += len(series) - len(values)
+        if values.empty:
+            return
+        if pd.api.types.is_datetime64_any_dtype(values):
+            kind = "datetime"
+        elif pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            kind = "number"
+        else:
+            kind = "text"
+            values = values.astype(str)
+        if self.kind is None:
+            self.kind = kind
+            if kind == "text":
+                self.date_format = detect_date_format(values.iloc[:DATE_SAMPLE_SIZE])
+            elif kind == "datetime":
+                self.date_format = "%Y-%m-%d %H:%M:%S"
+        elif self.kind != kind:
+            # 同一列中出现了不同类型的值, 只保留不同值计数
+            self.kind, self.mixed = "text", True
+            self.min = self.max = self.date_format = self.counts = None
+            values = values.astype(str)
+        if not self.mixed:
+            # 文本日期按解析后的时间比较, 避免 "31/01" 大于 "01/12" 这类按字典序的错误
+            bounds = pd.to_datetime(values, format=self.date_format, errors="coerce").dropna() if kind == "text" and self.date_format else values
+            low, high = (bounds.min(), bounds.max()) if len(bounds) else (self.min, self.max)
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+        if not self.distinct_approx:
+            hashes = np.unique(pd.util.hash_pandas_object(values, index=False).to_numpy())
+            self.hashes = np.union1d(self.hashes, hashes)
+            if len(self.hashes) > DISTINCT_LIMIT:
+                self.distinct_approx = True
+                self.hashes = self.hashes[:DISTINCT_LIMIT]
+        if self.counts is not None and self.kind == "text":
+            self.counts.update(values.value_counts().to_dict())
+            if len(self.counts) > CATEGORICAL_LIMIT:
+                self.counts = None
+
+    def top_values(self) -> List[Tuple[str, int]]:
+        """
+        出现次数最多的TOP_K个取值
+        """
+        return self.counts.most_common(TOP_K) if self.counts and self.kind == "text" else []
+
+    def row(self, table_name: str, position: int) -> Tuple:
+        """
+        转换为画像表中的一行
+        """
+        return (table_name, self.name, position, self.kind, self.rows, self.nulls, len(self.hashes), int(self.distinct_approx),
+                _scalar(self.min, self.date_format), _scalar(self.max, self.date_format), json.dumps(self.top_values(), ensure_ascii=False), self.date_format)
+
+    def value_rows(self, table_name: str) -> Iterable[Tuple]:
+        """
+        为类别型文本列生成倒排索引的行, 日期列不建索引
+        """
+        if not self.counts or self.kind != "text" or self.date_format:
+            return
+        for value, count in self.counts.items():
+            if len(value) > MAX_VALUE_LENGTH:
+                continue
+            for term in set(tokenize(value)):
+                yield term, table_name, self.name, value, count
+
+
+class TableProfiler:
+    """
+    逐块累计一张表所有列的统计信息
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self.columns: List[ColumnProfiler] = []
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        """
+        累计一块数据
+        """
+        if not self.columns:
+            self.columns = [ColumnProfiler(str(column)) for column in chunk.columns]
+        for i, profiler in enumerate(self.columns):
+            profiler.update(chunk.iloc[:, i])
+
+    def write(self, conn: sqlite3.Connection) -> None:
+        """
+        将画像与倒排索引写入附属表, 替换该表已有的记录
+        """
+        for statement in _CREATE_SIDECARS:
+            conn.execute(statement)
+        conn.execute(f"DELETE FROM {PROFILES_TABLE} WHERE table_name = ?;", (self.table_name,))
+        conn.execute(f"DELETE FROM {VALUES_TABLE} WHERE table_name = ?;", (self.table_name,))
+        conn.executemany(f"INSERT INTO {PROFILES_TABLE} VALUES ({', '.join('?' * 12)});",
+                         [profiler.row(self.table_name, i) for i, profiler in enumerate(self.columns)])
+        conn.executemany(f"INSERT OR IGNORE INTO {VALUES_TABLE} VALUES (?, ?, ?, ?, ?);",
+                         (row for profiler in self.columns for row in profiler.value_rows(self.table_name)))
+
+
+def profile_table(conn: sqlite3.Connection, table_name: str, chunksize: int=PROFILE_CHUNK_SIZE) -> None:
+    """
+    分块读取已有的表并写入画像, 用于直接上传的数据库文件
+    """
+    profiler = TableProfiler(table_name)
+    for chunk in pd.read_sql_query(f"SELECT * FROM main.{quote_identifier(table_name)};", conn, chunksize=chunksize):
+        profiler.update(chunk)
+    profiler.write(conn)
+
+
+def merge_profiles(conn: sqlite3.Connection, tables: Dict[str, str], schema: str="part") -> None:
+    """
+    将附加数据库中的画像合并到主库, tables为 {原表名: 合并后的表名}; 原库没有画像的表重新计算
+    """
+    for statement in _CREATE_SIDECARS:
+        conn.execute(statement)
+    attached = {name for name, in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table';")}
+    profiled = set()
+    if PROFILES_TABLE in attached and VALUES_TABLE in attached:
+        for name, target in tables.items():
+            cursor = conn.execute(f"INSERT OR REPLACE INTO main.{PROFILES_TABLE} SELECT ?, column_name, position, kind, rows, nulls, "
+                                  f"distinct_count, distinct_approx, min_value, max_value, top_values, date_format "
+                                  f"FROM {schema}.{PROFILES_TABLE} WHERE table_name = ?;", (target, name))
+            conn.execute(f"INSERT OR IGNORE INTO main.{VALUES_TABLE} SELECT term, ?, column_name, value, count "
+                         f"FROM {schema}.{VALUES_TABLE} WHERE table_name = ?;", (target, name))
+            if cursor.rowcount > 0:
+                profiled.add(target)
+    for target in tables.values():
+        if target not in profiled:
+            profile_table(conn, target)
+
+
+@dataclass
+class ColumnProfile:
+    """
+    列画像
+    """
+    table: str
+    column: str
+    kind: Optional[str]
+    rows: int
+    nulls: int
+    distinct_count: int
+    distinct_approx: bool
+    min_value: Any
+    max_value: Any
+    top_values: List[Tuple[str, int]] = field(default_factory=list)
+    date_format: Optional[str] = None
+
+
+@dataclass
+class Profiles:
+    """
+    数据库中所有列的画像
+    """
+    fingerprint: Fingerprint
+    columns: Dict[Tuple[str, str], ColumnProfile] = field(default_factory=dict)
+
+
+_profile_cache = LRUCache(PROFILE_CACHE_SIZE)
+
+
+def get_profiles(database_path: str) -> Profiles:
+    """
+    读取列画像, 按 (路径, 文件指纹) 缓存; 数据库没有画像表时返回空画像
+    """
+    key = os.path.abspath(database_path)
+    fingerprint = database_fingerprint(database_path)
+    profiles = _profile_cache.get(key)
+    if profiles is not None and profiles.fingerprint == fingerprint:
+        return profiles
+    profiles = Profiles(fingerprint)
+    with connect(database_path) as conn:
+        try:
+            rows = conn.execute(f"SELECT table_name, column_name, kind, rows, nulls, distinct_count, distinct_approx, "
+                                f"min_value, max_value, top_values, date_format FROM {PROFILES_TABLE} ORDER BY table_name, position;").fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+    for table, column, kind, rows_, nulls, distinct, approx, low, high, top, date_format in rows:
+        profiles.columns[(table.lower(), column.lower())] = ColumnProfile(
+            table, column, kind, rows_, nulls, distinct, bool(approx), low, high,
+            [tuple(item) for item in json.loads(top or "[]")], date_format)
+    _profile_cache.put(key, profiles)
+    return profiles
+
+
+def invalidate_profiles(database_path: str) -> None:
+    """
+    使列画像缓存失效
+    """
+    _profile_cache.pop(os.path.abspath(database_path))
+
+
+def match_values(database_path: str, query: str, limit: int=MATCHED_VALUES) -> List[Tuple[str, str, str]]:
+    """
+    在倒排索引中查找问题里提到的类别取值, 按命中的词数排序, 返回 [(表名, 列名, 取值)]
+    """
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return []
+    with connect(database_path) as conn:
+        try:
+            rows = conn.execute(f"SELECT table_name, column_name, value, COUNT(*) AS hits, MAX(count) FROM {VALUES_TABLE} "
+                                f"WHERE term IN ({', '.join('?' * len(terms))}) GROUP BY table_name, column_name, value "
+                                f"ORDER BY hits DESC, MAX(count) DESC LIMIT ?;", (*terms, limit * 4)).fetchall()
+        except sqlite3.OperationalError:
+            return []
+    matches = []
+    for table, column, value, hits, _ in rows:
+        # 多词取值要求命中其一半以上的词, 避免 "new" 匹配到所有 "New ..." 取值
+        if hits * 2 >= len(set(tokenize(value))):
+            matches.append((table, column, value))
+    return matches[:limit]
+
+
+def _format_value(value: Any) -> str:
+    """
+    渲染SQL字面量
+    """
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, float):
+        return f"{value:g}"
+    return str(value)
+
+
+def describe_column(profile: ColumnProfile, matched: List[str]) -> str:
+    """
+    用一行文字描述列画像
+    """
+    parts = [f"{quote_identifier(profile.table)}.{quote_identifier(profile.column)}:"]
+    distinct = f"{'>' if profile.distinct_approx else ''}{profile.distinct_count} distinct"
+    parts.append(distinct + (f", {profile.nulls / profile.rows:.0%} null" if profile.rows and profile.nulls else ""))
+    if matched:
+        parts.append("values matching the question: " + ", ".join(_format_value(v) for v in matched))
+    if profile.date_format:
+        parts.append(f"date format {profile.date_format}")
+    if profile.kind in ("number", "datetime") or profile.date_format:
+        if profile.min_value is not None:
+            parts.append(f"range {_format_value(profile.min_value)} .. {_format_value(profile.max_value)}")
+    elif profile.top_values and profile.distinct_count * 2 <= profile.rows - profile.nulls:
+        parts.append("top values: " + ", ".join(_format_value(v) for v, _ in profile.top_values))
+    description = " ".join(parts[:2])
+    if len(parts) > 2:
+        description += "; " + "; ".join(parts[2:])
+    return description
+
+
+def column_notes(database_path: str, query: str, columns: List[Tuple[str, str]],
+                 matches: Optional[List[Tuple[str, str, str]]]=None) -> List[str]:
+    """
+    为给定的列生成画像说明: 取值与问题匹配的列在前, 然后是日期列与类别列, 最后是其余列
+
+    matches为 match_values 的结果, 未传入时重新查找
+    """
+    profiles = get_profiles(database_path)
+    if not profiles.columns:
+        return []
+    matched: Dict[Tuple[str, str], List[str]] = {}
+    for table, column, value in matches if matches is not None else match_values(database_path, query):
+        matched.setdefault((table.lower(), column.lower()), []).append(value)
+
+    def priority(key: Tuple[str, str]) -> int:
+        profile = profiles.columns[key]
+        if key in matched:
+            return 0
+        if profile.date_format:
+            return 1
+        if profile.top_values and profile.distinct_count <= TOP_K:
+            return 2
+        return 3
+
+    keys = [key for key in ((t.lower(), c.lower()) for t, c in columns) if key in profiles.columns]
+    keys.sort(key=priority)
+    return [describe_column(profiles.columns[key], matched.get(key, [])) for key in keys]
@@ -0,0 +1,156 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+from typing import Any, List, Optional, Sequence, Tuple
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+RESULT_BATCH_SIZE = 2048
+MAX_RESULT_ROWS = 50000
+
+_DTYPE_ORDER = [np.dtype(np.int64), np.dtype(np.float64), np.dtype(object)]
+
+
+def _infer_dtype(values: Sequence[Any]) -> Optional[np.dtype]:
+    """
+    根据一批值推断列类型, 全为NULL时返回None
+    """
+    types = set(map(type, values))
+    types.discard(type(None))
+    if not types:
+        return None
+    if types == {int}:
+        return np.dtype(np.float64) if None in values else np.dtype(np.int64)
+    if types <= {int, float}:
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+class _NumpyColumn:
+    """
+    按批追加的NumPy列缓冲区, 容量不足时倍增, 类型不兼容时按 int64 -> float64 -> object 提升
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self.dtype: Optional[np.dtype] = None
+        self.data: Optional[np.ndarray] = None
+        self.size = 0
+
+    def append(self, values: Sequence[Any]) -> None:
+        """
+        追加一批值
+        """
+        dtype = _infer_dtype(values)
+        if dtype is None and self.dtype == np.dtype(np.int64):
+            # 整数列遇到全为NULL的批次时提升为浮点数, NULL写为NaN
+            dtype = np.dtype(np.float64)
+        if dtype is not None and self.dtype != dtype:
+            self._promote(dtype)
+        if self.data is None:
+            self.dtype = self.dtype or np.dtype(np.float64)
+            self.data = np.empty(self.capacity, dtype=self.dtype)
+        if self.size + len(values) > len(self.data):
+            self.data = np.resize(self.data, max(len(self.data) * 2, self.size + len(values)))
+        if self.data.dtype == object:
+            self.data[self.size:self.size + len(values)] = np.array(values, dtype=object)
+        else:
+            self.data[self.size:self.size + len(values)] = np.array(values, dtype=self.data.dtype)
+        self.size += len(values)
+
+    def _promote(self, dtype: np.dtype) -> None:
+        """
+        提升列类型
+        """
+        if self.dtype is not None and _DTYPE_ORDER.index(dtype) <= _DTYPE_ORDER.index(self.dtype):
+            return
+        self.dtype = dtype
+        if self.data is not None:
+            promoted = np.empty(len(self.data), dtype=dtype)
+            promoted[:self.size] = self.data[:self.size]
+            self.data = promoted
+
+    def finish(self) -> np.ndarray:
+        """
+        返回已写入部分
+        """
+        if self.data is None:
+            return np.empty(0, dtype=self.dtype or object)
+        return self.data[:self.size]
+
+
+def _fetch_numpy(cursor: sqlite3.Cursor, columns: List[str], batches: List[List[Tuple]], max_rows: int, batch_size: int) -> Tuple[pd.DataFrame, int]:
+    """
+    将结果逐批写入NumPy列缓冲区
+    """
+    buffers = [_NumpyColumn(min(max_rows, batch_size)) for _ in columns]
+    n_rows = 0
+    for batch in _iter_batches(cursor, batches, max_rows, batch_size):
+        for buffer, values in zip(buffers, zip(*batch)):
+            buffer.append(values)
+        n_rows += len(batch)
+    df = pd.DataFrame({i: buffer.finish() for i, buffer in enumerate(buffers)})
+    df.columns = columns
+    return df, n_rows
+
+
+def _fetch_arrow(cursor: sqlite3.Cursor, columns: List[str], max_rows: int, batch_size: int) -> Tuple[pd.DataFrame, int]:
+    """
+    将结果逐批转换为Arrow RecordBatch, 遇到Arrow无法表示的混合类型列时退回NumPy
+    """
+    names = [str(i) for i in range(len(columns))]
+    record_batches = []
+    n_rows = 0
+    for batch in _iter_batches(cursor, [], max_rows, batch_size):
+        try:
+            record_batches.append(pa.RecordBatch.from_arrays([pa.array(values) for values in zip(*batch)], names=names))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            rows = [list(zip(*(rb.column(i).to_pylist() for i in range(rb.num_columns)))) for rb in record_batches]
+            return _fetch_numpy(cursor, columns, rows + [batch], max_rows, batch_size)
+        n_rows += len(batch)
+    if not record_batches:
+        return pd.DataFrame(columns=columns), 0
+    tables = [pa.Table.from_batches([rb]) for rb in record_batches]
+    try:
+        df = pa.concat_tables(tables, promote_options="permissive").to_pandas()
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df = pd.concat([table.to_pandas() for table in tables], ignore_index=True)
+    df.columns = columns
+    return df, n_rows
+
+
+def _iter_batches(cursor: sqlite3.Cursor, pending: List[List[Tuple]], max_rows: int, batch_size: int):
+    """
+    先产出已读取的批次, 再用fetchmany继续读取, 最多读取max_rows行
+    """
+    n_rows = 0
+    for batch in pending:
+        batch = batch[:max_rows - n_rows]
+        if batch:
+            n_rows += len(batch)
+            yield batch
+    while n_rows < max_rows:
+        batch = cursor.fetchmany(min(batch_size, max_rows - n_rows))
+        if not batch:
+            break
+        n_rows += len(batch)
+        yield batch
+
+
+def fetch_dataframe(cursor: sqlite3.Cursor, max_rows: int=MAX_RESULT_ROWS, batch_size: int=RESULT_BATCH_SIZE) -> pd.DataFrame:
+    """
+    按批读取查询结果并直接构建列式DataFrame, 最多保留max_rows行
+
+    超出部分被截断, 并通过 df.attrs["truncated"] 标记
+    """
+    columns = [column[0] for column in cursor.description]
+    if pa is not None:
+        df, n_rows = _fetch_arrow(cursor, columns, max_rows, batch_size)
+    else:
+        df, n_rows = _fetch_numpy(cursor, columns, [], max_rows, batch_size)
+    df.attrs["truncated"] = n_rows >= max_rows and cursor.fetchone() is not None
+    df.attrs["max_rows"] = max_rows
+    return df
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+from .cache_utils import LRUCache
+from .str_utils import quote_identifier
+from .pool_utils import connect
+
+SCHEMA_CACHE_SIZE = 32
+
+Fingerprint = Tuple[int, int]
+
+
+@dataclass
+class Column:
+    """
+    列信息
+    """
+    name: str
+    type: str
+    notnull: bool = False
+    default: Optional[str] = None
+    pk: bool = False
+
+
+@dataclass
+class Table:
+    """
+    表信息
+    """
+    name: str
+    sql: str
+    columns: List[Column] = field(default_factory=list)
+
+
+@dataclass
+class Schema:
+    """
+    数据库schema, 同时保存渲染好的CREATE语句与结构化的列信息
+    """
+    path: str
+    fingerprint: Fingerprint
+    version: int
+    tables: List[Table] = field(default_factory=list)
+    create_statements: str = ""
+
+    def table(self, name: str) -> Optional[Table]:
+        """
+        按表名(忽略大小写)查找表
+        """
+        for table in self.tables:
+            if table.name.lower() == name.lower():
+                return table
+        return None
+
+
+_schema_cache = LRUCache(SCHEMA_CACHE_SIZE)
+
+
+def database_fingerprint(database_path: str) -> Fingerprint:
+    """
+    数据库文件指纹(修改时间, 大小), 文件被改写后即发生变化
+    """
+    stat = os.stat(database_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def render_create_statements(tables: List[Table]) -> str:
+    """
+    渲染CREATE语句
+    """
+    return "```sql\n" + "\n\n".join(table.sql for table in tables) + "\n```"
+
+
+def read_schema(conn: sqlite3.Connection, database_path: str, fingerprint: Fingerprint) -> Schema:
+    """
+    从数据库读取schema, 视图与表一同列出
+    """
+    cursor = conn.cursor()
+    version = cursor.execute("PRAGMA schema_version;").fetchone()[0]
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%' "
+                   "AND name NOT LIKE '\\_qa\\_%' ESCAPE '\\';")
+    tables = [Table(name, sql) for name, sql in cursor.fetchall()]
+    for table in tables:
+        cursor.execute(f"PRAGMA table_info({quote_identifier(table.name)});")
+        table.columns = [Column(name, type_, bool(notnull), default, bool(pk))
+                         for _, name, type_, notnull, default, pk in cursor.fetchall()]
+    return Schema(database_path, fingerprint, version, tables, render_create_statements(tables))
+
+
+def get_schema(database_path: str) -> Schema:
+    """
+    获取数据库schema, 按 (路径, 文件指纹) 缓存
+    """
+    key = os.path.abspath(database_path)
+    fingerprint = database_fingerprint(database_path)
+    schema = _schema_cache.get(key)
+    if schema is not None and schema.fingerprint == fingerprint:
+        return schema
+    with connect(database_path) as conn:
+        schema = read_schema(conn, database_path, fingerprint)
+    _schema_cache.put(key, schema)
+    return schema
+
+
+def invalidate_schema(database_path: str) -> None:
+    """
+    使数据库schema缓存失效
+    """
+    _schema_cache.pop(os.path.abspath(database_path))
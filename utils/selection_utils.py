@@ -0,0 +1,258 @@
+import os
+import re
+import math
+import logging
+import sqlite3
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from .cache_utils import LRUCache
+from .pool_utils import connect
+from .schema_utils import Column, Schema, Table, get_schema
+from .str_utils import quote_identifier, tokenize
+from .profile_utils import column_notes, get_profiles, match_values
+from .trace_utils import current_span
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_TOKEN_BUDGET = 4000
+SCHEMA_INDEX_CACHE_SIZE = 16
+SAMPLE_VALUES = 20
+SAMPLE_VALUE_LENGTH = 64
+OMITTED_TABLE_NAMES = 30
+BM25_K1 = 1.2
+BM25_B = 0.75
+MATCH_BOOST = 2.0
+
+_CJK = re.compile(r"[一-鿿]")
+
+Signature = Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数: 中文每字一个token, 其余每4个字符一个token
+    """
+    n_cjk = len(_CJK.findall(text))
+    return n_cjk + math.ceil((len(text) - n_cjk) / 4)
+
+
+class BM25:
+    """
+    BM25 检索模型
+    """
+
+    def __init__(self, documents: List[List[str]]):
+        self.tf = [Counter(document) for document in documents]
+        self.lengths = [len(document) for document in documents]
+        self.avg_length = sum(self.lengths) / len(documents) if documents else 0.0
+        df = Counter(term for tf in self.tf for term in tf)
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+    def scores(self, query: List[str]) -> List[float]:
+        """
+        计算查询与每篇文档的相关度
+        """
+        terms = [term for term in set(query) if term in self.idf]
+        scores = []
+        for tf, length in zip(self.tf, self.lengths):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self.avg_length) if self.avg_length else BM25_K1
+            scores.append(sum(self.idf[t] * tf[t] * (BM25_K1 + 1) / (tf[t] + norm) for t in terms if t in tf))
+        return scores
+
+
+def schema_signature(schema: Schema) -> Signature:
+    """
+    schema的结构签名(表名与列名)
+    """
+    return tuple((table.name, tuple(column.name for column in table.columns)) for table in schema.tables)
+
+
+def _is_text(column: Column) -> bool:
+    """
+    判断列是否为文本类型
+    """
+    type_ = column.type.upper()
+    return not type_ or any(t in type_ for t in ("CHAR", "CLOB", "TEXT"))
+
+
+def sample_values(conn: sqlite3.Connection, table: Table, limit: int=SAMPLE_VALUES) -> Dict[str, List[str]]:
+    """
+    为表中的文本列采样若干不同的取值
+    """
+    samples = {}
+    for column in table.columns:
+        if not _is_text(column):
+            continue
+        name = quote_identifier(column.name)
+        try:
+            rows = conn.execute(f"SELECT DISTINCT substr({name}, 1, {SAMPLE_VALUE_LENGTH}) FROM {quote_identifier(table.name)} "
+                                f"WHERE typeof({name}) = 'text' LIMIT {limit};").fetchall()
+        except sqlite3.Error:
+            continue
+        samples[column.name] = [value for value, in rows]
+    return samples
+
+
+class SchemaIndex:
+    """
+    schema的本地词法索引
+
+    每张表一篇文档(表名与全部列名), 每列一篇文档(表名、列名与采样取值), 均用BM25打分
+    """
+
+    def __init__(self, schema: Schema, samples: Dict[str, Dict[str, List[str]]]):
+        self.signature = schema_signature(schema)
+        self.tables = schema.tables
+        self.table_index = BM25([tokenize(table.name) + [t for column in table.columns for t in tokenize(column.name)]
+                                 for table in self.tables])
+        self.columns: List[Tuple[int, Column]] = []
+        documents = []
+        for i, table in enumerate(self.tables):
+            values = samples.get(table.name, {})
+            for column in table.columns:
+                self.columns.append((i, column))
+                documents.append(tokenize(table.name) + tokenize(column.name) * 2
+                                 + [t for value in values.get(column.name, []) for t in tokenize(value)])
+        self.column_index = BM25(documents)
+
+    def rank(self, query: str, boost: Optional[Dict[Tuple[str, str], float]]=None) -> List[Tuple[Table, float, Dict[str, float]]]:
+        """
+        按相关度对表排序, 返回 (表, 表得分, {列名: 列得分}); boost为 {(表名, 列名): 加分}, 名称均为小写
+        """
+        tokens = tokenize(query)
+        boost = boost or {}
+        table_scores = self.table_index.scores(tokens)
+        column_scores: List[Dict[str, float]] = [{} for _ in self.tables]
+        for (i, column), score in zip(self.columns, self.column_index.scores(tokens)):
+            column_scores[i][column.name] = score + boost.get((self.tables[i].name.lower(), column.name.lower()), 0.0)
+        ranked = [(table, table_scores[i] + max(column_scores[i].values(), default=0.0), column_scores[i])
+                  for i, table in enumerate(self.tables)]
+        return sorted(ranked, key=lambda item: -item[1])
+
+
+_index_cache = LRUCache(SCHEMA_INDEX_CACHE_SIZE)
+
+
+def get_schema_index(database_path: str, schema: Schema) -> SchemaIndex:
+    """
+    获取数据库对应的词法索引, 表结构变化时重建
+
+    优先使用入库时计算的列画像中的高频取值, 没有画像时才扫描表采样
+    """
+    key = os.path.abspath(database_path)
+    index = _index_cache.get(key)
+    if index is not None and index.signature == schema_signature(schema):
+        return index
+    profiles = get_profiles(database_path).columns
+    samples: Dict[str, Dict[str, List[str]]] = {}
+    if profiles:
+        for profile in profiles.values():
+            samples.setdefault(profile.table, {})[profile.column] = [value for value, _ in profile.top_values]
+    else:
+        with connect(database_path) as conn:
+            samples = {table.name: sample_values(conn, table) for table in schema.tables}
+    index = SchemaIndex(schema, samples)
+    _index_cache.put(key, index)
+    return index
+
+
+def invalidate_schema_index(database_path: str) -> None:
+    """
+    使数据库的词法索引失效
+    """
+    _index_cache.pop(os.path.abspath(database_path))
+
+
+def render_columns(table: Table, columns: List[Column]) -> str:
+    """
+    渲染只包含部分列的CREATE语句
+    """
+    lines = [f"  {quote_identifier(column.name)} {column.type}".rstrip() + (" PRIMARY KEY" if column.pk else "") for column in columns]
+    statement = f"CREATE TABLE {quote_identifier(table.name)} (\n" + ",\n".join(lines)
+    if len(columns) < len(table.columns):
+        statement += f"\n  -- {len(table.columns) - len(columns)} more columns omitted"
+    return statement + "\n);"
+
+
+def prune_table(table: Table, column_scores: Dict[str, float], budget: int) -> Optional[List[Column]]:
+    """
+    在预算内为表挑选列: 主键在前, 然后按相关度, 最后按原顺序补齐; 没有相关列时返回None
+    """
+    relevant = sorted((c for c in table.columns if column_scores.get(c.name, 0.0) > 0 and not c.pk),
+                      key=lambda c: -column_scores[c.name])
+    if not relevant:
+        return None
+    ordered = [c for c in table.columns if c.pk] + relevant
+    ordered += [c for c in table.columns if c not in ordered]
+    selected: List[Column] = []
+    for column in ordered:
+        statement = render_columns(table, selected + [column])
+        if estimate_tokens(statement) > budget:
+            break
+        selected.append(column)
+    if not any(c in selected for c in relevant):
+        return None
+    position = {column.name: i for i, column in enumerate(table.columns)}
+    return sorted(selected, key=lambda c: position[c.name])
+
+
+def select_create_statements(database_path: str, query: str, budget: int=SCHEMA_TOKEN_BUDGET) -> str:
+    """
+    在token预算内挑选与问题相关的表和列并渲染CREATE语句
+
+    完整schema不超过预算时全部保留; 否则按相关度依次加入整表, 放不下的表只保留相关列,
+    与问题无关的表只列出表名, 没有任何表与问题相关时按原顺序加入.
+    剩余预算用于附加所选列的画像说明(与问题匹配的取值、日期格式、取值范围等)
+    """
+    schema = get_schema(database_path)
+    matches = match_values(database_path, query)
+    used = estimate_tokens(schema.create_statements)
+    if used <= budget:
+        statements = [table.sql for table in schema.tables]
+        columns = [(table.name, column.name) for table in schema.tables for column in table.columns]
+        included = [table.name for table in schema.tables]
+        omitted = []
+    else:
+        boost = {(table.lower(), column.lower()): MATCH_BOOST for table, column, _ in matches}
+        ranked = get_schema_index(database_path, schema).rank(query, boost)
+        if not ranked or ranked[0][1] <= 0:
+            ranked = [(table, 0.0, {}) for table in schema.tables]
+        else:
+            ranked = [item for item in ranked if item[1] > 0]
+        used = estimate_tokens("```sql\n\n```")
+        statements, columns, included = [], [], []
+        for table, _, column_scores in ranked:
+            remaining = budget - used
+            if remaining <= 0:
+                break
+            statement, selected = table.sql, table.columns
+            if estimate_tokens(statement) > remaining:
+                selected = prune_table(table, column_scores, remaining)
+                if selected is None:
+                    continue
+                statement = render_columns(table, selected)
+            statements.append(statement)
+            columns += [(table.name, column.name) for column in selected]
+            included.append(table.name)
+            used += estimate_tokens(statement) + 1
+        omitted = [table.name for table in schema.tables if table.name not in included]
+        if omitted:
+            names = ", ".join(omitted[:OMITTED_TABLE_NAMES]) + (", ..." if len(omitted) > OMITTED_TABLE_NAMES else "")
+            statements.append(f"-- {len(omitted)} other tables omitted: {names}")
+            used += estimate_tokens(statements[-1]) + 1
+    logger.info(f"Schema selection for {query[:80]!r}: included {', '.join(included) or 'no tables'} "
+                f"(~{used} of {budget} tokens), omitted {len(omitted)} of {len(schema.tables)} tables")
+    parent = current_span()
+    if parent is not None:
+        parent.set(schema_tables=included, schema_omitted=len(omitted), schema_tokens=used)
+    notes = []
+    for note in column_notes(database_path, query, columns, matches):
+        note = "-- " + note
+        if used + estimate_tokens(note) + 1 > budget:
+            break
+        notes.append(note)
+        used += estimate_tokens(note) + 1
+    if notes:
+        statements.append("-- Column profiles:\n" + "\n".join(notes))
+    return "```sql\n" + "\n\n".join(statements) + "\n```"
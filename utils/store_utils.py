@@ -0,0 +1,249 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+import pandas as pd
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+from .cache_utils import LRUCache
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+RESULT_STORE_DIR = "./tmp/session_results"
+RESULT_PREVIEW_ROWS = 100
+SESSION_RESULT_BYTES = 256 * 2 ** 20
+TOTAL_RESULT_BYTES = 4 * 2 ** 30
+LOADED_RESULT_BYTES = 128 * 2 ** 20
+SESSION_RESULT_TTL = 2 * 3600
+SWEEP_INTERVAL = 60
+
+
+@dataclass
+class ResultHandle:
+    """
+    溢出到磁盘的查询结果: 会话中只保留句柄与前几行预览
+    """
+    session_id: str
+    key: str
+    rows: int
+    bytes: int
+    preview: pd.DataFrame
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def empty(self) -> bool:
+        return self.rows == 0
+
+
+class ResultStore:
+    """
+    会话查询结果的磁盘存储
+
+    DataFrame写为Parquet文件(没有pyarrow时用pickle), 文件按会话与全局字节预算LRU淘汰;
+    读取过的结果保存在有字节上限的内存LRU中, 重新渲染时不必每次读盘.
+    Streamlit不通知会话结束, 因此超过session_ttl没有活动的会话在定期清扫时整体删除;
+    目录中不属于本进程的会话(如上次运行留下的)超过session_ttl未修改时同样删除
+    """
+
+    def __init__(self, root: str, session_bytes: int, total_bytes: int, loaded_bytes: int, session_ttl: float=SESSION_RESULT_TTL):
+        self.root = root
+        self.session_bytes = session_bytes
+        self.total_bytes = total_bytes
+        self.session_ttl = session_ttl
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[str, str, int]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._loaded = LRUCache(4096, loaded_bytes)
+        self._touched: Dict[str, float] = {}
+        self._swept = 0.0
+        self._lock = threading.Lock()
+
+    def touch(self, session_id: str) -> None:
+        """
+        记录会话的活动(同时更新会话目录的修改时间, 供其它进程判断), 并按需清扫过期的会话
+        """
+        with self._lock:
+            self._touched[session_id] = time.time()
+        try:
+            os.utime(os.path.join(self.root, session_id))
+        except OSError:
+            pass
+        self.sweep()
+
+    def sweep(self, now: Optional[float]=None) -> List[str]:
+        """
+        删除超过session_ttl没有活动的会话, 两次清扫至少间隔SWEEP_INTERVAL秒, 返回被删除的会话
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if now - self._swept < SWEEP_INTERVAL:
+                return []
+            self._swept = now
+            expired = [session_id for session_id, touched in self._touched.items() if now - touched > self.session_ttl]
+            active = set(self._touched)
+        for session_id in expired:
+            self.drop_session(session_id)
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try:
+                    stale = name not in active and now - os.path.getmtime(path) > self.session_ttl
+                except OSError:
+                    continue
+                if stale:
+                    shutil.rmtree(path, ignore_errors=True)
+                    expired.append(name)
+        return expired
+
+    def put(self, session_id: str, df: pd.DataFrame) -> ResultHandle:
+        """
+        把结果写入会话目录, 返回句柄; 超出预算时淘汰最久未使用的结果
+        """
+        self.touch(session_id)
+        key = uuid.uuid4().hex
+        directory = os.path.join(self.root, session_id)
+        os.makedirs(directory, exist_ok=True)
+        if pa is not None:
+            path = os.path.join(directory, key + ".parquet")
+            try:
+                df.to_parquet(path, index=False)
+            except (pa.ArrowException, ValueError, TypeError):
+                self._remove(path)
+                path = os.path.join(directory, key + ".pkl")
+                df.to_pickle(path)
+        else:
+            path = os.path.join(directory, key + ".pkl")
+            df.to_pickle(path)
+        size = os.path.getsize(path)
+        evicted = []
+        with self._lock:
+            self._entries[key] = (session_id, path, size)
+            self._sizes[session_id] = self._sizes.get(session_id, 0) + size
+            self._bytes += size
+            for old_key, (old_session, _, _) in list(self._entries.items()):
+                if self._bytes <= self.total_bytes and self._sizes[session_id] <= self.session_bytes:
+                    break
+                if old_key == key or (self._bytes <= self.total_bytes and old_session != session_id):
+                    continue
+                evicted.append(self._pop(old_key))
+        for path_ in evicted:
+            self._remove(path_)
+        return ResultHandle(session_id, key, len(df), size, df.head(RESULT_PREVIEW_ROWS).copy(), dict(df.attrs))
+
+    def load(self, handle: ResultHandle) -> Optional[pd.DataFrame]:
+        """
+        读取完整结果, 已被淘汰时返回None
+        """
+        self.touch(handle.session_id)
+        df = self._loaded.get(handle.key)
+        if df is not None:
+            with self._lock:
+                if handle.key in self._entries:
+                    self._entries.move_to_end(handle.key)
+            return df
+        with self._lock:
+            entry = self._entries.get(handle.key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(handle.key)
+        path = entry[1]
+        try:
+            df = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_pickle(path)
+        except (OSError, ValueError):
+            return None
+        df.attrs.update(handle.attrs)
+        self._loaded.put(handle.key, df, int(df.memory_usage(deep=True).sum()))
+        return df
+
+    def drop_session(self, session_id: str) -> None:
+        """
+        删除会话的全部结果
+        """
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[0] == session_id]
+            for key in keys:
+                self._pop(key)
+            self._sizes.pop(session_id, None)
+            self._touched.pop(session_id, None)
+        shutil.rmtree(os.path.join(self.root, session_id), ignore_errors=True)
+
+    def _pop(self, key: str) -> str:
+        """
+        在持有锁时删除条目, 返回待删除的文件
+        """
+        session_id, path, size = self._entries.pop(key)
+        self._sizes[session_id] -= size
+        self._bytes -= size
+        self._loaded.pop(key)
+        self.evictions += 1
+        return path
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        """
+        删除结果文件
+        """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self, session_id: Optional[Hashable] = None) -> Dict[str, int]:
+        """
+        存储统计, 传入session_id时附带该会话的用量
+        """
+        with self._lock:
+            stats = {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "evictions": self.evictions,
+                "loaded_bytes": self._loaded.bytes,
+            }
+            if session_id is not None:
+                stats["session_entries"] = sum(1 for entry in self._entries.values() if entry[0] == session_id)
+                stats["session_bytes"] = self._sizes.get(session_id, 0)
+        return stats
+
+
+_result_store = ResultStore(RESULT_STORE_DIR, SESSION_RESULT_BYTES, TOTAL_RESULT_BYTES, LOADED_RESULT_BYTES)
+
+
+def spill_result(session_id: str, df: Union[pd.DataFrame, ResultHandle]) -> Union[pd.DataFrame, ResultHandle]:
+    """
+    把超过预览行数的结果移到磁盘, 返回句柄; 小结果原样返回
+    """
+    if isinstance(df, ResultHandle) or len(df) <= RESULT_PREVIEW_ROWS:
+        return df
+    return _result_store.put(session_id, df)
+
+
+def touch_session(session_id: str) -> None:
+    """
+    记录会话仍在使用, 长时间没有活动的会话的结果会被删除
+    """
+    _result_store.touch(session_id)
+
+
+def load_result(result: Union[pd.DataFrame, ResultHandle]) -> Tuple[pd.DataFrame, bool]:
+    """
+    获取完整结果, 返回 (DataFrame, 是否完整); 结果已被淘汰时返回预览
+    """
+    if isinstance(result, pd.DataFrame):
+        return result, True
+    df = _result_store.load(result)
+    if df is None:
+        return result.preview, False
+    return df, True
+
+
+def result_store_stats(session_id: Optional[str] = None) -> Dict[str, int]:
+    """
+    结果存储的统计信息
+    """
+    return _result_store.stats(session_id)
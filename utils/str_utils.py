@@ -1,10 +1,13 @@
 import re
 import json
 import pandas as pd
-from typing import Any, Optional, Union
+from typing import Any, Iterator, Optional, Tuple, Union
 from xml.etree import ElementTree
 from .type_utils import *
 
+_CAMEL = re.compile(r"([a-z])([A-Z])")
+_WORD = re.compile(r"[a-z]+|\d+|[一-鿿]|[^\W\d_a-z一-鿿]+")
+
 
 def is_valid_json(s: str) -> bool:
     """
@@ -17,60 +20,227 @@ def is_valid_json(s: str) -> bool:
         return False
 
 
+def quote_identifier(name: str) -> str:
+    """
+    转义SQL标识符
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+SQL_KEYWORDS = {
+    "ALL", "AND", "AS", "ASC", "BETWEEN", "BY", "CASE", "CAST", "CROSS", "DESC", "DISTINCT", "ELSE", "END", "ESCAPE",
+    "EXCEPT", "EXISTS", "FROM", "FULL", "GLOB", "GROUP", "HAVING", "IN", "INNER", "INTERSECT", "IS", "JOIN", "LEFT",
+    "LIKE", "LIMIT", "NATURAL", "NOT", "NULL", "OFFSET", "ON", "OR", "ORDER", "OUTER", "OVER", "PARTITION", "RIGHT",
+    "SELECT", "THEN", "UNION", "USING", "WHEN", "WHERE", "WINDOW", "WITH",
+}
+
+_SQL_TOKEN = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+  | (?P<number>\d+\.\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?|\d+(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+def _normalize_number(literal: str) -> str:
+    """
+    规范化数字字面量, 保留整数与小数的区别
+    """
+    if re.fullmatch(r"\d+", literal):
+        return str(int(literal))
+    mantissa, _, exponent = literal.lower().partition("e")
+    if "." in mantissa:
+        integer, fraction = mantissa.split(".")
+        mantissa = f"{int(integer or '0')}.{fraction.rstrip('0') or '0'}"
+    return mantissa + (f"e{int(exponent)}" if exponent else "")
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    规范化SQL: 去掉注释和末尾分号, 合并空白, 关键字与函数名转大写, 规范化数字字面量; 字符串与标识符保持原样
+    """
+    tokens = [(match.lastgroup, match.group()) for match in _SQL_TOKEN.finditer(sql) if match.lastgroup not in ("comment", "space")]
+    for i, (kind, token) in enumerate(tokens):
+        if kind == "word" and (token.upper() in SQL_KEYWORDS or (i + 1 < len(tokens) and tokens[i + 1][1] == "(")):
+            tokens[i] = (kind, token.upper())
+        elif kind == "number":
+            tokens[i] = (kind, _normalize_number(token))
+    tokens = [token for _, token in tokens]
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return " ".join(tokens)
+
+
+_FROM_END = {"WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "WINDOW", "UNION", "EXCEPT", "INTERSECT", "ON", "USING", "SELECT", "VALUES"}
+_JOIN_WORDS = {"NATURAL", "LEFT", "RIGHT", "FULL", "INNER", "OUTER", "CROSS"}
+
+
+def _table_references(tokens: List[Tuple[str, str]]) -> Iterator[Tuple[int, Optional[int]]]:
+    """
+    在去掉注释与空白的token序列中找出FROM/JOIN子句中的表引用, 产出 (表名token下标, 别名token下标或None)
+    """
+    depth, from_depths, expect_table = 0, [], False
+    i = 0
+    while i < len(tokens):
+        kind, token = tokens[i]
+        upper = token.upper() if kind == "word" else token
+        if token == "(":
+            depth += 1
+            expect_table = False
+        elif token == ")":
+            while from_depths and from_depths[-1] >= depth:
+                from_depths.pop()
+            depth -= 1
+        elif upper in ("FROM", "JOIN"):
+            if upper == "FROM" or not from_depths or from_depths[-1] != depth:
+                from_depths.append(depth)
+            expect_table = True
+        elif upper in _FROM_END:
+            if from_depths and from_depths[-1] == depth and upper not in ("ON", "USING"):
+                from_depths.pop()
+            expect_table = False
+        elif token == "," and from_depths and from_depths[-1] == depth:
+            expect_table = True
+        elif expect_table and kind in ("word", "quoted") and upper not in SQL_KEYWORDS:
+            # 跳过 schema.table 中的 schema
+            if i + 2 < len(tokens) and tokens[i + 1][1] == "." and tokens[i + 2][0] in ("word", "quoted"):
+                i += 2
+            table, alias = i, None
+            j = i + 1
+            if j < len(tokens) and tokens[j][0] == "word" and tokens[j][1].upper() == "AS":
+                j += 1
+            if j < len(tokens) and tokens[j][0] in ("word", "quoted") and tokens[j][1].upper() not in SQL_KEYWORDS | _JOIN_WORDS:
+                alias = i = j
+            yield table, alias
+            expect_table = False
+        elif upper not in _JOIN_WORDS:
+            expect_table = False
+        i += 1
+
+
+def _unquote_token(kind: str, token: str) -> str:
+    """
+    去掉带引号标识符的引号
+    """
+    if kind != "quoted":
+        return token
+    return token[1:-1].replace('""', '"') if token[0] == '"' else token[1:-1]
+
+
+def table_aliases(sql: str) -> Dict[str, str]:
+    """
+    解析FROM/JOIN子句中的表引用, 返回 {小写的别名或表名: 表名}
+
+    查询计划中的 "SCAN x" 在有别名时只给出别名, 需要据此映射回真实表; 子查询的别名不在结果中
+    """
+    tokens = [(match.lastgroup, match.group()) for match in _SQL_TOKEN.finditer(sql) if match.lastgroup not in ("comment", "space")]
+    aliases: Dict[str, str] = {}
+    for table, alias in _table_references(tokens):
+        name = _unquote_token(*tokens[table])
+        aliases.setdefault(name.lower(), name)
+        if alias is not None:
+            aliases[_unquote_token(*tokens[alias]).lower()] = name
+    return aliases
+
+
+def rename_tables(sql: str, mapping: Dict[str, str]) -> str:
+    """
+    把SQL中FROM/JOIN子句里的表名以及 "表名.列名" 中的表名按mapping(键为小写的原表名)替换, 其余部分保持原样
+    """
+    matches = [match for match in _SQL_TOKEN.finditer(sql) if match.lastgroup not in ("comment", "space")]
+    tokens = [(match.lastgroup, match.group()) for match in matches]
+    replace, aliases = set(), set()
+    for table, alias in _table_references(tokens):
+        if _unquote_token(*tokens[table]).lower() in mapping:
+            replace.add(table)
+        if alias is not None:
+            aliases.add(_unquote_token(*tokens[alias]).lower())
+    for i, (kind, token) in enumerate(tokens):
+        name = _unquote_token(kind, token).lower() if kind in ("word", "quoted") else None
+        if (name in mapping and name not in aliases and i + 1 < len(tokens) and tokens[i + 1][1] == "."
+                and (i == 0 or tokens[i - 1][1] != ".")):
+            replace.add(i)
+    parts, end = [], 0
+    for i in sorted(replace):
+        match = matches[i]
+        parts.append(sql[end:match.start()])
+        parts.append(quote_identifier(mapping[_unquote_token(*tokens[i]).lower()]))
+        end = match.end()
+    parts.append(sql[end:])
+    return "".join(parts)
+
+
+# 合法JSON对象/数组的开头: "{" 后只能是键或 "}", "[" 后只能是值或 "]"
+_JSON_START = re.compile(r'\{\s*["}]|\[\s*[-\d"\[\]{tfnNI]')
+# JSON结构字符扫描器与解码器, 供流式解析共用
+JSON_STRUCTURE = re.compile(r'[\[\]{}"\\]')
+JSON_DECODER = json.JSONDecoder()
+
+
+def _match_brackets(s: str, start: int, ends: Dict[int, int]) -> None:
+    """
+    从start处的括号开始扫描到它的匹配括号, 把扫描中遇到的每个结构括号(不在字符串内)的匹配结束位置记入ends,
+    括号不匹配或没有闭合时记为-1
+
+    从内层结构括号单独开始扫描会得到完全相同的结果, 因此一次扫描即可确定所有内层候选的结束位置
+    """
+    stack = []
+    in_string = False
+    escaped = -1
+    for match in JSON_STRUCTURE.finditer(s, start):
+        i, c = match.start(), match.group()
+        if in_string:
+            if i == escaped:
+                continue
+            if c == '\\':
+                escaped = i + 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in ('{', '['):
+            stack.append(i)
+        elif c in ('}', ']'):
+            if s[stack[-1]] != ('{' if c == '}' else '['):
+                break
+            ends[stack.pop()] = i + 1
+            if not stack:
+                return
+    for i in stack:
+        ends[i] = -1
+
+
 def extract_json_strings(s: str) -> List[Any]:
     """
     提取字符串中的所有json串
+
+    从左到右寻找可能的起点, 起点之后第一次括号配平处就是唯一可能合法的结束位置;
+    括号能配平时用 raw_decode 解析, 成功则跳到其结束位置继续, 否则从下一个字符继续.
+    括号匹配的结果在多个起点间共享, 整体为线性时间
     """
     result = []
+    ends: Dict[int, int] = {}
     i = 0
-    n = len(s)
-    while i < n:
-        if s[i] in ('{', '['):
-            stack = [s[i]]
-            start = i
-            max_j = -1
-            in_string = False
-            escaped = False
-            j = i + 1
-            while j < n:
-                c = s[j]
-                if not in_string:
-                    if c == '"':
-                        in_string = True
-                        escaped = False
-                    elif c in ('{', '['):
-                        stack.append(c)
-                    elif c == '}':
-                        if stack and stack[-1] == '{':
-                            stack.pop()
-                        else:
-                            break
-                    elif c == ']':
-                        if stack and stack[-1] == '[':
-                            stack.pop()
-                        else:
-                            break
-                else:
-                    if escaped:
-                        escaped = False
-                    else:
-                        if c == '\\':
-                            escaped = True
-                        elif c == '"':
-                            in_string = False
-                if not stack:
-                    substr = s[start:j+1]
-                    if is_valid_json(substr):
-                        max_j = j
-                j += 1
-            if max_j != -1:
-                result.append(s[start:max_j+1])
-                i = max_j + 1
+    while True:
+        match = _JSON_START.search(s, i)
+        if match is None:
+            break
+        start = match.start()
+        if start not in ends:
+            _match_brackets(s, start, ends)
+        if ends[start] != -1:
+            try:
+                value, end = JSON_DECODER.raw_decode(s, start)
+            except json.JSONDecodeError:
+                pass
             else:
-                i += 1
-        else:
-            i += 1
-    result = [json.loads(j) for j in result]
+                result.append(value)
+                i = end
+                continue
+        i = start + 1
     return result
 
 
@@ -81,7 +251,7 @@ def extract_xml(s: str, label: str) -> Optional[str]:
     try:
         root = ElementTree.fromstring(f"<root>{s}</root>")
         res = root.find(label).text.strip()
-    except ElementTree.ParseError:
+    except (ElementTree.ParseError, AttributeError):
         match = re.search(re.escape(f"<{label}>") + r'\n?(.*?)\n?' + re.escape(f"</{label}>"), s, re.DOTALL | re.IGNORECASE)
         res = match.group(1).strip() if match else None
     return res
@@ -97,6 +267,20 @@ def extract_code(markdown_str: str, code_language: str) -> List[str]:
     return code_blocks
 
 
+def extract_step_code(markdown_str: str, code_language: str) -> Dict[int, str]:
+    """
+    提取按 "### Step <编号>" 分节的Markdown中每节的最后一个代码块, 返回 {步骤编号: 代码}
+    """
+    headings = list(re.finditer(r"^#+\s*Step\s*(\d+)\b.*$", markdown_str, re.MULTILINE | re.IGNORECASE))
+    code_blocks = {}
+    for heading, next_heading in zip(headings, headings[1:] + [None]):
+        section = markdown_str[heading.end():next_heading.start() if next_heading else len(markdown_str)]
+        codes = extract_code(section, code_language)
+        if codes:
+            code_blocks.setdefault(int(heading.group(1)), codes[-1])
+    return code_blocks
+
+
 def chat_history_formatter(messages: Messages) -> str:
     """
     格式化聊天记录
@@ -117,6 +301,41 @@ def pd_df_formatter(dfs: Union[pd.DataFrame, List[pd.DataFrame]], head: bool=Tru
             else:
                 dfs_preview.append(f"df{i + 1}.to_markdown():\n{md}")
         return '\n'.join(dfs_preview)
+    attrs = dfs.attrs
+    truncated = attrs.get("truncated", False)
+    max_rows = attrs.get("max_rows")
     if head:
         dfs = dfs.head()
-    return dfs.to_markdown(index=False).replace("|:", "|-").replace(":|", "-|") or "Empty DataFrame"
+    md = dfs.to_markdown(index=False).replace("|:", "|-").replace(":|", "-|") or "Empty DataFrame"
+    if truncated:
+        md += f"\n(Truncated: only the first {max_rows} rows of the result were returned)"
+    if attrs.get("error"):
+        md += f"\n(Query failed: {attrs['error']})"
+    return md
+
+
+def same_question(a: str, b: str) -> bool:
+    """
+    判断两个问题是否只有大小写、标点或空白上的差别
+    """
+    def normalize(text: str) -> List[str]:
+        return re.findall(r"\w+", text.lower())
+    return normalize(a) == normalize(b)
+
+
+def _stem(word: str) -> str:
+    """
+    简单的英文词形还原: 去掉复数后缀
+    """
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词: 拆分驼峰与下划线命名, 英文按词、中文按字切分
+    """
+    return [_stem(word) for word in _WORD.findall(_CAMEL.sub(r"\1 \2", text).lower())]
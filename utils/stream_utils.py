@@ -0,0 +1,110 @@
+import re
+import json
+from typing import Any, Callable, Dict, List
+from .str_utils import JSON_STRUCTURE, JSON_DECODER
+
+_PLAN_ARRAY = re.compile(r'"plan"\s*:\s*\[')
+
+
+class XmlElementParser:
+    """
+    增量解析xml元素, 每个元素闭合时立即产出其文本
+    """
+
+    def __init__(self, label: str):
+        self._pattern = re.compile(re.escape(f"<{label}>") + r"\n?(.*?)\n?" + re.escape(f"</{label}>"), re.DOTALL | re.IGNORECASE)
+        self._text = ""
+        self._pos = 0
+
+    def feed(self, token: str) -> List[str]:
+        """
+        追加一段输出, 返回新闭合的元素文本
+        """
+        self._text += token
+        elements = []
+        while (match := self._pattern.search(self._text, self._pos)) is not None:
+            elements.append(match.group(1).strip())
+            self._pos = match.end()
+        return elements
+
+
+class PlanStepParser:
+    """
+    增量解析计划JSON中 "plan" 数组的元素, 每个步骤对象闭合时立即产出
+
+    只解析输出中的第一个 "plan" 数组; 无法解析为JSON对象的元素(如带注释的模板)被跳过.
+    扫描状态在多次feed之间保留, 每个字符只扫描一次
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._in_array = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = -1
+        self._element = -1
+
+    def feed(self, token: str) -> List[Dict[str, Any]]:
+        """
+        追加一段输出, 返回新闭合的步骤对象
+        """
+        self._text += token
+        if self._done:
+            return []
+        if not self._in_array:
+            match = _PLAN_ARRAY.search(self._text, self._pos)
+            if match is None:
+                # "plan" 键可能被截断在末尾, 下次从它(或末尾几个字符)开始重新匹配
+                last = self._text.rfind('"plan"', self._pos)
+                self._pos = last if last != -1 else max(self._pos, len(self._text) - len('"plan'))
+                return []
+            self._in_array = True
+            self._pos = match.end()
+        steps = []
+        for match in JSON_STRUCTURE.finditer(self._text, self._pos):
+            i, c = match.start(), match.group()
+            if self._in_string:
+                if i == self._escaped:
+                    continue
+                if c == '\\':
+                    self._escaped = i + 1
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in ('{', '['):
+                if self._depth == 0 and c == '{':
+                    self._element = i
+                self._depth += 1
+            elif self._depth == 0:
+                self._done = True
+                break
+            else:
+                self._depth -= 1
+                if self._depth == 0 and self._element != -1:
+                    try:
+                        step, _ = JSON_DECODER.raw_decode(self._text, self._element)
+                    except json.JSONDecodeError:
+                        step = None
+                    if isinstance(step, dict):
+                        steps.append(step)
+                    self._element = -1
+        self._pos = len(self._text)
+        return steps
+
+
+def until_elements(*labels: str) -> Callable[[str], bool]:
+    """
+    构造chat的on_token回调: 指定的xml元素都已闭合时返回True, 提前结束流式请求
+    """
+    parsers = {label: XmlElementParser(label) for label in labels}
+    pending = set(labels)
+
+    def on_token(token: str) -> bool:
+        for label in list(pending):
+            if parsers[label].feed(token):
+                pending.discard(label)
+        return not pending
+    return on_token
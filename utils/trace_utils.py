@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import pandas as pd
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+TRACE_DIR = "./tmp/traces"
+TRACE_SERVICE_NAME = "data-qa"
+TRACE_FORMATS = ("off", "jsonl", "otlp")
+
+_local = threading.local()
+
+
+@dataclass
+class Span:
+    """
+    一个阶段的耗时与指标
+
+    时间为Unix纳秒时间戳; attributes记录阶段的指标, 如 ttft_ms、prompt_tokens、completion_tokens、cache_hit、rows、sql_ms
+    """
+    name: str
+    trace: Optional["Trace"] = field(repr=False)
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        """
+        耗时(毫秒), 尚未结束时计算到当前时间
+        """
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set(self, **attributes: Any) -> "Span":
+        """
+        设置指标
+        """
+        self.attributes.update(attributes)
+        return self
+
+    def add(self, **metrics: float) -> "Span":
+        """
+        累加指标
+        """
+        for key, value in metrics.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+        return self
+
+    def finish(self, error: Optional[BaseException]=None) -> None:
+        """
+        结束span, error不为None时标记为失败
+        """
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        转换为JSONL记录
+        """
+        return {
+            "trace_id": self.trace.trace_id if self.trace else None,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """
+        转换为OTLP/JSON格式的span
+        """
+        span = {
+            "traceId": self.trace.trace_id if self.trace else "",
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items() if value is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """
+    转换为OTLP的AnyValue
+    """
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """
+    一次提问的所有span, 可以从多个线程追加
+    """
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        """
+        追加span
+        """
+        with self._lock:
+            self.spans.append(span)
+
+    def to_jsonl(self) -> str:
+        """
+        每个span一行JSON
+        """
+        with self._lock:
+            spans = list(self.spans)
+        return "".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n" for span in spans)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """
+        OTLP/JSON格式的 ExportTraceServiceRequest, 可以直接发送给OpenTelemetry Collector
+        """
+        with self._lock:
+            spans = list(self.spans)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        汇总整个trace的耗时、LLM调用、token用量与sql执行指标; llm_estimated_usage为token用量由本地估算的LLM调用数
+        """
+        with self._lock:
+            spans = list(self.spans)
+        llm = [span for span in spans if span.name in ("llm", "write_response")]
+        sql = [span for span in spans if span.name == "execute_sql"]
+        return {
+            "duration_ms": spans[0].duration_ms if spans else 0.0,
+            "llm_calls": len(llm),
+            "llm_cache_hits": sum(1 for span in llm if span.attributes.get("cache_hit")),
+            "llm_estimated_usage": sum(1 for span in llm if span.attributes.get("usage_estimated")),
+            "prompt_tokens": sum(span.attributes.get("prompt_tokens", 0) for span in llm),
+            "completion_tokens": sum(span.attributes.get("completion_tokens", 0) for span in llm),
+            "sql_queries": len(sql),
+            "sql_ms": sum(span.attributes.get("sql_ms", 0.0) for span in sql),
+            "rows": sum(span.attributes.get("rows", 0) for span in sql),
+        }
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        瀑布图数据: 按开始时间排列的span, 时间相对于trace开始, 名称按层级缩进
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        if not spans:
+            return pd.DataFrame(columns=["span", "start_ms", "end_ms", "duration_ms", "metrics", "error"])
+        depth: Dict[str, int] = {}
+        origin = spans[0].start_ns
+        rows = []
+        for i, span in enumerate(spans):
+            depth[span.span_id] = depth.get(span.parent_id, -1) + 1 if span.parent_id else 0
+            end_ns = span.end_ns or time.time_ns()
+            rows.append({
+                "span": f"{i:>3} " + "  " * depth[span.span_id] + span.name,
+                "start_ms": (span.start_ns - origin) / 1e6,
+                "end_ms": (end_ns - origin) / 1e6,
+                "duration_ms": (end_ns - span.start_ns) / 1e6,
+                "metrics": ", ".join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                                     for key, value in span.attributes.items() if value is not None),
+                "error": span.error or "",
+            })
+        return pd.DataFrame(rows)
+
+
+def current_span() -> Optional[Span]:
+    """
+    当前线程正在进行的span
+    """
+    return getattr(_local, "span", None)
+
+
+@contextmanager
+def trace_scope(parent: Optional[Span]) -> Iterator[None]:
+    """
+    为当前线程指定父span, 供线程池中的任务把span挂到提交任务时的span下
+    """
+    previous = getattr(_local, "span", None)
+    _local.span = parent
+    try:
+        yield
+    finally:
+        _local.span = previous
+
+
+def start_span(name: str, **attributes: Any) -> Span:
+    """
+    在当前span下开始一个子span, 但不把它设为当前span; 需要调用 finish 结束
+
+    没有进行中的trace时返回不记录的span, 调用方无需判断
+    """
+    parent = current_span()
+    trace = parent.trace if parent is not None else None
+    span = Span(name, trace, uuid.uuid4().hex[:16], parent.span_id if parent is not None else None, time.time_ns(),
+                attributes={key: value for key, value in attributes.items() if value is not None})
+    if trace is not None:
+        trace.add(span)
+    return span
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    在with块内记录一个span, 并设为当前span
+    """
+    child = start_span(name, **attributes)
+    try:
+        with trace_scope(child):
+            yield child
+    except BaseException as e:
+        child.finish(e)
+        raise
+    child.finish()
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Trace]:
+    """
+    开始一次新的trace, with块内的span都记录在其根span下
+    """
+    trace = Trace(name)
+    root = Span(name, trace, uuid.uuid4().hex[:16], None, time.time_ns(),
+                attributes={key: value for key, value in attributes.items() if value is not None})
+    trace.add(root)
+    try:
+        with trace_scope(root):
+            yield trace
+    except BaseException as e:
+        root.finish(e)
+        raise
+    root.finish()
+
+
+def traced(name: Optional[str]=None) -> Callable[[Callable], Callable]:
+    """
+    装饰器: 函数的每次调用记录为一个span, 名称默认为函数名
+    """
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def export_trace(trace: Trace, fmt: str, directory: str=TRACE_DIR) -> Optional[str]:
+    """
+    把trace追加到导出文件, fmt为 jsonl(每个span一行) 或 otlp(每个trace一行OTLP/JSON), 返回文件路径
+    """
+    if fmt == "jsonl":
+        path, content = os.path.join(directory, "traces.jsonl"), trace.to_jsonl()
+    elif fmt == "otlp":
+        path, content = os.path.join(directory, "traces.otlp.jsonl"), json.dumps(trace.to_otlp(), ensure_ascii=False, default=str) + "\n"
+    else:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as fp:
+        fp.write(content)
+    return path
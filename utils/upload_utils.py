@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from collections import Counter
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "./tmp/store"
+STORE_QUOTA_BYTES = 8 * 2 ** 30
+LEASE_TTL = 2 * 3600
+HASH_CHUNK_SIZE = 2 ** 20
+
+
+def hash_upload(file: BinaryIO, chunk_size: int=HASH_CHUNK_SIZE) -> str:
+    """
+    分块计算上传文件内容的sha256
+    """
+    digest = hashlib.sha256()
+    position = file.tell()
+    file.seek(0)
+    try:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    finally:
+        file.seek(position)
+    return digest.hexdigest()
+
+
+def write_upload(file: BinaryIO, path: str, chunk_size: int=HASH_CHUNK_SIZE) -> None:
+    """
+    分块把上传文件写到path
+    """
+    position = file.tell()
+    file.seek(0)
+    try:
+        with open(path, "wb") as fp:
+            while chunk := file.read(chunk_size):
+                fp.write(chunk)
+    finally:
+        file.seek(position)
+
+
+def _size(path: str) -> int:
+    """
+    文件或目录占用的字节数
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class IngestStore:
+    """
+    按内容寻址的导入存储, 在所有会话间共享
+
+    parts/<sha256>/ 保存单个上传文件导入后的SQLite文件与清单, workspaces/<key>.sqlite 保存由若干文件合并成的工作区,
+    workspaces/<key>.sqlite.<后缀> 保存工作区的派生数据(如Parquet导出、自动索引副本), 与工作区共用租约.
+    条目先写到临时路径再原子重命名, 同一条目同时只有一个线程构建; 会话通过租约引用工作区,
+    构建工作区期间通过临时租约(lease)引用所用的导入结果, 磁盘用量超过配额时按最近使用时间淘汰没有有效租约的条目
+    """
+
+    def __init__(self, root: str, quota_bytes: int, lease_ttl: float):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.lease_ttl = lease_ttl
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._held: Counter = Counter()
+        self._sizes: Optional[Dict[str, int]] = None
+        self._building: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def part_dir(self, digest: str) -> str:
+        """
+        上传文件的导入结果目录
+        """
+        return os.path.join(self.root, "parts", digest)
+
+    def workspace_path(self, key: str) -> str:
+        """
+        工作区数据库路径
+        """
+        return os.path.join(self.root, "workspaces", f"{key}.sqlite")
+
+    @staticmethod
+    def read_manifest(part_dir: str) -> Dict[str, Any]:
+        """
+        读取导入结果的清单
+        """
+        with open(os.path.join(part_dir, "manifest.json"), encoding="utf-8") as fp:
+            return json.load(fp)
+
+    @staticmethod
+    def write_manifest(part_dir: str, manifest: Dict[str, Any]) -> None:
+        """
+        写入导入结果的清单
+        """
+        with open(os.path.join(part_dir, "manifest.json"), "w", encoding="utf-8") as fp:
+            json.dump(manifest, fp, ensure_ascii=False)
+
+    @contextmanager
+    def build(self, path: str) -> Iterator[Optional[str]]:
+        """
+        构建条目: path已存在时产出None, 否则产出临时路径, 正常退出后原子重命名为path, 异常时删除临时路径
+
+        同一path的构建互斥, 等待中的线程在前一次构建完成后直接复用结果
+        """
+        with self._lock:
+            lock = self._building.setdefault(path, threading.Lock())
+        with lock:
+            if os.path.exists(path):
+                os.utime(path)
+                yield None
+                return
+            directory, name = os.path.split(path)
+            os.makedirs(directory, exist_ok=True)
+            temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+            try:
+                yield temp_path
+                os.replace(temp_path, path)
+                self._track(path, _size(path))
+            finally:
+                if os.path.isdir(temp_path):
+                    shutil.rmtree(temp_path, ignore_errors=True)
+                elif os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def _track(self, path: str, size: Optional[int]) -> None:
+        """
+        更新缓存的条目大小, size为None表示条目已删除; 尚未统计过时不做处理
+        """
+        with self._lock:
+            if self._sizes is None:
+                return
+            if size is None:
+                self._sizes.pop(path, None)
+            else:
+                self._sizes[path] = size
+
+    @staticmethod
+    def owner(path: str) -> str:
+        """
+        条目所属的工作区(派生数据属于其工作区, 其它条目属于自身)
+        """
+        path = os.path.abspath(path)
+        directory, name = os.path.split(path)
+        if os.path.basename(directory) == "workspaces" and ".sqlite." in name:
+            return os.path.join(directory, name.split(".sqlite.", 1)[0] + ".sqlite")
+        return path
+
+    def acquire(self, session_id: str, path: str) -> None:
+        """
+        会话开始(或继续)使用path, 同时释放该会话之前的租约
+        """
+        with self._lock:
+            self._leases[session_id] = (os.path.abspath(path), time.time())
+        os.utime(path)
+
+    def release(self, session_id: str) -> None:
+        """
+        释放会话的租约
+        """
+        with self._lock:
+            self._leases.pop(session_id, None)
+
+    @contextmanager
+    def lease(self, paths: Iterable[str]) -> Iterator[None]:
+        """
+        在with块内持有paths的临时租约, 期间这些条目不会被淘汰
+
+        应在构建或读取条目之前取得: 淘汰与构建互斥, 取得租约时正在被淘汰的条目会在随后的构建中重新生成
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        with self._lock:
+            self._held.update(paths)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held.subtract(paths)
+                self._held += Counter()
+
+    def leased(self) -> Dict[str, int]:
+        """
+        每个条目的有效租约数, 同时清理过期的租约
+        """
+        now = time.time()
+        counts: Dict[str, int] = {}
+        with self._lock:
+            for session_id, (path, touched) in list(self._leases.items()):
+                if now - touched > self.lease_ttl:
+                    del self._leases[session_id]
+                    continue
+                counts[path] = counts.get(path, 0) + 1
+        return counts
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """
+        列出所有条目 (路径, 字节数, 最近使用时间)
+        """
+        entries = []
+        for kind in ["parts", "workspaces"]:
+            directory = os.path.join(self.root, kind)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    entries.append((path, _size(path), os.path.getmtime(path)))
+                except OSError:
+                    continue
+        return entries
+
+    def cleanup(self, on_remove: Optional[Callable[[str], None]]=None) -> int:
+        """
+        磁盘用量超过配额时按最近使用时间淘汰没有租约(包括临时租约)且不在构建中的条目, 返回释放的字节数
+        """
+        entries = self.entries()
+        with self._lock:
+            self._sizes = {path: size for path, size, _ in entries}
+        total = sum(size for _, size, _ in entries)
+        if total <= self.quota_bytes:
+            return 0
+        leased = self.leased()
+        freed = 0
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total - freed <= self.quota_bytes:
+                break
+            if leased.get(self.owner(path)):
+                continue
+            with self._lock:
+                lock = self._building.setdefault(path, threading.Lock())
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                with self._lock:
+                    held = self._held[os.path.abspath(path)] > 0 or self._held[self.owner(path)] > 0
+                if held:
+                    continue
+                if on_remove is not None:
+                    on_remove(path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+                self._track(path, None)
+                freed += size
+            finally:
+                lock.release()
+        logger.info(f"Ingest store cleanup freed {freed / 2 ** 20:.1f} MB ({total / 2 ** 20:.1f} MB used, quota {self.quota_bytes / 2 ** 20:.0f} MB)")
+        return freed
+
+    def stats(self) -> Dict[str, int]:
+        """
+        存储统计
+
+        首次调用时遍历存储, 之后使用由 build 与 cleanup 维护的条目大小, 不在每次渲染时读盘;
+        不经 build 写入的派生数据(如自动索引副本)在下一次 cleanup 时计入
+        """
+        with self._lock:
+            sizes = None if self._sizes is None else dict(self._sizes)
+        if sizes is None:
+            sizes = {path: size for path, size, _ in self.entries()}
+            with self._lock:
+                if self._sizes is None:
+                    self._sizes = dict(sizes)
+        return {
+            "parts": sum(1 for path in sizes if os.path.basename(os.path.dirname(path)) == "parts"),
+            "workspaces": sum(1 for path in sizes if path.endswith(".sqlite") and os.path.basename(os.path.dirname(path)) == "workspaces"),
+            "bytes": sum(sizes.values()),
+            "leases": sum(self.leased().values()),
+        }
+
+
+_ingest_store = IngestStore(STORE_DIR, STORE_QUOTA_BYTES, LEASE_TTL)
+
+
+def get_ingest_store() -> IngestStore:
+    """
+    获取进程内共享的导入存储
+    """
+    return _ingest_store